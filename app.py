@@ -1,40 +1,44 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from supabase import create_client, Client
 import os
 import time
 import json
 import io
+import base64
+import hashlib
+import hmac
+import gzip
+import tempfile
 import textwrap
+import threading
+import sqlite3
+import bisect
+import functools
+import importlib.util
+from contextlib import contextmanager
+from itertools import accumulate
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from types import SimpleNamespace
-import extra_streamlit_components as xtc
-try:
-    from streamlit_autorefresh import st_autorefresh
-except ImportError:
-    st_autorefresh = None
-
-# Importación segura de librerías opcionales
-try:
-    import openpyxl
-    HAS_OPENPYXL = True
-except (ImportError, ModuleNotFoundError):
-    HAS_OPENPYXL = False
-
-try:
-    from docx import Document
-    from docx.shared import Pt, Inches
-    from docx.enum.text import WD_ALIGN_PARAGRAPH
-    HAS_DOCX = True
-except ImportError:
-    HAS_DOCX = False
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Librerías opcionales: solo se comprueba que estén instaladas; se importan al usarlas
+# (Excel en las páginas de admin, Word en Facturación), no en cada proceso nuevo
+HAS_OPENPYXL = importlib.util.find_spec("openpyxl") is not None
+HAS_DOCX = importlib.util.find_spec("docx") is not None
 
 # Helper para zona horaria (Lima/Bogotá UTC-5)
 def get_lima_now():
     return datetime.now(timezone.utc) - timedelta(hours=5)
 
 def generate_word_letter(texto_completo, firma_resp):
+    from docx import Document
+    from docx.shared import Pt, Inches
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
     doc = Document()
     style = doc.styles['Normal']
     font = style.font
@@ -80,6 +84,295 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+# --- INSTRUMENTACIÓN DE CONSULTAS ---
+# Cada consulta ejecutada se anota en la lista de la ejecución del script en curso
+# (un hilo por ejecución en Streamlit); el panel de administración la resume al final.
+# Solo se registra entre iniciar_registro_consultas(True) y el cierre de la ejecución:
+# los hilos de fondo (p. ej. BufferLatidos) y las sesiones sin panel ni log no anotan nada.
+UMBRAL_N_MAS_1 = 5
+_consultas_locales = threading.local()
+
+def consultas_de_la_ejecucion():
+    return getattr(_consultas_locales, 'lista', None) or []
+
+def iniciar_registro_consultas(activo):
+    _consultas_locales.lista = [] if activo else None
+
+def _medir_respuesta(respuesta):
+    # Hook de httpx: tamaño del cuerpo recibido, sin volver a serializar ``data``
+    if getattr(_consultas_locales, 'lista', None) is not None:
+        respuesta.read()
+        _consultas_locales.bytes_respuesta = len(respuesta.content)
+
+def _enganchar_sesion(builder):
+    sesion = getattr(getattr(builder, 'request', None), 'session', None)
+    hooks = getattr(sesion, 'event_hooks', None)
+    if hooks is not None and _medir_respuesta not in hooks.get('response', []):
+        hooks.setdefault('response', []).append(_medir_respuesta)
+
+class _ConsultaInstrumentada:
+    """Envuelve un request builder de postgrest y mide su ``execute()``."""
+
+    def __init__(self, tabla, builder, pasos=(), forma=()):
+        self._tabla = tabla
+        self._builder = builder
+        self._pasos = list(pasos)
+        # Misma cadena sin los valores filtrados: sirve para detectar patrones N+1
+        self._forma = list(forma)
+
+    def __getattr__(self, nombre):
+        attr = getattr(self._builder, nombre)
+        if hasattr(attr, 'execute') and not callable(attr):
+            # Propiedades que devuelven otro builder (p. ej. ``not_``)
+            return _ConsultaInstrumentada(self._tabla, attr, self._pasos + [nombre], self._forma + [nombre])
+        if not callable(attr):
+            return attr
+
+        def llamada(*args, **kwargs):
+            res = attr(*args, **kwargs)
+            if hasattr(res, 'execute'):
+                paso = f"{nombre}({', '.join([repr(a) for a in args] + [f'{k}={v!r}' for k, v in kwargs.items()])})"
+                columna = args[0] if args and isinstance(args[0], str) and nombre not in ('insert', 'upsert', 'update') else ''
+                return _ConsultaInstrumentada(self._tabla, res, self._pasos + [paso[:120]], self._forma + [f"{nombre}:{columna}"])
+            return res
+        return llamada
+
+    def execute(self):
+        registro = getattr(_consultas_locales, 'lista', None)
+        if registro is None:
+            return self._builder.execute()
+        _enganchar_sesion(self._builder)
+        _consultas_locales.bytes_respuesta = None
+        t0 = time.perf_counter()
+        error = None
+        try:
+            resp = self._builder.execute()
+            return resp
+        except Exception as e:
+            error, resp = str(e)[:200], None
+            raise
+        finally:
+            data = getattr(resp, 'data', None)
+            registro.append({
+                'tabla': self._tabla,
+                'operacion': next((p.split('(')[0] for p in self._pasos if p.split('(')[0] in ('select', 'insert', 'update', 'upsert', 'delete')), 'rpc' if self._tabla.startswith('rpc:') else 'select'),
+                'pasos': self._pasos,
+                'forma': '.'.join(self._forma),
+                'filas': len(data) if isinstance(data, list) else int(data is not None),
+                'bytes': _consultas_locales.bytes_respuesta or 0,
+                'ms': round((time.perf_counter() - t0) * 1000, 1),
+                'seccion': seccion_actual(),
+                'error': error,
+            })
+
+class ClienteInstrumentado:
+    """Cliente de Supabase que registra cada consulta; el resto de la API pasa tal cual."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, nombre):
+        return _ConsultaInstrumentada(nombre, self._client.table(nombre))
+
+    from_ = table
+
+    def rpc(self, nombre, params=None, *args, **kwargs):
+        return _ConsultaInstrumentada(f"rpc:{nombre}", self._client.rpc(nombre, params, *args, **kwargs))
+
+    def __getattr__(self, nombre):
+        return getattr(self._client, nombre)
+
+def patrones_n_mas_1(consultas, umbral=UMBRAL_N_MAS_1):
+    """Tablas consultadas ``umbral`` o más veces con la misma forma (mismos filtros, otros valores)."""
+    formas = {}
+    for c in consultas:
+        forma = (c['tabla'], c['operacion'], c['forma'])
+        formas[forma] = formas.get(forma, 0) + 1
+    return [{'tabla': t, 'operacion': op, 'forma': forma, 'veces': n}
+            for (t, op, forma), n in sorted(formas.items(), key=lambda x: -x[1]) if n >= umbral]
+
+def ruta_log_consultas():
+    try:
+        return st.secrets.get("RUTA_LOG_CONSULTAS") or os.getenv("RUTA_LOG_CONSULTAS")
+    except Exception:
+        return os.getenv("RUTA_LOG_CONSULTAS")
+
+def registro_consultas_solicitado():
+    # Administradores (ven el panel) o cualquier sesión si hay un log configurado
+    return bool(st.session_state.get('user') and st.session_state.get('is_admin')) or bool(ruta_log_consultas())
+
+def guardar_log_consultas(consultas, n_mas_1, fragmento=None):
+    # Una línea JSON por ejecución del script (o rerun de fragmento), solo si RUTA_LOG_CONSULTAS está configurada
+    ruta = ruta_log_consultas()
+    if not ruta or not consultas:
+        return
+    usuario = st.session_state.get('user')
+    registro = {
+        'fecha': datetime.now(timezone.utc).isoformat(),
+        'usuario': getattr(usuario, 'id', None),
+        'fragmento': fragmento,
+        'consultas': consultas,
+        'n_mas_1': n_mas_1,
+    }
+    try:
+        with open(ruta, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(registro, default=str, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+def mostrar_panel_consultas(consultas, n_mas_1, contenedor=st.sidebar, fragmento=None):
+    titulo = f"rerun de '{fragmento}'" if fragmento else "esta ejecución"
+    with contenedor.expander(f" Consultas de {titulo} ({len(consultas)})"):
+        if not consultas:
+            st.caption("Sin consultas a Supabase en esta ejecución.")
+            return
+        total_ms = sum(c['ms'] for c in consultas)
+        total_kb = sum(c['bytes'] for c in consultas) / 1024
+        st.caption(f"{total_ms:,.0f} ms · {total_kb:,.1f} KB · {sum(c['filas'] for c in consultas):,} filas")
+        for patron in n_mas_1:
+            st.warning(f"Posible N+1: {patron['veces']} consultas {patron['operacion']} a '{patron['tabla']}' con la misma forma.")
+        resumen = pd.DataFrame(consultas).groupby(['tabla', 'operacion']).agg(
+            consultas=('ms', 'size'), ms=('ms', 'sum'), filas=('filas', 'sum'), bytes=('bytes', 'sum')
+        ).sort_values('ms', ascending=False).reset_index()
+        st.dataframe(resumen, hide_index=True, use_container_width=True)
+        st.download_button(" Log JSON", data=json.dumps({'consultas': consultas, 'n_mas_1': n_mas_1}, default=str, ensure_ascii=False, indent=2),
+                           file_name=f"consultas_{get_lima_now().strftime('%Y%m%d_%H%M%S')}.json", mime="application/json")
+
+# --- PERFILADOR POR SESIÓN (?perfil=1) ---
+# Mide cuánto tarda cada sección con nombre del script en cada rerun. Solo trabaja
+# en las sesiones que lo activaron; en el resto ``seccion()`` no hace nada.
+HISTORIAL_PERFIL = 20
+RAIZ_PERFIL = "ejecución"
+_perfil_local = threading.local()
+
+def perfil_solicitado():
+    """Lee ``?perfil=1`` / ``?perfil=0`` y lo recuerda en la sesión."""
+    valor = st.query_params.get("perfil")
+    if valor is not None:
+        st.session_state.perfil_activo = valor not in ("0", "false", "")
+    return st.session_state.get('perfil_activo', False)
+
+def iniciar_perfil(activo):
+    _perfil_local.activo = activo
+    # Pila de (ruta, inicio, manual); las secciones manuales las cierra la siguiente hermana
+    _perfil_local.pila = [((RAIZ_PERFIL,), time.perf_counter(), False)]
+    _perfil_local.tiempos = {}
+    _perfil_local.orden = {(RAIZ_PERFIL,): 0}
+
+def _perfil_activo():
+    # Fuera de una ejecución medida (hilos de fondo, reruns de fragmentos sin
+    # fragmento_medido) la pila ya quedó cerrada: no se perfila
+    return getattr(_perfil_local, 'activo', False) and bool(_perfil_local.pila)
+
+def _abrir_seccion(nombre, manual):
+    ruta = _perfil_local.pila[-1][0] + (nombre,)
+    _perfil_local.orden.setdefault(ruta, len(_perfil_local.orden))
+    _perfil_local.pila.append((ruta, time.perf_counter(), manual))
+    return ruta
+
+def _cerrar_seccion(ruta=None):
+    # Cierra secciones hasta ``ruta`` inclusive (o solo la del tope)
+    while _perfil_local.pila:
+        tope, inicio, _ = _perfil_local.pila.pop()
+        acumulado = _perfil_local.tiempos.setdefault(tope, [0.0, 0])
+        acumulado[0] += time.perf_counter() - inicio
+        acumulado[1] += 1
+        if ruta is None or tope == ruta:
+            break
+
+@contextmanager
+def seccion(nombre):
+    if not _perfil_activo():
+        yield
+        return
+    ruta = _abrir_seccion(nombre, False)
+    try:
+        yield
+    finally:
+        _cerrar_seccion(ruta)
+
+def entrar_seccion(nombre):
+    """Abre una sección sin bloque ``with``; dura hasta la siguiente hermana o el fin del rerun."""
+    if not _perfil_activo():
+        return
+    while _perfil_local.pila[-1][2]:
+        _cerrar_seccion()
+    _abrir_seccion(nombre, True)
+
+def perfilado(nombre):
+    def decorador(func):
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            with seccion(nombre):
+                return func(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def seccion_actual():
+    if not _perfil_activo():
+        return None
+    return ";".join(_perfil_local.pila[-1][0])
+
+def cerrar_perfil(consultas=()):
+    """Cierra todo lo abierto y devuelve el desglose del rerun (tiempo total y propio por sección)."""
+    if not _perfil_activo():
+        return []
+    _cerrar_seccion((RAIZ_PERFIL,))
+    tiempos, orden = _perfil_local.tiempos, _perfil_local.orden
+    hijos = {}
+    for ruta, (total, _) in tiempos.items():
+        if len(ruta) > 1:
+            hijos[ruta[:-1]] = hijos.get(ruta[:-1], 0.0) + total
+    en_consultas = {}
+    for c in consultas:
+        if c.get('seccion'):
+            en_consultas[c['seccion']] = en_consultas.get(c['seccion'], 0.0) + c['ms']
+    return [{
+        'seccion': ";".join(ruta),
+        'nivel': len(ruta) - 1,
+        'llamadas': n,
+        'total_ms': round(total * 1000, 1),
+        'propio_ms': round(max(total - hijos.get(ruta, 0.0), 0.0) * 1000, 1),
+        'consultas_ms': round(en_consultas.get(";".join(ruta), 0.0), 1),
+    } for ruta, (total, n) in sorted(tiempos.items(), key=lambda x: [orden[x[0][:i]] for i in range(1, len(x[0]) + 1)])]
+
+def pilas_colapsadas(reruns):
+    """Formato "a;b;c <µs>" de flamegraph.pl / speedscope, sumando el tiempo propio de varios reruns."""
+    pilas = {}
+    for desglose in reruns:
+        for fila in desglose:
+            pilas[fila['seccion']] = pilas.get(fila['seccion'], 0) + int(fila['propio_ms'] * 1000)
+    return "\n".join(f"{pila} {us}" for pila, us in pilas.items() if us > 0) + "\n"
+
+def mostrar_panel_perfil(desglose, contenedor=st.sidebar, fragmento=None):
+    historial = st.session_state.setdefault('perfil_historial', [])
+    historial.append(desglose)
+    del historial[:-HISTORIAL_PERFIL]
+    with contenedor.expander(f" Perfil del rerun de '{fragmento}'" if fragmento else " Perfil de este rerun", expanded=not fragmento):
+        if not desglose:
+            return
+        st.caption(f"Total {desglose[0]['total_ms']:,.0f} ms · {len(historial)} reruns acumulados en la sesión")
+        vista = pd.DataFrame(desglose)
+        vista['seccion'] = ["\u2003" * n + s.rsplit(";", 1)[-1] for n, s in zip(vista['nivel'], vista['seccion'])]
+        st.dataframe(vista.drop(columns='nivel'), hide_index=True, use_container_width=True)
+        st.download_button(" Perfil (pilas colapsadas)", data=pilas_colapsadas(historial),
+                           file_name=f"perfil_{get_lima_now().strftime('%Y%m%d_%H%M%S')}.folded", mime="text/plain",
+                           help="Abrir con speedscope.app o flamegraph.pl; acumula los últimos reruns de la sesión.")
+        if st.button("Reiniciar acumulado", key=f"perfil_reiniciar_{fragmento}" if fragmento else "perfil_reiniciar"):
+            historial.clear()
+
+def cerrar_medicion(contenedor=st.sidebar, fragmento=None):
+    """Cierra el registro de consultas y el perfil de la ejecución; los administradores ven ambos paneles."""
+    consultas = list(consultas_de_la_ejecucion())
+    iniciar_registro_consultas(False)
+    n_mas_1 = patrones_n_mas_1(consultas)
+    perfil = cerrar_perfil(consultas)
+    guardar_log_consultas(consultas, n_mas_1, fragmento)
+    if st.session_state.get('user') and st.session_state.get('is_admin'):
+        mostrar_panel_consultas(consultas, n_mas_1, contenedor, fragmento)
+        if perfil:
+            mostrar_panel_perfil(perfil, contenedor, fragmento)
+
 # Inicializacin de Supabase con soporte para Nube
 @st.cache_resource
 def get_supabase():
@@ -99,11 +392,12 @@ def get_supabase():
     url, key, service_key = map(clean, [url, key, service_key])
     
     # Priorizar Service Key para administración
-    return create_client(url, service_key if service_key else key)
+    return ClienteInstrumentado(create_client(url, service_key if service_key else key))
 
+iniciar_registro_consultas(registro_consultas_solicitado())
+iniciar_perfil(perfil_solicitado())
+entrar_seccion("Inicio y cookies")
 supabase = get_supabase()
-# Inicializar gestor de cookies (CRITICAL PARA IOS)
-cookie_manager = xtc.CookieManager()
 
 # --- TRAMPA DE CIERRE TOTAL (HARD LOGOUT) ---
 # Si detectamos 'logout' en la URL, limpiamos TODO antes de que la app se cargue
@@ -141,6 +435,147 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- TOKEN DE SESIÓN FIRMADO ---
+# La cookie lleva nombre, rol y si es admin, firmados con HMAC-SHA256. Al volver se
+# restaura sin ir a la BD; pasado REVALIDAR_TOKEN_S se confirma en segundo plano que el
+# perfil sigue activo y se renueva el token. La cookie antigua (user_id_persist, solo el
+# id y sin firma) ya no abre sesión: se borra del navegador y se pide el login.
+COOKIE_SESION = "sesion_er"
+COOKIE_ANTIGUA = "user_id_persist"
+VIGENCIA_TOKEN_S = 30 * 24 * 3600
+REVALIDAR_TOKEN_S = 12 * 3600
+VIGENCIA_REVALIDACION_S = 60  # una respuesta no recogida en este plazo se descarta
+
+@st.cache_resource
+def get_clave_sesion():
+    # Sin SESSION_SECRET ni service key se usa una clave aleatoria: los tokens valen
+    # solo mientras viva el proceso (tras reiniciar se vuelve a pedir login)
+    secreto = (st.secrets.get("SESSION_SECRET") or os.getenv("SESSION_SECRET")
+               or st.secrets.get("SUPABASE_SERVICE_KEY") or os.getenv("SUPABASE_SERVICE_KEY"))
+    if not secreto:
+        return os.urandom(32)
+    return hashlib.sha256(f"sesion-er:{str(secreto).strip()}".encode()).digest()
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode()
+
+def _firma_token(cuerpo):
+    return _b64(hmac.new(get_clave_sesion(), cuerpo.encode(), hashlib.sha256).digest())
+
+def firmar_token_sesion(perfil, is_admin):
+    ahora = int(time.time())
+    datos = {
+        "uid": perfil['id'], "nom": perfil.get('full_name', ''), "rid": perfil.get('role_id'),
+        "rol": (perfil.get('roles') or {}).get('name', ''), "adm": bool(is_admin),
+        "iat": ahora, "exp": ahora + VIGENCIA_TOKEN_S,
+    }
+    cuerpo = _b64(json.dumps(datos, separators=(",", ":")).encode())
+    return f"{cuerpo}.{_firma_token(cuerpo)}"
+
+def leer_token_sesion(token):
+    """Datos del token si la firma es válida y no venció; None en cualquier otro caso."""
+    try:
+        cuerpo, firma = str(token).split(".")
+        if not hmac.compare_digest(firma, _firma_token(cuerpo)):
+            return None
+        datos = json.loads(base64.urlsafe_b64decode(cuerpo + "=" * (-len(cuerpo) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(datos, dict) or datos.get('exp', 0) < time.time():
+        return None
+    return datos
+
+def perfil_desde_token(datos):
+    return {
+        'id': datos['uid'], 'full_name': datos['nom'], 'role_id': datos.get('rid'),
+        'roles': {'name': datos['rol']}, 'is_admin': datos['adm'], 'is_active': True,
+    }
+
+def es_admin(perfil):
+    return perfil.get('is_admin', False) or (perfil.get('account_type') == "Administrador")
+
+class RevalidadorSesiones:
+    """Confirma en segundo plano que el perfil de un token sigue activo.
+
+    Cada respuesta vale VIGENCIA_REVALIDACION_S: si la sesión que la pidió no la recoge
+    a tiempo (p. ej. se cerró la pestaña), se descarta y la próxima sesión vuelve a consultar.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self._en_curso = set()
+        self._resultados = {}  # user_id -> (resultado, instante monotónico)
+
+    def _vigente(self, user_id):
+        # Con el lock tomado: descarta la respuesta vencida
+        resultado = self._resultados.get(user_id)
+        if resultado and time.monotonic() - resultado[1] > VIGENCIA_REVALIDACION_S:
+            del self._resultados[user_id]
+            return None
+        return resultado
+
+    def solicitar(self, user_id):
+        with self._lock:
+            if user_id in self._en_curso or self._vigente(user_id):
+                return
+            self._en_curso.add(user_id)
+        threading.Thread(target=self._revalidar, args=(user_id,), daemon=True, name="revalidar-sesion").start()
+
+    def _revalidar(self, user_id):
+        try:
+            res = self._client.table("profiles").select("*, roles(name)").eq("id", user_id).execute()
+            perfil = res.data[0] if res and res.data else None
+            resultado = perfil if perfil and perfil.get('is_active') else False
+        except Exception:
+            resultado = None # Error de red: no se guarda nada y la siguiente solicitud consulta de nuevo
+        with self._lock:
+            self._en_curso.discard(user_id)
+            if resultado is not None:
+                self._resultados[user_id] = (resultado, time.monotonic())
+
+    def resultado(self, user_id):
+        """Perfil vigente, False si ya no puede entrar, o None si aún no hay respuesta.
+
+        Sin respuesta ni consulta en curso (error o respuesta vencida) pide otra.
+        """
+        with self._lock:
+            vigente = self._vigente(user_id)
+            if vigente:
+                del self._resultados[user_id]
+                return vigente[0]
+        self.solicitar(user_id)
+        return None
+
+@st.cache_resource
+def get_revalidador_sesiones():
+    return RevalidadorSesiones(get_supabase())
+
+def guardar_sesion_en_navegador(perfil, is_admin, aviso=True):
+    # Persistencia Universal: document.cookie (Lax) + LocalStorage (Fallback fuerte)
+    token = firmar_token_sesion(perfil, is_admin)
+    st.components.v1.html(f"""
+        <script>
+            const expire = new Date();
+            expire.setTime(expire.getTime() + ({VIGENCIA_TOKEN_S}*1000));
+            const value = "{COOKIE_SESION}={token}; expires=" + expire.toUTCString() + "; path=/; SameSite=Lax";
+            document.cookie = value;
+            localStorage.setItem("{COOKIE_SESION}", "{token}");
+            document.cookie = "{COOKIE_ANTIGUA}=; expires=Thu, 01 Jan 1970 00:00:00 GMT; path=/";
+            localStorage.removeItem("{COOKIE_ANTIGUA}");
+        </script>
+    """, height=0)
+    if aviso:
+        st.toast(" Sesión guardada en este dispositivo.")
+
+def borrar_cookie_antigua():
+    st.components.v1.html(f"""
+        <script>
+            document.cookie = "{COOKIE_ANTIGUA}=; expires=Thu, 01 Jan 1970 00:00:00 GMT; path=/";
+            localStorage.removeItem("{COOKIE_ANTIGUA}");
+        </script>
+    """, height=0)
+
 # Lógica de Login
 def login_user(email, password):
     try:
@@ -160,82 +595,909 @@ def login_user(email, password):
 
             st.session_state.user = response.user
             st.session_state.profile = p_data
-            is_admin_check = p_data.get('is_admin', False)
-            acc_type = p_data.get('account_type', '')
-            st.session_state.is_admin = is_admin_check or (acc_type == "Administrador")
+            st.session_state.is_admin = es_admin(p_data)
             st.session_state.logout_requested = False
-            
-            # Persistencia Universal: document.cookie (Lax) + LocalStorage (Fallback fuerte)
-            st.components.v1.html(f"""
-                <script>
-                    const expire = new Date();
-                    expire.setTime(expire.getTime() + (30*24*60*60*1000));
-                    const value = "user_id_persist={response.user.id}; expires=" + expire.toUTCString() + "; path=/; SameSite=Lax";
-                    document.cookie = value;
-                    localStorage.setItem("user_id_persist", "{response.user.id}");
-                </script>
-            """, height=0)
-            
-            
-            st.success(" Sesión guardada en este dispositivo.")
-            time.sleep(1.0)
+            # La cookie se escribe fuera del formulario de acceso (que se retira al entrar)
+            st.session_state.sesion_por_guardar = "login"
             # Limpiar cualquier estado residual de cronómetros anteriores
             limpiar_estado_timer()
-            st.rerun()
     except Exception as e:
         st.error(f" Error de acceso: {str(e)}")
 
+def a_utc(dt):
+    # Naive se asume UTC (como se guarda en BD); con zona se convierte
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt)
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+class IndiceIntervalos:
+    """Registros [inicio, fin) de un usuario ordenados por inicio.
+
+    Con el máximo acumulado de los fines, saber si un rango se cruza con alguno
+    es una búsqueda binaria, aunque los registros existentes se solapen entre sí.
+    """
+
+    def __init__(self, intervalos=()):
+        pares = sorted(intervalos)
+        self._inicios = [a for a, _ in pares]
+        self._fines = [b for _, b in pares]
+        self._max_fin = list(accumulate(self._fines, max))
+
+    def se_solapa(self, inicio, fin):
+        # Dos rangos se solapan si: (start1 < end2) AND (end1 > start2)
+        i = bisect.bisect_left(self._inicios, fin)
+        return i > 0 and self._max_fin[i - 1] > inicio
+
+    def agregar(self, inicio, fin):
+        i = bisect.bisect_right(self._inicios, inicio)
+        self._inicios.insert(i, inicio)
+        self._fines.insert(i, fin)
+        previo = self._max_fin[i - 1] if i > 0 else fin
+        self._max_fin[i:] = list(accumulate(self._fines[i:], max, initial=max(previo, fin)))[1:]
+
+def cargar_indices_intervalos(user_ids, desde, hasta):
+    """Un IndiceIntervalos por usuario con sus registros que tocan [desde, hasta), en una consulta."""
+    desde_iso = a_utc(desde).replace(tzinfo=None).isoformat()
+    hasta_iso = a_utc(hasta).replace(tzinfo=None).isoformat()
+    filas = obtener_todas_las_filas(lambda: supabase.table("time_entries").select("id, profile_id, start_time, end_time")
+                                    .in_("profile_id", list(user_ids)).lt("start_time", hasta_iso).gt("end_time", desde_iso).order("id"))
+    por_usuario = {u: [] for u in user_ids}
+    for f in filas:
+        if f['start_time'] and f['end_time']:
+            por_usuario.setdefault(f['profile_id'], []).append((a_utc(f['start_time']), a_utc(f['end_time'])))
+    return {u: IndiceIntervalos(v) for u, v in por_usuario.items()}
+
 def check_overlap(user_id, start_dt, end_dt):
     """Validar que no existan registros superpuestos para el mismo usuario.
     Dos rangos se solapan si: (start1 < end2) AND (end1 > start2)
     """
     try:
-        # Convertir a UTC y luego a strings ISO SIN timezone
-        if hasattr(start_dt, 'tzinfo'):
-            if start_dt.tzinfo is None:
-                start_utc = start_dt.replace(tzinfo=timezone.utc)
-                end_utc = end_dt.replace(tzinfo=timezone.utc)
-            else:
-                start_utc = start_dt.astimezone(timezone.utc)
-                end_utc = end_dt.astimezone(timezone.utc)
-        else:
-            start_utc = start_dt.replace(tzinfo=timezone.utc)
-            end_utc = end_dt.replace(tzinfo=timezone.utc)
-        
-        # Convertir a ISO strings SIN timezone para comparación
-        start_iso = start_utc.replace(tzinfo=None).isoformat()
-        end_iso = end_utc.replace(tzinfo=None).isoformat()
-        
-        # Crear timestamp de inicio del día (00:00:00) como string ISO
-        day_start = start_utc.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None).isoformat()
-        
-        # Obtener todos los registros del usuario desde el inicio del día
-        q = supabase.table("time_entries").select("id, start_time, end_time").eq("profile_id", user_id).gte("start_time", day_start).execute()
-        
-        if not q.data:
-            return False
-        
-        # Verificar solapamiento comparando strings ISO
-        for entry in q.data:
-            existing_start = entry['start_time']
-            existing_end = entry['end_time']
-            
-            # Lógica de solapamiento con strings ISO
-            if (existing_start < end_iso) and (existing_end > start_iso):
-                return True
-        
-        return False
+        start_utc, end_utc = a_utc(start_dt), a_utc(end_dt)
+        indice = cargar_indices_intervalos([user_id], start_utc, end_utc)[user_id]
+        return indice.se_solapa(start_utc, end_utc)
     except Exception as e:
         # En caso de error, permitir el registro (fail-safe)
         return False
 
+# --- DATOS DE REFERENCIA (caché compartida entre sesiones) ---
+# Se invalidan con invalidar_referencias() en cada pantalla que escribe en esas tablas.
 @st.cache_data(ttl=300, show_spinner=False)
 def get_clientes_cached():
     try:
-        return supabase.table("clients").select("id, name").order("name").execute()
+        return supabase.table("clients").select("id, name, doi_type, doi_number, address").order("name").execute()
     except:
         return None
 
+@st.cache_data(ttl=300, show_spinner=False)
+def get_proyectos_cached():
+    return supabase.table("projects").select("id, name, currency, client_id, clients(name)").order("name").execute().data or []
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_perfiles_cached():
+    return supabase.table("profiles").select("id, full_name, role_id, is_active").order("full_name").execute().data or []
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_roles_cached():
+    return supabase.table("roles").select("id, name").order("name").execute().data or []
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_tarifas_cached():
+    return supabase.table("project_rates").select("*").execute().data or []
+
+# Tabla escrita -> cachés que dependen de ella (los proyectos embeben el nombre del cliente)
+CACHES_POR_TABLA = {
+    "clients": [get_clientes_cached, get_proyectos_cached],
+    "projects": [get_proyectos_cached],
+    "profiles": [get_perfiles_cached],
+    "roles": [get_roles_cached],
+    "project_rates": [get_tarifas_cached],
+}
+
+def invalidar_referencias(*tablas):
+    versiones = get_versiones_referencias()
+    for tabla in tablas:
+        versiones[tabla] = versiones.get(tabla, 0) + 1
+        for cache in CACHES_POR_TABLA.get(tabla, []):
+            cache.clear()
+    if "time_entries" in tablas:
+        get_replica_entradas().marcar_pendiente()
+
+# --- MEMO DE SESIÓN ---
+# Búsquedas derivadas de las cachés (mapas de clientes, proyectos por cliente, tarifa
+# del usuario) guardadas en la sesión; se recalculan si cambia alguna de sus tablas.
+TTL_MEMO_SESION_S = 300
+
+@st.cache_resource
+def get_versiones_referencias():
+    # Contador por tabla compartido por el proceso; lo incrementa invalidar_referencias
+    return {}
+
+def memo_sesion(clave, tablas, calcular):
+    versiones = get_versiones_referencias()
+    firma = tuple(versiones.get(t, 0) for t in tablas)
+    memo = st.session_state.setdefault('memo_sesion', {})
+    guardado = memo.get(clave)
+    ahora = time.monotonic()
+    if guardado and guardado[0] == firma and ahora - guardado[1] < TTL_MEMO_SESION_S:
+        return guardado[2]
+    valor = calcular()
+    if valor is not None:
+        memo[clave] = (firma, ahora, valor)
+    return valor
+
+# --- RESOLUCIÓN DE TARIFAS (vectorizada) ---
+def resolver_tarifas(df, rates_df, role_col='profiles.role_id'):
+    """Tarifa, monto bruto y monto facturable por fila de ``df``.
+
+    Une los registros con project_rates por (project_id, role_id) en una sola
+    operación; si hay tarifas duplicadas se usa la primera, como antes.
+    """
+    claves = pd.DataFrame({'project_id': df['project_id'].to_numpy(), 'role_id': df[role_col].to_numpy()})
+    if rates_df is None or rates_df.empty:
+        tarifa = pd.Series(0.0, index=df.index)
+    else:
+        tabla = rates_df[['project_id', 'role_id', 'rate']].drop_duplicates(['project_id', 'role_id'])
+        tarifa = claves.merge(tabla, on=['project_id', 'role_id'], how='left')['rate']
+        tarifa = pd.Series(pd.to_numeric(tarifa, errors='coerce').fillna(0.0).to_numpy(dtype=float), index=df.index)
+    bruto = (pd.to_numeric(df['total_minutes'], errors='coerce') / 60) * tarifa
+    if 'is_billable' in df:
+        facturable = bruto.where(df['is_billable'].eq(True), 0.0)
+    else:
+        facturable = bruto
+    return pd.DataFrame({'tarifa': tarifa, 'bruto': bruto, 'facturable': facturable}, index=df.index)
+
+def matriz_tarifas(project_ids, roles):
+    """Matriz proyecto x rol con las tarifas vigentes, leídas en una sola consulta.
+
+    Las columnas son los ids de rol como texto; las celdas sin tarifa quedan en 0.0.
+    """
+    filas = supabase.table("project_rates").select("project_id, role_id, rate").in_("project_id", list(project_ids)).execute().data or []
+    tarifas = pd.DataFrame(filas, columns=['project_id', 'role_id', 'rate']).drop_duplicates(['project_id', 'role_id'])
+    tarifas['role_id'] = tarifas['role_id'].astype(str)
+    matriz = tarifas.pivot(index='project_id', columns='role_id', values='rate')
+    columnas = [str(r['id']) for r in roles]
+    return matriz.reindex(index=list(project_ids), columns=columnas).astype(float).fillna(0.0)
+
+def cambios_matriz(original, editada, roles):
+    """Celdas que cambiaron entre dos matrices de tarifas, como filas para guardar."""
+    role_ids = {str(r['id']): r['id'] for r in roles}
+    diff = editada.astype(float).ne(original.astype(float)) & editada.notna()
+    celdas = editada.where(diff).stack().dropna()
+    return [{"project_id": p_id, "role_id": role_ids[r_id], "rate": float(rate)} for (p_id, r_id), rate in celdas.items()]
+
+def guardar_tarifas_por_clave(filas, etiquetas, progreso=None):
+    """Guarda tarifas por (proyecto, rol): actualiza por id las que existen y crea el resto.
+
+    project_rates no tiene restricción única en (project_id, role_id), así que no se
+    puede hacer upsert por esa clave; los ids se buscan en una sola consulta. Si un par
+    está duplicado se actualizan todas sus filas, como el update por filtro de antes.
+    Devuelve (nuevas, actualizadas, errores).
+    """
+    project_ids = sorted({f['project_id'] for f in filas})
+    ids = {}
+    if project_ids:
+        for r in supabase.table("project_rates").select("id, project_id, role_id").in_("project_id", project_ids).execute().data or []:
+            ids.setdefault((r['project_id'], r['role_id']), []).append(r['id'])
+    return sincronizar_por_clave("project_rates", filas, etiquetas,
+                                 lambda f: ids.get((f['project_id'], f['role_id'])), progreso=progreso)
+
+# --- ENRIQUECIMIENTO DE REGISTROS (vectorizado) ---
+def a_hora_lima(serie):
+    return pd.to_datetime(serie, utc=True, errors='coerce', format='ISO8601').dt.tz_convert('America/Lima').dt.tz_localize(None)
+
+def formatear_fechas(serie, formato):
+    # strftime una vez por día distinto; NaT (código -1) cae en '---'
+    codigos, unicos = pd.factorize(serie)
+    textos = np.append(np.asarray(pd.DatetimeIndex(unicos).strftime(formato), dtype=object), '---')
+    return pd.Series(textos[codigos], index=serie.index)
+
+HORAS_DEL_DIA = np.array([f"{m // 60:02d}:{m % 60:02d}" for m in range(1440)] + ['---'], dtype=object)
+
+def formatear_horas(serie):
+    minuto_del_dia = (serie.dt.hour * 60 + serie.dt.minute).fillna(1440).astype(int)
+    return pd.Series(HORAS_DEL_DIA[minuto_del_dia.to_numpy()], index=serie.index)
+
+def formatear_minutos(serie):
+    minutos = pd.to_numeric(serie, errors='coerce').fillna(0).astype(int)
+    return minutos.map({m: f"{m // 60:02d}:{m % 60:02d}" for m in minutos.unique()})
+
+@perfilado("Enriquecimiento pandas")
+def enriquecer_entradas(df):
+    """Agrega a un DataFrame de time_entries las columnas de fecha/hora Lima y duración.
+
+    Columnas: dt_ref, dt_start, dt_end, Fecha (dd.mm-aaaa), Inicio, Fin (HH:MM), Tiempo (hh:mm).
+    """
+    df['dt_ref'] = df['start_time'].fillna(df['created_at']) if 'created_at' in df else df['start_time']
+    df['dt_start'] = a_hora_lima(df['dt_ref'])
+    df['dt_end'] = a_hora_lima(df['end_time']) if 'end_time' in df else pd.NaT
+    df['Fecha'] = formatear_fechas(df['dt_start'].dt.normalize(), '%d.%m-%Y')
+    df['Inicio'] = formatear_horas(df['dt_start'])
+    df['Fin'] = formatear_horas(df['dt_end'])
+    df['Tiempo'] = formatear_minutos(df['total_minutes'])
+    return df
+
+# --- RÉPLICA LOCAL DE time_entries (por proceso) ---
+# La sincronización incremental requiere time_entries.updated_at mantenida por un trigger
+# (supabase/migrations/20261017000000_time_entries_updated_at.sql). Mientras no se vea
+# que updated_at avanza al editar una fila, se recarga la tabla completa cada
+# INTERVALO_RECONCILIACION_S para no perder ediciones.
+TAM_PAGINA = 200
+TAM_LOTE_LECTURA = 1000
+INTERVALO_SINCRONIZACION_S = 15
+INTERVALO_RECONCILIACION_S = 300
+MARGEN_MARCA_S = 60  # relee este margen hacia atrás por transacciones que confirman tarde
+COLUMNAS_REPLICA = ['id', 'profile_id', 'project_id', 'start_time', 'end_time', 'total_minutes', 'is_billable', 'created_at', '_inicio']
+
+def obtener_todas_las_filas(construir_query, tam_lote=TAM_LOTE_LECTURA):
+    # Lee por bloques con .range() para no chocar con el límite de filas de PostgREST
+    filas, offset = [], 0
+    while True:
+        lote = construir_query().range(offset, offset + tam_lote - 1).execute().data or []
+        filas.extend(lote)
+        if len(lote) < tam_lote:
+            return filas
+        offset += tam_lote
+
+class ReplicaEntradas:
+    """Copia en memoria de time_entries compartida por todas las sesiones del proceso.
+
+    Cada sincronización trae solo las filas con updated_at posterior a la marca de agua.
+    Los borrados se detectan comparando la lista de ids cada INTERVALO_RECONCILIACION_S.
+    Sin un updated_at que avance al editar, cada reconciliación es una recarga completa.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self._df = None
+        self._marca = None
+        self._ultima_sinc = 0.0
+        self._ultima_reconciliacion = 0.0
+        self._pendiente = True
+        self._incremental = False  # la tabla tiene updated_at
+        self._trigger_visto = False  # se vio updated_at avanzar en una fila ya conocida
+        self._oyentes = []
+
+    def suscribir(self, oyente):
+        """Registra ``oyente(filas_df, ids_borrados)``; recibe de inmediato la copia actual."""
+        with self._lock:
+            self._oyentes.append(oyente)
+            if self._df is not None and not self._df.empty:
+                oyente(self._df, ())
+
+    def marcar_pendiente(self):
+        # Tras una escritura propia: la próxima lectura sincroniza sin esperar el intervalo
+        self._pendiente = True
+
+    def _aplicar(self, filas, borrados=()):
+        df = self._df
+        if borrados:
+            df = df.drop(index=list(borrados), errors='ignore')
+        if filas:
+            nuevas = pd.DataFrame(filas)
+            nuevas.index = pd.Index(nuevas['id'].to_numpy())
+            nuevas['_inicio'] = pd.to_datetime(nuevas['start_time'], utc=True, errors='coerce', format='ISO8601')
+            df = nuevas if df is None or df.empty else pd.concat([df.drop(index=nuevas.index, errors='ignore'), nuevas])
+        self._df = df
+        for oyente in self._oyentes:
+            oyente(nuevas if filas else None, borrados)
+
+    def _avanzar_marca(self, filas):
+        marcas = pd.to_datetime(pd.Series([f.get('updated_at') for f in filas]), utc=True, errors='coerce', format='ISO8601').dropna()
+        if not marcas.empty:
+            self._marca = (marcas.max() - timedelta(seconds=MARGEN_MARCA_S)).tz_localize(None).isoformat()
+
+    def _recargar(self):
+        """Lee la tabla completa y aplica solo las filas nuevas, cambiadas o borradas."""
+        filas = obtener_todas_las_filas(lambda: self._client.table("time_entries").select("*").order("id"))
+        if filas:
+            self._incremental = 'updated_at' in filas[0]
+        if self._df is None:
+            # La copia se publica solo después de una lectura completa sin errores
+            self._aplicar(filas)
+            if self._df is None:
+                self._df = pd.DataFrame(columns=COLUMNAS_REPLICA)
+        else:
+            ids_servidor = {f['id'] for f in filas}
+            antes = self._df
+            nuevas = pd.DataFrame(filas, index=[f['id'] for f in filas])
+            comunes = nuevas.index.intersection(antes.index)
+            columnas = [c for c in nuevas.columns if c in antes.columns]
+            a, b = antes.loc[comunes, columnas].astype(object), nuevas.loc[comunes, columnas].astype(object)
+            distintas = comunes[(a.ne(b) & ~(a.isna() & b.isna())).any(axis=1)]
+            cambiadas = set(nuevas.index.difference(antes.index)) | set(distintas)
+            self._aplicar([f for f in filas if f['id'] in cambiadas], set(antes.index) - ids_servidor)
+        if self._incremental:
+            self._avanzar_marca(filas)
+
+    def _traer_cambios(self):
+        def construir():
+            q = self._client.table("time_entries").select("*")
+            if self._marca:
+                q = q.gte("updated_at", self._marca)
+            return q.order("updated_at").order("id")
+        filas = obtener_todas_las_filas(construir)
+        if filas:
+            if not self._trigger_visto:
+                previas = self._df['updated_at'] if 'updated_at' in self._df else pd.Series(dtype=object)
+                self._trigger_visto = any(f['id'] in previas.index and f.get('updated_at') != previas[f['id']] for f in filas)
+            self._aplicar(filas)
+            self._avanzar_marca(filas)
+        return len(filas)
+
+    def _reconciliar(self):
+        ids_servidor = {f['id'] for f in obtener_todas_las_filas(
+            lambda: self._client.table("time_entries").select("id").order("id"))}
+        ids_locales = set(self._df.index)
+        self._aplicar([], ids_locales - ids_servidor)
+        # Filas sin updated_at (anteriores al trigger) que la marca de agua no alcanza
+        faltantes = list(ids_servidor - ids_locales)
+        for i in range(0, len(faltantes), TAM_LOTE_LECTURA):
+            self._aplicar(self._client.table("time_entries").select("*").in_("id", faltantes[i:i + TAM_LOTE_LECTURA]).execute().data or [])
+
+    def sincronizar(self, forzar=False):
+        ahora = time.monotonic()
+        if not (forzar or self._pendiente or ahora - self._ultima_sinc >= INTERVALO_SINCRONIZACION_S):
+            return
+        with self._lock:
+            reconciliar = ahora - self._ultima_reconciliacion >= INTERVALO_RECONCILIACION_S
+            if self._df is None or not self._incremental:
+                # Carga inicial, o tabla sin updated_at: solo lecturas completas
+                if self._df is None or reconciliar or self._pendiente:
+                    self._recargar()
+                    self._ultima_reconciliacion = ahora
+            else:
+                self._traer_cambios()
+                if reconciliar:
+                    if self._trigger_visto:
+                        self._reconciliar()
+                    else:
+                        self._recargar()
+                    self._ultima_reconciliacion = ahora
+            self._pendiente = False
+            self._ultima_sinc = ahora
+
+    def marco(self):
+        """DataFrame con todas las filas (indexado por id); no se modifica, se filtra."""
+        try:
+            self.sincronizar()
+        except Exception:
+            # Sin conexión se sirve la última copia; sin una carga completa previa, el error sube
+            if self._df is None:
+                raise
+        return self._df
+
+@st.cache_resource
+def get_replica_entradas():
+    return ReplicaEntradas(supabase)
+
+def lima_a_utc_iso(fecha, fin_de_dia=False):
+    # 00:00 en Lima (UTC-5) expresado como ISO UTC sin zona
+    dt = datetime.combine(fecha, datetime.min.time()) + timedelta(hours=5)
+    if fin_de_dia:
+        dt += timedelta(days=1)
+    return dt.isoformat()
+
+def filtrar_entradas(df, filtros):
+    """Filtra la réplica por fecha (días Lima), usuario y proyecto."""
+    mascara = pd.Series(True, index=df.index)
+    if filtros.get('desde'):
+        mascara &= df['_inicio'] >= pd.Timestamp(lima_a_utc_iso(filtros['desde']), tz='UTC')
+    if filtros.get('hasta'):
+        mascara &= df['_inicio'] < pd.Timestamp(lima_a_utc_iso(filtros['hasta'], fin_de_dia=True), tz='UTC')
+    if filtros.get('profile_ids'):
+        mascara &= df['profile_id'].isin(filtros['profile_ids'])
+    if filtros.get('project_ids') is not None:
+        mascara &= df['project_id'].isin(filtros['project_ids'])
+    return df[mascara]
+
+def entradas_locales(filtros, descendente=True):
+    """Registros de la réplica que cumplen los filtros, ordenados por (start_time, id)."""
+    df = filtrar_entradas(get_replica_entradas().marco(), filtros)
+    return df.sort_values(['_inicio', 'id'], ascending=not descendente, na_position='last')
+
+@perfilado("Unión con referencias")
+def unir_referencias(df):
+    """Agrega nombres de usuario, rol, proyecto y cliente desde las cachés de referencia.
+
+    Las columnas se llaman como las que daba json_normalize sobre los embeds de PostgREST.
+    """
+    df = df.copy()
+    perfiles = pd.DataFrame(get_perfiles_cached(), columns=['id', 'full_name', 'role_id']).set_index('id')
+    proyectos = pd.DataFrame(get_proyectos_cached(), columns=['id', 'name', 'currency', 'client_id', 'clients']).set_index('id')
+    roles = {r['id']: r['name'] for r in get_roles_cached()}
+    df['profiles.full_name'] = df['profile_id'].map(perfiles['full_name'])
+    df['profiles.role_id'] = df['profile_id'].map(perfiles['role_id'])
+    df['profiles.roles.name'] = df['profiles.role_id'].map(roles)
+    df['projects.name'] = df['project_id'].map(proyectos['name'])
+    df['projects.currency'] = df['project_id'].map(proyectos['currency'])
+    df['projects.client_id'] = df['project_id'].map(proyectos['client_id'])
+    df['projects.clients.name'] = df['project_id'].map(proyectos['clients'].map(lambda c: c.get('name') if isinstance(c, dict) else None))
+    return df.reset_index(drop=True)
+
+def pagina_entradas(filtros, cursor=None, limite=TAM_PAGINA):
+    """Página de registros ordenada por start_time desc, nulos al final (keyset: start_time, id).
+
+    Devuelve (df, cursor_siguiente); cursor_siguiente es None en la última página. Las
+    filas sin start_time van después de todas las demás y se recorren por id.
+    """
+    df = entradas_locales(filtros)
+    if cursor:
+        c_start, c_id = cursor
+        sin_inicio = df['_inicio'].isna()
+        if c_start is None:
+            df = df[sin_inicio & (df['id'] < c_id)]
+        else:
+            c_inicio = pd.Timestamp(c_start)
+            c_inicio = c_inicio.tz_localize('UTC') if c_inicio.tzinfo is None else c_inicio.tz_convert('UTC')
+            df = df[(df['_inicio'] < c_inicio) | ((df['_inicio'] == c_inicio) & (df['id'] < c_id)) | sin_inicio]
+    siguiente = None
+    if len(df) > limite:
+        ultima = df.iloc[limite - 1]
+        siguiente = (None if pd.isna(ultima['_inicio']) else ultima['start_time'], ultima['id'])
+    return unir_referencias(df.head(limite)), siguiente
+
+# --- ALMACÉN ANALÍTICO (SQLite en memoria, por proceso) ---
+ESQUEMA_ANALITICO = """
+    CREATE TABLE entradas (id PRIMARY KEY, profile_id, project_id, inicio TEXT, total_minutes REAL, is_billable INTEGER, description TEXT);
+    CREATE INDEX entradas_inicio ON entradas (inicio);
+    CREATE INDEX entradas_proyecto ON entradas (project_id, inicio);
+    CREATE INDEX entradas_perfil ON entradas (profile_id, inicio);
+    CREATE TABLE perfiles (id PRIMARY KEY, full_name TEXT, role_id);
+    CREATE TABLE proyectos (id PRIMARY KEY, name TEXT, currency TEXT, client_id);
+    CREATE INDEX proyectos_cliente ON proyectos (client_id);
+    CREATE TABLE tarifas (project_id, role_id, rate REAL, PRIMARY KEY (project_id, role_id));
+    CREATE TABLE agregados (dia TEXT, profile_id, project_id, moneda TEXT, n INTEGER, minutos REAL, bruto REAL, facturable REAL,
+                            PRIMARY KEY (dia, profile_id, project_id));
+    CREATE TEMP TABLE afectados (id PRIMARY KEY);
+"""
+FROM_MONTOS = """
+    FROM entradas e
+    LEFT JOIN perfiles pf ON pf.id = e.profile_id
+    LEFT JOIN proyectos p ON p.id = e.project_id
+    LEFT JOIN tarifas t ON t.project_id = e.project_id AND t.role_id = pf.role_id
+"""
+MONTO_SQL = "e.total_minutes / 60.0 * COALESCE(t.rate, 0)"
+
+# Agregado diario (día Lima, usuario, proyecto); ``signo`` -1 descuenta el aporte previo de las filas
+AGREGAR_SQL = f"""
+    INSERT INTO agregados (dia, profile_id, project_id, moneda, n, minutos, bruto, facturable)
+    SELECT COALESCE(date(e.inicio, '-5 hours'), ''), e.profile_id, e.project_id, p.currency,
+           {{signo}} * COUNT(*), {{signo}} * COALESCE(SUM(e.total_minutes), 0),
+           {{signo}} * COALESCE(SUM({MONTO_SQL}), 0),
+           {{signo}} * COALESCE(SUM(CASE WHEN e.is_billable = 1 THEN {MONTO_SQL} ELSE 0 END), 0)
+    {FROM_MONTOS} WHERE {{donde}}
+    GROUP BY 1, 2, 3
+    ON CONFLICT (dia, profile_id, project_id) DO UPDATE SET
+        n = n + excluded.n, minutos = minutos + excluded.minutos,
+        bruto = bruto + excluded.bruto, facturable = facturable + excluded.facturable
+"""
+
+def filas_sql(df):
+    # NaN/NaT a NULL y escalares de numpy a tipos nativos para sqlite3
+    return df.astype(object).where(df.notna(), None).to_numpy().tolist()
+
+class AlmacenAnalitico:
+    """Base SQLite en memoria con las columnas de time_entries que usan los reportes.
+
+    Se alimenta de los cambios de la réplica; perfiles, proyectos y tarifas se
+    recargan desde las cachés de referencia cuando cambian. La tabla ``agregados``
+    se mantiene al día con cada cambio: se resta el aporte anterior de las filas
+    afectadas y se suma el nuevo. Si cambian tarifas, roles o monedas se recalcula entera.
+    """
+
+    def __init__(self):
+        self._con = sqlite3.connect(":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        self._firma_referencias = None
+        self._con.executescript(ESQUEMA_ANALITICO)
+
+    def aplicar(self, filas, borrados=()):
+        ids = [valor_json(i) for i in borrados]
+        if filas is not None and not filas.empty:
+            ids += [valor_json(i) for i in filas['id']]
+        if not ids:
+            return
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM afectados")
+            self._con.executemany("INSERT OR IGNORE INTO afectados VALUES (?)", [(i,) for i in ids])
+            self._con.execute(AGREGAR_SQL.format(signo=-1, donde="e.id IN (SELECT id FROM afectados)"))
+            self._con.execute("DELETE FROM entradas WHERE id IN (SELECT id FROM afectados)")
+            if filas is not None and not filas.empty:
+                datos = pd.DataFrame({
+                    'id': filas['id'], 'profile_id': filas['profile_id'], 'project_id': filas['project_id'],
+                    'inicio': filas['_inicio'].dt.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'total_minutes': pd.to_numeric(filas['total_minutes'], errors='coerce'),
+                    'is_billable': filas['is_billable'].eq(True),
+                    'description': filas['description'] if 'description' in filas else None,
+                })
+                self._con.executemany("INSERT OR REPLACE INTO entradas VALUES (?, ?, ?, ?, ?, ?, ?)", filas_sql(datos))
+            self._con.execute(AGREGAR_SQL.format(signo=1, donde="e.id IN (SELECT id FROM afectados)"))
+            self._con.execute("DELETE FROM agregados WHERE n = 0")
+
+    def cargar_referencias(self, perfiles, proyectos, tarifas):
+        firma = hash(json.dumps([perfiles, proyectos, tarifas], sort_keys=True, default=str))
+        if firma == self._firma_referencias:
+            return
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM perfiles")
+            self._con.execute("DELETE FROM proyectos")
+            self._con.execute("DELETE FROM tarifas")
+            self._con.executemany("INSERT INTO perfiles VALUES (?, ?, ?)", [(p['id'], p['full_name'], p['role_id']) for p in perfiles])
+            self._con.executemany("INSERT INTO proyectos VALUES (?, ?, ?, ?)", [(p['id'], p['name'], p['currency'], p['client_id']) for p in proyectos])
+            # Con tarifas duplicadas vale la primera, como en resolver_tarifas
+            self._con.executemany("INSERT OR IGNORE INTO tarifas VALUES (?, ?, ?)", [(t['project_id'], t['role_id'], t['rate']) for t in tarifas])
+            self._con.execute("DELETE FROM agregados")
+            self._con.execute(AGREGAR_SQL.format(signo=1, donde="1"))
+        self._firma_referencias = firma
+
+    def consultar(self, sql, params=()):
+        with self._lock:
+            return pd.read_sql_query(sql, self._con, params=params)
+
+@st.cache_resource
+def get_almacen():
+    almacen = AlmacenAnalitico()
+    get_replica_entradas().suscribir(almacen.aplicar)
+    return almacen
+
+def consultar_almacen(sql, params=()):
+    """Consulta SQL sobre el almacén, con la réplica y las referencias al día."""
+    almacen = get_almacen()
+    get_replica_entradas().marco()
+    almacen.cargar_referencias(get_perfiles_cached(), get_proyectos_cached(), get_tarifas_cached())
+    return almacen.consultar(sql, params)
+
+def condiciones_sql(filtros, tabla='e'):
+    """WHERE y parámetros para los mismos filtros que filtrar_entradas, más cliente, proyectos y moneda.
+
+    Con ``tabla='a'`` las fechas se comparan contra el día Lima de la tabla ``agregados``.
+    """
+    cond, params = [], []
+    def en_lista(columna, valores):
+        cond.append(f"{columna} IN ({', '.join('?' * len(valores))})" if valores else "0")
+        params.extend(valor_json(v) for v in valores)
+    if filtros.get('desde'):
+        cond.append("a.dia >= ?" if tabla == 'a' else "e.inicio >= ?")
+        params.append(filtros['desde'].isoformat() if tabla == 'a' else lima_a_utc_iso(filtros['desde']))
+    if filtros.get('hasta'):
+        cond.append("a.dia <= ?" if tabla == 'a' else "e.inicio < ?")
+        params.append(filtros['hasta'].isoformat() if tabla == 'a' else lima_a_utc_iso(filtros['hasta'], fin_de_dia=True))
+    if filtros.get('profile_ids'):
+        en_lista(f"{tabla}.profile_id", filtros['profile_ids'])
+    if filtros.get('project_ids') is not None:
+        en_lista(f"{tabla}.project_id", filtros['project_ids'])
+    if filtros.get('client_id') is not None:
+        cond.append("p.client_id = ?")
+        params.append(filtros['client_id'])
+    if filtros.get('proyectos') is not None:
+        en_lista("p.name", filtros['proyectos'])
+    if filtros.get('moneda'):
+        cond.append("p.currency = ?")
+        params.append(filtros['moneda'])
+    return (" WHERE " + " AND ".join(cond)) if cond else "", params
+
+def totales_entradas(filtros):
+    """Totales por moneda sobre todo el conjunto filtrado (desde la tabla de agregados diarios)."""
+    where, params = condiciones_sql(filtros, tabla='a')
+    resumen = consultar_almacen(f"""
+        SELECT COALESCE(a.moneda, '') AS Moneda, SUM(a.n) AS n, SUM(a.minutos) AS Minutos,
+               SUM(a.bruto) AS "Valor Total", SUM(a.facturable) AS "Costo Facturable"
+        FROM agregados a{where}
+        GROUP BY 1 ORDER BY 1""", params)
+    return int(resumen['n'].sum()), resumen.drop(columns='n')
+
+def liquidacion_proyectos(client_id, desde, hasta):
+    """Proyectos del cliente con registros en el periodo, en orden de su primer registro."""
+    where, params = condiciones_sql({'client_id': client_id, 'desde': desde, 'hasta': hasta})
+    return consultar_almacen(f"""
+        SELECT p.name AS proyecto, p.currency AS moneda
+        {FROM_MONTOS}{where}
+        GROUP BY p.id ORDER BY MIN(e.inicio), MIN(e.id)""", params)
+
+def liquidacion_por_consultor(client_id, desde, hasta, proyectos):
+    """Horas y monto por consultor y moneda (pestaña Dashboard y total de la carta), desde los agregados diarios."""
+    where, params = condiciones_sql({'client_id': client_id, 'desde': desde, 'hasta': hasta, 'proyectos': proyectos}, tabla='a')
+    return consultar_almacen(f"""
+        SELECT pf.full_name AS "profiles.full_name", a.moneda AS "projects.currency",
+               SUM(a.minutos) / 60.0 AS Horas_num, SUM(a.bruto) AS Total_Monto
+        FROM agregados a
+        JOIN proyectos p ON p.id = a.project_id
+        LEFT JOIN perfiles pf ON pf.id = a.profile_id{where}
+        GROUP BY 1, 2 ORDER BY 1, 2""", params)
+
+def liquidacion_detalle(client_id, desde, hasta, proyectos, moneda):
+    """Registros del anexo en orden cronológico, con su monto."""
+    where, params = condiciones_sql({'client_id': client_id, 'desde': desde, 'hasta': hasta, 'proyectos': proyectos, 'moneda': moneda})
+    return consultar_almacen(f"""
+        SELECT p.name AS "projects.name", e.inicio AS start_time, pf.full_name AS "profiles.full_name",
+               e.description, e.total_minutes, {MONTO_SQL} AS Total_Monto
+        {FROM_MONTOS}{where}
+        ORDER BY e.inicio, e.id""", params)
+
+# --- DOCUMENTOS BAJO DEMANDA ---
+# Los botones de descarga reciben un callable: el archivo se arma solo al hacer clic
+# (en un hilo aparte) y st.cache_data lo memoiza por el contenido de los argumentos.
+@st.cache_data(max_entries=16, show_spinner=False)
+def docx_carta(texto_completo, firma_resp):
+    return generate_word_letter(texto_completo, firma_resp)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def xlsx_hoja(df, hoja):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=hoja)
+    return buffer.getvalue()
+
+# --- EXPORTACIÓN GLOBAL (por bloques, memoria constante) ---
+SELECT_EXPORTACION = "*, profiles(full_name), projects(name, currency, clients(name))"
+COLUMNAS_ANIDADAS = ['profiles.full_name', 'projects.name', 'projects.currency', 'projects.clients.name']
+
+def lotes_exportacion(tam_lote=TAM_LOTE_LECTURA):
+    """Recorre time_entries completo por id ascendente (keyset) y entrega un DataFrame por bloque.
+
+    Todos los bloques comparten las columnas del primero, para escribir un solo encabezado.
+    """
+    columnas, ultimo_id = None, None
+    while True:
+        q = supabase.table("time_entries").select(SELECT_EXPORTACION)
+        if ultimo_id is not None:
+            q = q.gt("id", ultimo_id)
+        lote = q.order("id").limit(tam_lote).execute().data or []
+        if not lote:
+            return
+        df = pd.json_normalize(lote)
+        if columnas is None:
+            columnas = [c for c in df.columns if c not in ('profiles', 'projects', 'projects.clients')]
+            columnas += [c for c in COLUMNAS_ANIDADAS if c not in columnas]
+        yield df.reindex(columns=columnas)
+        if len(lote) < tam_lote:
+            return
+        ultimo_id = lote[-1]['id']
+
+# Los archivos exportados viven en disco hasta VIGENCIA_EXPORTACION_S; el botón de
+# descarga los lee solo al hacer clic.
+DIR_EXPORTACIONES = os.path.join(tempfile.gettempdir(), "control_horas_exportaciones")
+VIGENCIA_EXPORTACION_S = 3600
+
+def purgar_exportaciones(vigencia=VIGENCIA_EXPORTACION_S):
+    # Borra las exportaciones vencidas, incluidas las de sesiones ya cerradas
+    try:
+        nombres = os.listdir(DIR_EXPORTACIONES)
+    except FileNotFoundError:
+        return
+    limite = time.time() - vigencia
+    for nombre in nombres:
+        ruta = os.path.join(DIR_EXPORTACIONES, nombre)
+        try:
+            if os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+        except OSError:
+            pass
+
+def leer_exportacion(ruta):
+    with open(ruta, 'rb') as archivo:
+        return archivo.read()
+
+def exportar_base_completa(ruta, formato, progreso=None, total=0):
+    """Escribe la base completa en ``ruta`` (xlsx en modo write-only o csv.gz) y devuelve las filas escritas."""
+    escritas = 0
+    if formato == 'xlsx':
+        import openpyxl
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('BaseCompleta')
+        for df in lotes_exportacion():
+            if escritas == 0:
+                ws.append(list(df.columns))
+            for fila in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+                ws.append(fila)
+            escritas += len(df)
+            if progreso and total:
+                progreso.progress(min(escritas / total, 1.0), text=f"{escritas} de {total} registros...")
+        if escritas == 0:
+            return 0
+        wb.save(ruta)
+    else:
+        with gzip.open(ruta, 'wt', encoding='utf-8-sig', newline='') as f:
+            for df in lotes_exportacion():
+                df.to_csv(f, index=False, header=escritas == 0)
+                escritas += len(df)
+                if progreso and total:
+                    progreso.progress(min(escritas / total, 1.0), text=f"{escritas} de {total} registros...")
+    return escritas
+
+# --- ESCRITURAS EN LOTE ---
+TAM_LOTE_ESCRITURA = 500
+
+def _insertar_bloque(tabla, bloque, etiquetas, errores, on_conflict=None):
+    try:
+        if on_conflict:
+            supabase.table(tabla).upsert(bloque, on_conflict=on_conflict).execute()
+        else:
+            supabase.table(tabla).insert(bloque).execute()
+        return len(bloque)
+    except Exception as e:
+        if len(bloque) == 1:
+            errores.append(f"{etiquetas[0]}: Error - {str(e)}")
+            return 0
+        # Bisección: aisla las filas con error sin perder las válidas del bloque
+        mitad = len(bloque) // 2
+        return (_insertar_bloque(tabla, bloque[:mitad], etiquetas[:mitad], errores, on_conflict)
+                + _insertar_bloque(tabla, bloque[mitad:], etiquetas[mitad:], errores, on_conflict))
+
+def insertar_en_lotes(tabla, filas, etiquetas, progreso=None, tam_lote=TAM_LOTE_ESCRITURA, on_conflict=None, previas=0, total=None):
+    """Inserta ``filas`` en bloques; devuelve (insertadas, errores por fila).
+
+    Con ``on_conflict`` cada bloque se envía como upsert sobre esas columnas. Si la
+    barra ``progreso`` se comparte entre varias llamadas, ``previas`` y ``total``
+    ubican estas filas dentro del total.
+    """
+    total = total or len(filas)
+    insertadas, errores = 0, []
+    for ini in range(0, len(filas), tam_lote):
+        insertadas += _insertar_bloque(tabla, filas[ini:ini + tam_lote], etiquetas[ini:ini + tam_lote], errores, on_conflict)
+        if progreso is not None:
+            hechas = previas + min(ini + tam_lote, len(filas))
+            progreso.progress(hechas / total, text=f"{hechas} de {total} filas procesadas")
+    return insertadas, errores
+
+def valor_celda(v, defecto=''):
+    # Celdas vacías de Excel llegan como NaN (no serializable a JSON)
+    return defecto if v is None or (isinstance(v, float) and pd.isna(v)) else v
+
+def clave_texto(v):
+    return str(valor_celda(v)).strip().lower()
+
+def sincronizar_por_clave(tabla, filas, etiquetas, id_existente, progreso=None):
+    """Carga idempotente: actualiza las filas que ya existen y crea el resto.
+
+    ``id_existente(fila)`` devuelve el id (o la lista de ids) de los registros con la
+    misma clave natural, o None. Las existentes van como upsert por id y las nuevas
+    como insert, ambos en lotes. Devuelve (nuevas, actualizadas, errores).
+    """
+    nuevas, n_etq, existentes, e_etq = [], [], [], []
+    for fila, etiqueta in zip(filas, etiquetas):
+        row_ids = id_existente(fila)
+        if row_ids is None:
+            nuevas.append(fila)
+            n_etq.append(etiqueta)
+            continue
+        for row_id in (row_ids if isinstance(row_ids, list) else [row_ids]):
+            existentes.append({"id": row_id, **fila})
+            e_etq.append(etiqueta)
+    # Una sola barra de 0 a 100 % para las dos escrituras
+    total = len(existentes) + len(nuevas)
+    actualizadas, errores = insertar_en_lotes(tabla, existentes, e_etq, progreso=progreso, on_conflict="id", total=total)
+    creadas, errores_ins = insertar_en_lotes(tabla, nuevas, n_etq, progreso=progreso, previas=len(existentes), total=total)
+    return creadas, actualizadas, errores + errores_ins
+
+# --- CAMBIOS DE EDITORES (change-set) ---
+def valor_json(v):
+    # Escalares de numpy/pandas a tipos nativos; NaN/NaT/NA a None
+    if v is None or (not isinstance(v, (list, dict)) and pd.isna(v)):
+        return None
+    return v.item() if hasattr(v, 'item') else v
+
+def conjunto_cambios(original, editado, columnas, clave='id'):
+    """Celdas modificadas en un st.data_editor, comparando por ``clave`` en una pasada.
+
+    Devuelve {id: {columna: valor_nuevo}} solo con las filas y columnas que cambiaron.
+    """
+    antes = original.drop_duplicates(clave).set_index(clave)[columnas]
+    despues = editado.drop_duplicates(clave).set_index(clave)[columnas]
+    antes = antes.reindex(despues.index)
+    iguales = pd.DataFrame({c: despues[c].eq(antes[c]) | (despues[c].isna() & antes[c].isna()) for c in columnas})
+    mascara = (~iguales).stack()
+    cambiadas = mascara.index[mascara.to_numpy(dtype=bool)]
+    cambios = {}
+    for fila_id, col in cambiadas:
+        cambios.setdefault(valor_json(fila_id), {})[col] = valor_json(despues.at[fila_id, col])
+    return cambios
+
+def aplicar_cambios(tabla, cambios, columnas_bd=None):
+    """Guarda un change-set: un update por grupo de filas con el mismo contenido (``in_`` sobre ids).
+
+    ``columnas_bd`` traduce nombres de pantalla a columnas de la tabla. Devuelve las filas afectadas.
+    """
+    columnas_bd = columnas_bd or {}
+    grupos = {}
+    for fila_id, campos in cambios.items():
+        payload = {columnas_bd.get(c, c): v for c, v in campos.items()}
+        grupos.setdefault(json.dumps(payload, sort_keys=True, default=str), (payload, []))[1].append(fila_id)
+    for payload, ids in grupos.values():
+        for i in range(0, len(ids), TAM_LOTE_ESCRITURA):
+            supabase.table(tabla).update(payload).in_("id", ids[i:i + TAM_LOTE_ESCRITURA]).execute()
+    return len(cambios)
+
+# --- CRONÓMETRO EN EL NAVEGADOR ---
+# El conteo por segundo lo hace el navegador; el servidor solo interviene en
+# Pausar/Fin/Sinc y en el latido periódico que mantiene vivo el registro.
+INTERVALO_LATIDO_S = 50
+
+def mostrar_cronometro_en_vivo(segundos_base):
+    st.components.v1.html(f"""
+        <div style="font-family: 'Source Sans Pro', sans-serif; color: #31333F;">
+            <div style="font-size: 14px;"> EN VIVO</div>
+            <div id="crono" style="font-size: 36px; line-height: 1.4;">--:--:--</div>
+        </div>
+        <script>
+            const base = {int(segundos_base)};
+            const t0 = Date.now();
+            const pad = (n) => String(n).padStart(2, "0");
+            function tick() {{
+                const s = base + Math.floor((Date.now() - t0) / 1000);
+                document.getElementById("crono").textContent =
+                    pad(Math.floor(s / 3600)) + ":" + pad(Math.floor((s % 3600) / 60)) + ":" + pad(s % 60);
+            }}
+            tick();
+            setInterval(tick, 1000);
+        </script>
+    """, height=90)
+
+# Los latidos de todas las sesiones se acumulan en memoria y se escriben en un
+# solo UPDATE cada INTERVALO_VACIADO_S. El retraso máximo en BD (latido + vaciado)
+# debe quedar muy por debajo del umbral de auto-stop de 300 s.
+INTERVALO_VACIADO_S = 30
+
+class BufferLatidos:
+    """Agregador de latidos compartido por todas las sesiones del proceso."""
+
+    def __init__(self, client, intervalo_s):
+        self._client = client
+        self._intervalo_s = intervalo_s
+        self._pendientes = {}
+        self._ultimo_visto = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._bucle, daemon=True, name="buffer-latidos").start()
+
+    def registrar(self, timer_id):
+        ahora = datetime.now(timezone.utc)
+        with self._lock:
+            self._pendientes[timer_id] = ahora
+            self._ultimo_visto[timer_id] = ahora
+
+    def olvidar(self, timer_id):
+        with self._lock:
+            self._pendientes.pop(timer_id, None)
+            self._ultimo_visto.pop(timer_id, None)
+
+    def ultimo_latido(self, timer_id):
+        # Latido aún no vaciado a BD (o ya vaciado) visto por este proceso
+        with self._lock:
+            return self._ultimo_visto.get(timer_id)
+
+    def vaciar(self):
+        with self._lock:
+            lote, self._pendientes = self._pendientes, {}
+            limite = datetime.now(timezone.utc) - timedelta(seconds=300)
+            self._ultimo_visto = {k: v for k, v in self._ultimo_visto.items() if v > limite}
+        if not lote:
+            return
+        # Un solo UPDATE para todo el lote; se usa el latido más antiguo para no
+        # declarar vivo a ningún cronómetro más allá de lo observado.
+        marca = min(lote.values())
+        try:
+            self._client.table("active_timers").update({"updated_at": marca.isoformat()}).in_("id", list(lote.keys())).execute()
+        except Exception:
+            with self._lock:
+                for k, v in lote.items():
+                    if k not in self._pendientes:
+                        self._pendientes[k] = v
+
+    def _bucle(self):
+        while True:
+            time.sleep(self._intervalo_s)
+            self.vaciar()
+
+@st.cache_resource
+def get_buffer_latidos():
+    return BufferLatidos(supabase, INTERVALO_VACIADO_S)
+
+@st.fragment(run_every=INTERVALO_LATIDO_S)
+def latido_cronometro(timer_id):
+    # Solo se re-ejecuta este fragmento, no el script completo
+    get_buffer_latidos().registrar(timer_id)
+
 # Sidebar y Ttulo
 st.title(" Control Horas - ER")
 
@@ -244,7 +1506,74 @@ if 'user' not in st.session_state:
 if 'logout_requested' not in st.session_state:
     st.session_state.logout_requested = False
 
+# --- HIDRATACIÓN DEL CRONÓMETRO ---
+# Una sola consulta por sesión (y una revisión cada INTERVALO_REVISION_TIMER_S si no hay
+# cronómetro, por si se inició en otro dispositivo); sin rerun: el formulario se dibuja
+# en la misma pasada con cliente y proyecto ya cargados.
+INTERVALO_REVISION_TIMER_S = 60
+
+def hidratar_cronometro():
+    if st.session_state.active_timer_id is not None or not st.session_state.user:
+        return
+    revision = st.session_state.get('timer_revisado')
+    if revision and revision[0] == st.session_state.user.id and time.monotonic() - revision[1] < INTERVALO_REVISION_TIMER_S:
+        return
+    st.session_state.timer_revisado = (st.session_state.user.id, time.monotonic())
+    try:
+        timer_q = supabase.table("active_timers").select("*, projects(name, client_id, clients(name))").eq("user_id", st.session_state.user.id).execute()
+    except Exception as e:
+        st.toast(f"No se pudo recuperar el cronómetro: {e}", icon="⚠️")
+        return
+    if not timer_q or not timer_q.data:
+        # No active timer found in DB
+        st.session_state.timer_running = False
+        st.session_state.active_timer_description = ""
+        return
+    t_data = timer_q.data[0]
+
+    # --- HEARTBEAT & AUTO-STOP CHECK ---
+    # Verificar si el cronómetro está "vivo" o si murió (batería, cierre inesperado)
+    last_update = pd.to_datetime(t_data.get('updated_at', t_data['created_at'])).replace(tzinfo=timezone.utc)
+    # Un latido pendiente en el buffer es más reciente que lo guardado en BD
+    latido_local = get_buffer_latidos().ultimo_latido(t_data['id'])
+    if latido_local and latido_local > last_update:
+        last_update = latido_local
+    now_utc = datetime.now(timezone.utc)
+
+    # Si pasaron más de 5 minutos desde último update, asumimos muerte súbita
+    if t_data['is_running'] and (now_utc - last_update).total_seconds() > 300:
+        # Calcular tiempo real hasta el corte
+        start_utc = pd.to_datetime(t_data['start_time']).replace(tzinfo=timezone.utc)
+        # Tiempo corrido hasta el último latido
+        valid_elapsed = t_data['total_elapsed_seconds'] + (last_update - start_utc).total_seconds()
+
+        try:
+            supabase.table("active_timers").update({
+                "is_running": False,
+                "total_elapsed_seconds": int(valid_elapsed),
+                "updated_at": now_utc.isoformat()
+            }).eq("id", t_data['id']).execute()
+            st.toast(f"⚠️ Cronómetro detenido automáticamente (Inactividad desde {last_update.astimezone(timezone(timedelta(hours=-5))).strftime('%H:%M')})", icon="🛑")
+            # Actualizar estado local
+            t_data['is_running'] = False
+            t_data['total_elapsed_seconds'] = int(valid_elapsed)
+        except Exception as e:
+            st.error(f"Error auto-deteniendo cronómetro: {e}")
+
+    # Cargar en sesión, incluido el cliente/proyecto para preseleccionarlos en el formulario
+    proyecto = t_data.get('projects') or {}
+    st.session_state.active_timer_id = t_data['id']
+    st.session_state.active_project_id = t_data['project_id']
+    st.session_state.active_project_name = proyecto.get('name')
+    st.session_state.active_client_name = (proyecto.get('clients') or {}).get('name')
+    st.session_state.timer_running = t_data['is_running']
+    st.session_state.active_timer_description = t_data.get('description', '')
+    st.session_state.active_timer_billable = t_data.get('is_billable', True)
+    st.session_state.total_elapsed = t_data['total_elapsed_seconds']
+    st.session_state.timer_start = pd.to_datetime(t_data['start_time']).replace(tzinfo=None) # Local time logic used elsewhere expects naive or handle with care
+
 # Función reutilizable para el Registro de Tiempos
+@perfilado("Formulario de registro")
 def mostrar_registro_tiempos():
     # Manejo de mensajes persistentes tras rerun
     if 'success_msg' in st.session_state:
@@ -260,355 +1589,309 @@ def mostrar_registro_tiempos():
 
     # --- SINCRONIZACIN INICIAL (CRITICAL PARA IOS) ---
     # Se hace AQU para que cargue Cliente/Proyecto ANTES de renderizar el formulario
-    if st.session_state.active_timer_id is None and st.session_state.user:
-        try:
-            timer_q = supabase.table("active_timers").select("*, projects(name, client_id, clients(name))").eq("user_id", st.session_state.user.id).execute()
-            if timer_q and timer_q.data:
-                t_data = timer_q.data[0]
-                
-                # --- HEARTBEAT & AUTO-STOP CHECK ---
-                # Verificar si el cronómetro está "vivo" o si murió (batería, cierre inesperado)
-                should_auto_stop = False
-                last_update = pd.to_datetime(t_data.get('updated_at', t_data['created_at'])).replace(tzinfo=timezone.utc)
-                now_utc = datetime.now(timezone.utc)
-                
-                # Si pasaron más de 5 minutos desde último update, asumimos muerte súbita
-                if t_data['is_running'] and (now_utc - last_update).total_seconds() > 300:
-                    should_auto_stop = True
-                    # Calcular tiempo real hasta el corte
-                    start_utc = pd.to_datetime(t_data['start_time']).replace(tzinfo=timezone.utc)
-                    # Tiempo corrido hasta el último latido
-                    valid_elapsed = t_data['total_elapsed_seconds'] + (last_update - start_utc).total_seconds()
-                    
-                    try:
-                        supabase.table("active_timers").update({
-                            "is_running": False,
-                            "total_elapsed_seconds": int(valid_elapsed),
-                            "updated_at": now_utc.isoformat()
-                        }).eq("id", t_data['id']).execute()
-                        st.toast(f"⚠️ Cronómetro detenido automáticamente (Inactividad desde {last_update.astimezone(timezone(timedelta(hours=-5))).strftime('%H:%M')})", icon="🛑")
-                        # Actualizar estado local
-                        t_data['is_running'] = False
-                        t_data['total_elapsed_seconds'] = int(valid_elapsed)
-                    except Exception as e:
-                        st.error(f"Error auto-deteniendo cronómetro: {e}")
-
-                # Cargar en sesión
-                if st.session_state.active_timer_id != t_data['id'] or should_auto_stop:
-                    st.session_state.active_timer_id = t_data['id']
-                    st.session_state.active_project_id = t_data['project_id']
-                    st.session_state.timer_running = t_data['is_running']
-                    st.session_state.active_timer_description = t_data.get('description', '')
-                    st.session_state.active_timer_billable = t_data.get('is_billable', True)
-                    st.session_state.total_elapsed = t_data['total_elapsed_seconds']
-                    st.session_state.timer_start = pd.to_datetime(t_data['start_time']).replace(tzinfo=None) # Local time logic used elsewhere expects naive or handle with care
+    hidratar_cronometro()
 
-            else:
-                # No active timer found in DB
-                st.session_state.active_timer_id = None
-                st.session_state.timer_running = False
-                st.session_state.active_timer_description = ""
-            st.rerun()
-        except: pass
-    
     # 1. Selección de Cliente (Siempre visible)
-    clientes_resp = None
-    for _ in range(3): # Simple retry logic
-        clientes_resp = get_clientes_cached()
-        if clientes_resp: break
-        time.sleep(0.5)
-        
-    if not clientes_resp or not clientes_resp.data:
+    def mapa_clientes():
+        for _ in range(3): # Simple retry logic
+            clientes_resp = get_clientes_cached()
+            if clientes_resp: break
+            time.sleep(0.5)
+        if clientes_resp and clientes_resp.data:
+            return {c['name']: c['id'] for c in clientes_resp.data}
+    client_map = memo_sesion(('clientes',), ('clients',), mapa_clientes)
+
+    if not client_map:
         st.info("Aún no hay clientes registrados (o error de conexión).")
         return
-        
-    client_map = {c['name']: c['id'] for c in clientes_resp.data}
-    
+
     # Recuperar cliente del timer activo si existe
     index_cliente = 0
     if 'active_client_name' in st.session_state and st.session_state.active_client_name in client_map:
         index_cliente = (list(client_map.keys()).index(st.session_state.active_client_name)) + 1
 
     cliente_sel = st.selectbox("Seleccionar Cliente", ["---"] + list(client_map.keys()), index=index_cliente, key=f"cli_{st.session_state.form_key_suffix}")
-    
-    # Variables de control y estado (Scope de la función)
-    fecha_sel = get_lima_now()
-    listo_para_registro = False
-    p_id = None
-    moneda = "$"
-    can_register = False
-    form_valido = False
-    descripcion = ""
-    es_facturable = True
-    target_user_id = st.session_state.user.id
-
-    if cliente_sel != "---":
-        proyectos = supabase.table("projects").select("id, name, currency").eq("client_id", client_map[cliente_sel]).order("name").execute()
-        if not proyectos.data:
-            st.warning(f"Sin proyectos para {cliente_sel}.")
-        else:
-            proj_map = {p['name']: p['id'] for p in proyectos.data}
-            proj_currency = {p['id']: p['currency'] for p in proyectos.data}
-            
-            index_proj = 0
-            if 'active_project_name' in st.session_state and st.session_state.active_project_name in proj_map:
-                index_proj = list(proj_map.keys()).index(st.session_state.active_project_name)
-
-            proyecto_sel = st.selectbox("Seleccionar Proyecto", list(proj_map.keys()), index=index_proj, key=f"pro_{st.session_state.form_key_suffix}")
-            p_id = proj_map[proyecto_sel]
-            moneda = proj_currency[p_id]
-            listo_para_registro = True
-            
-            st.info(f"Proyecto: **{proyecto_sel}** | Moneda: **{moneda}**")
-            
-            col_u1, col_u2 = st.columns(2)
-            with col_u1:
-                fecha_sel = st.date_input("Fecha", value=get_lima_now(), max_value=get_lima_now(), key=f"fec_{st.session_state.form_key_suffix}")
-            with col_u2:
-                if st.session_state.is_admin:
-                    usuarios_res = supabase.table("profiles").select("id, full_name").eq("is_active", True).execute()
-                    user_map = {u['full_name']: u['id'] for u in usuarios_res.data}
-                    usuario_para = st.selectbox("Registrar para", list(user_map.keys()), index=list(user_map.values()).index(st.session_state.user.id) if st.session_state.user.id in user_map.values() else 0, key=f"user_sel_{st.session_state.form_key_suffix}")
-                    target_user_id = user_map[usuario_para]
-                else:
-                    target_user_id = st.session_state.user.id
-                st.write(f"Usuario: **{st.session_state.profile['full_name']}**")
 
-            # VALIDACIÓN DE TARIFA
-            if target_user_id:
-                try:
-                    profile_info = supabase.table("profiles").select("role_id").eq("id", target_user_id).single().execute()
-                    role_id = profile_info.data['role_id']
-                    rate_q = supabase.table("project_rates").select("rate").eq("project_id", p_id).eq("role_id", role_id).execute()
-                    
-                    current_rate_val = float(rate_q.data[0]['rate']) if rate_q.data else 0.0
-                    if current_rate_val <= 0:
-                        if st.session_state.is_admin:
-                            st.warning(f" **Atención**: No se han definido tarifas para el rol en este proyecto.")
-                    else:
-                        if st.session_state.is_admin:
-                            st.success(f"Tarifa detectada: **{current_rate_val} {moneda}/h**")
-                    can_register = True
-                except:
-                    pass
+    if cliente_sel == "---":
+        st.markdown("---")
+        mostrar_historial_tiempos()
+        return
 
-            # Valor por defecto para descripción y facturabilidad
-            def_desc = st.session_state.get('active_timer_description', '')
-            def_fact = st.session_state.get('active_timer_billable', True)
+    proyectos = memo_sesion(('proyectos', client_map[cliente_sel]), ('projects', 'clients'),
+                            lambda: [p for p in get_proyectos_cached() if p['client_id'] == client_map[cliente_sel]])
+    if not proyectos:
+        st.warning(f"Sin proyectos para {cliente_sel}.")
+        st.markdown("---")
+        mostrar_historial_tiempos()
+        return
 
-            descripcion = st.text_area("Detalle del trabajo", value=def_desc, placeholder="¿Qué hiciste?", key=f"desc_{st.session_state.form_key_suffix}")
-            es_facturable = st.checkbox("Es facturable?", value=def_fact, key=f"fact_{st.session_state.form_key_suffix}")
-            form_valido = len(descripcion.strip()) > 3
-            if not form_valido:
-                st.warning(" ⚠️ Ingrese el **Detalle del trabajo** para habilitar el registro.")
+    proj_map = {p['name']: p['id'] for p in proyectos}
+    proj_currency = {p['id']: p['currency'] for p in proyectos}
+
+    index_proj = 0
+    if 'active_project_name' in st.session_state and st.session_state.active_project_name in proj_map:
+        index_proj = list(proj_map.keys()).index(st.session_state.active_project_name)
+
+    proyecto_sel = st.selectbox("Seleccionar Proyecto", list(proj_map.keys()), index=index_proj, key=f"pro_{st.session_state.form_key_suffix}")
+    p_id = proj_map[proyecto_sel]
+    moneda = proj_currency[p_id]
+
+    st.info(f"Proyecto: **{proyecto_sel}** | Moneda: **{moneda}**")
+
+    timer_is_for_current_proj = (st.session_state.active_timer_id and st.session_state.get('active_project_id') == p_id)
+    timer_en_curso = st.session_state.timer_running and timer_is_for_current_proj
+    timer_pausado = not timer_en_curso and st.session_state.total_elapsed > 0
+
+    # 2. FORMULARIO DE REGISTRO: los datos se confirman en bloque al pulsar un botón,
+    # así escribir el detalle no re-ejecuta la página en cada cambio
+    with st.form(f"registro_{st.session_state.form_key_suffix}"):
+        col_u1, col_u2 = st.columns(2)
+        with col_u1:
+            fecha_sel = st.date_input("Fecha", value=get_lima_now(), max_value=get_lima_now(), key=f"fec_{st.session_state.form_key_suffix}")
+        with col_u2:
+            if st.session_state.is_admin:
+                user_map = memo_sesion(('perfiles_activos',), ('profiles',),
+                                       lambda: {u['full_name']: u['id'] for u in get_perfiles_cached() if u['is_active']})
+                usuario_para = st.selectbox("Registrar para", list(user_map.keys()), index=list(user_map.values()).index(st.session_state.user.id) if st.session_state.user.id in user_map.values() else 0, key=f"user_sel_{st.session_state.form_key_suffix}")
+                target_user_id = user_map[usuario_para]
+            else:
+                target_user_id = st.session_state.user.id
+            st.write(f"Usuario: **{st.session_state.profile['full_name']}**")
 
-            # Nota Interna (Opcional)
-            nota_interna = st.text_input("Nota Interna / Flag (Opcional, solo admins)", key=f"note_{st.session_state.form_key_suffix}")
+        # Valor por defecto para descripción y facturabilidad
+        def_desc = st.session_state.get('active_timer_description', '')
+        def_fact = st.session_state.get('active_timer_billable', True)
 
-    st.markdown("---")
-    
-    # 2. SECCIÓN DE REGISTRO (Solo si hay proyecto)
-    if listo_para_registro:
+        descripcion = st.text_area("Detalle del trabajo", value=def_desc, placeholder="¿Qué hiciste?", key=f"desc_{st.session_state.form_key_suffix}")
+        es_facturable = st.checkbox("Es facturable?", value=def_fact, key=f"fact_{st.session_state.form_key_suffix}")
+
+        # Nota Interna (Opcional)
+        nota_interna = st.text_input("Nota Interna / Flag (Opcional, solo admins)", key=f"note_{st.session_state.form_key_suffix}")
+
+        st.markdown("---")
         col1, col2 = st.columns(2)
         with col1:
             st.subheader(" Ingreso Manual")
             t_inicio_str = st.text_input("Hora Inicio (HH:mm)", value="08:00", key=f"hi_{st.session_state.form_key_suffix}")
             t_fin_str = st.text_input("Hora Final (HH:mm)", value="", placeholder="Vacío = Hora Actual (Solo Hoy)", key=f"hf_{st.session_state.form_key_suffix}")
-            
-            if st.button("Registrar Manualmente", disabled=not (can_register and form_valido), use_container_width=True):
-                try:
-                    is_today = fecha_sel == get_lima_now().date()
-                    tz_local = timezone(timedelta(hours=-5))
-
-                    t1_dt = datetime.strptime(t_inicio_str, "%H:%M")
-                    t1 = datetime.combine(fecha_sel, t1_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
-                    
-                    if not t_fin_str:
-                        if is_today:
-                             t2 = get_lima_now() # Ya tiene timezone utc diff correcto si usa .now(timezone.utc) o similar, pero get_lima_now tiene -5
-                             # get_lima_now returns now in Lima (-5). We need to ensure t1 is compared correctly.
-                             # t1 is converted to UTC. get_lima_now is Lima time.
-                             # Let's convert get_lima_now to UTC for storage
-                             t2 = t2.astimezone(timezone.utc)
-                        else:
-                            st.error("Debe especificar Hora Final para fechas pasadas.")
-                            t2 = None # Blocking
-                    else:
-                        t2_dt = datetime.strptime(t_fin_str, "%H:%M")
-                        t2 = datetime.combine(fecha_sel, t2_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
-                    
-                    if t2:
-                        if t2 <= t1:
-                            st.error("La hora final debe ser posterior a la inicial.")
-                        elif check_overlap(target_user_id, t1, t2):
-                            st.error("⚠️ Error: El rango de horas se cruza con un registro existente.")
-                        else:
-                            supabase.table("time_entries").insert({
-                                "profile_id": target_user_id, "project_id": p_id, "description": descripcion,
-                                "start_time": t1.isoformat(), "end_time": t2.isoformat(),
-                                "total_minutes": int((t2 - t1).total_seconds() / 60), "is_billable": es_facturable,
-                                "internal_note": nota_interna
-                            }).execute()
-                            limpiar_estado_timer()
-                            st.session_state.success_msg = f" Guardado con éxito ({t_inicio_str} a {t2.astimezone(tz_local).strftime('%H:%M')})."
-                            st.rerun()
-                except ValueError:
-                    st.error("Formato invlido. Use HH:mm (ej: 08:33)")
-                except Exception as e:
-                    st.error(f" Error: {str(e)}")
+            registrar_manual = st.form_submit_button("Registrar Manualmente", use_container_width=True)
 
+        is_today = fecha_sel == get_lima_now().date()
         with col2:
             st.subheader(" Cronómetro")
-            is_today = fecha_sel == get_lima_now().date()
+            pausar = finalizar = continuar = iniciar = False
             if not is_today and not st.session_state.timer_running:
-                 st.info("⚠️ El cronómetro solo está disponible para registros del día de hoy.")
+                st.info("⚠️ El cronómetro solo está disponible para registros del día de hoy.")
+            elif timer_en_curso:
+                now_lima = get_lima_now().replace(tzinfo=None)
+                mostrar_cronometro_en_vivo(st.session_state.total_elapsed + (now_lima - st.session_state.timer_start).total_seconds())
+                c_t1, c_t2 = st.columns(2)
+                with c_t1:
+                    pausar = st.form_submit_button(" || Pausar", use_container_width=True)
+                with c_t2:
+                    finalizar = st.form_submit_button(" Fin", use_container_width=True, type="primary")
+            elif timer_pausado:
+                hrs, rem = divmod(int(st.session_state.total_elapsed), 3600)
+                mins, secs = divmod(rem, 60)
+                st.metric("Pausado", f"{hrs:02d}:{mins:02d}:{secs:02d}")
+                continuar = st.form_submit_button(" Continuar")
             else:
-                timer_is_for_current_proj = (st.session_state.active_timer_id and st.session_state.get('active_project_id') == p_id)
+                iniciar = st.form_submit_button(" Iniciar Cronómetro")
+
+    # VALIDACIÓN DE TARIFA (memo por usuario y proyecto)
+    def tarifa_registro():
+        perfil = next((u for u in get_perfiles_cached() if u['id'] == target_user_id), None)
+        if perfil is None:
+            return None
+        rate_match = [r for r in get_tarifas_cached() if r['project_id'] == p_id and r['role_id'] == perfil['role_id']]
+        return float(rate_match[0]['rate'] or 0) if rate_match else 0.0
+    current_rate_val = memo_sesion(('tarifa', target_user_id, p_id), ('profiles', 'project_rates'), tarifa_registro) if target_user_id else None
+    can_register = current_rate_val is not None
+    if can_register and st.session_state.is_admin:
+        if current_rate_val <= 0:
+            st.warning(f" **Atención**: No se han definido tarifas para el rol en este proyecto.")
+        else:
+            st.success(f"Tarifa detectada: **{current_rate_val} {moneda}/h**")
+
+    form_valido = len(descripcion.strip()) > 3
+    if (registrar_manual or finalizar or iniciar) and not form_valido:
+        st.warning(" ⚠️ Ingrese el **Detalle del trabajo** para habilitar el registro.")
+    if (registrar_manual or finalizar or iniciar) and not can_register:
+        st.error("No se pudo determinar el rol del usuario para este registro.")
+    listo = can_register and form_valido
+
+    # Botones sin datos del formulario
+    if timer_en_curso:
+        # Latido al servidor solo cada INTERVALO_LATIDO_S (sin rerun completo)
+        latido_cronometro(st.session_state.active_timer_id)
+        if st.button(" 🔄 Sinc", help="Fuerza la actualización si el tiempo se ve estático"): st.rerun()
+    elif timer_pausado and (is_today or st.session_state.timer_running):
+        if st.button(" Descartar"):
+            try:
+                if st.session_state.active_timer_id:
+                    get_buffer_latidos().olvidar(st.session_state.active_timer_id)
+                    supabase.table("active_timers").delete().eq("id", st.session_state.active_timer_id).execute()
+                limpiar_estado_timer()
+                st.rerun()
+            except Exception as e:
+                st.error(f" Error al descartar: {str(e)}")
 
-                if st.session_state.timer_running and timer_is_for_current_proj:
-                    if st_autorefresh:
-                        count = st_autorefresh(interval=50 * 1000, key="timer_pulse")
-                        try:
-                            now_utc = datetime.now(timezone.utc)
-                            supabase.table("active_timers").update({"updated_at": now_utc.isoformat()}).eq("id", st.session_state.active_timer_id).execute()
-                        except: pass
-                    # -----------------------
+    # 3. ACCIONES DEL FORMULARIO
+    if registrar_manual and listo:
+        try:
+            tz_local = timezone(timedelta(hours=-5))
+
+            t1_dt = datetime.strptime(t_inicio_str, "%H:%M")
+            t1 = datetime.combine(fecha_sel, t1_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
+
+            if not t_fin_str:
+                if is_today:
+                     t2 = get_lima_now() # Ya tiene timezone utc diff correcto si usa .now(timezone.utc) o similar, pero get_lima_now tiene -5
+                     # get_lima_now returns now in Lima (-5). We need to ensure t1 is compared correctly.
+                     # t1 is converted to UTC. get_lima_now is Lima time.
+                     # Let's convert get_lima_now to UTC for storage
+                     t2 = t2.astimezone(timezone.utc)
+                else:
+                    st.error("Debe especificar Hora Final para fechas pasadas.")
+                    t2 = None # Blocking
+            else:
+                t2_dt = datetime.strptime(t_fin_str, "%H:%M")
+                t2 = datetime.combine(fecha_sel, t2_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
+
+            if t2:
+                if t2 <= t1:
+                    st.error("La hora final debe ser posterior a la inicial.")
+                elif check_overlap(target_user_id, t1, t2):
+                    st.error("⚠️ Error: El rango de horas se cruza con un registro existente.")
+                else:
+                    supabase.table("time_entries").insert({
+                        "profile_id": target_user_id, "project_id": p_id, "description": descripcion,
+                        "start_time": t1.isoformat(), "end_time": t2.isoformat(),
+                        "total_minutes": int((t2 - t1).total_seconds() / 60), "is_billable": es_facturable,
+                        "internal_note": nota_interna
+                    }).execute()
+                    invalidar_referencias("time_entries")
+                    limpiar_estado_timer()
+                    st.session_state.success_msg = f" Guardado con éxito ({t_inicio_str} a {t2.astimezone(tz_local).strftime('%H:%M')})."
+                    st.rerun()
+        except ValueError:
+            st.error("Formato invlido. Use HH:mm (ej: 08:33)")
+        except Exception as e:
+            st.error(f" Error: {str(e)}")
 
-                    now_lima = get_lima_now().replace(tzinfo=None)
-                    actual_elapsed = st.session_state.total_elapsed + (now_lima - st.session_state.timer_start).total_seconds()
-                    hrs, rem = divmod(int(actual_elapsed), 3600)
-                    mins, secs = divmod(rem, 60)
-                    st.metric(" EN VIVO", f"{hrs:02d}:{mins:02d}:{secs:02d}")
+    if pausar:
+        try:
+            t_now = get_lima_now().replace(tzinfo=None)
+            new_elapsed = st.session_state.total_elapsed + (t_now - st.session_state.timer_start).total_seconds()
+            st.session_state.total_elapsed = new_elapsed
+            st.session_state.timer_running = False
+            get_buffer_latidos().olvidar(st.session_state.active_timer_id)
+            supabase.table("active_timers").update({
+                "is_running": False, "total_elapsed_seconds": int(new_elapsed),
+                "description": descripcion, "is_billable": es_facturable
+            }).eq("id", st.session_state.active_timer_id).execute()
+            st.rerun()
+        except Exception as e:
+            st.error(f" Error al pausar: {str(e)}")
 
-                    c_t1, c_t2, c_t3 = st.columns(3)
-                    with c_t1:
-                        if st.button(" || Pausar", use_container_width=True):
-                            try:
-                                t_now = get_lima_now().replace(tzinfo=None)
-                                new_elapsed = st.session_state.total_elapsed + (t_now - st.session_state.timer_start).total_seconds()
-                                st.session_state.total_elapsed = new_elapsed
-                                st.session_state.timer_running = False
-                                supabase.table("active_timers").update({
-                                    "is_running": False, "total_elapsed_seconds": int(new_elapsed),
-                                    "description": descripcion, "is_billable": es_facturable
-                                }).eq("id", st.session_state.active_timer_id).execute()
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f" Error al pausar: {str(e)}")
-                    with c_t2:
-                        if st.button(" 🔄 Sinc", use_container_width=True, help="Fuerza la actualización si el tiempo se ve estático"): st.rerun()
-                    with c_t3:
-                        if st.button(" Fin", disabled=not (can_register and form_valido), use_container_width=True, type="primary"):
-                            try:
-                                t_now = get_lima_now().replace(tzinfo=None)
-                                t_sec = st.session_state.total_elapsed + (t_now - st.session_state.timer_start).total_seconds()
-                                t_min = int(t_sec // 60) + (1 if t_sec % 60 > 0 else 0)
-                                tz_local = timezone(timedelta(hours=-5))
-                                t_st_loc = st.session_state.timer_start - timedelta(seconds=st.session_state.total_elapsed)
-                                st_dt = datetime.combine(fecha_sel, t_st_loc.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
-                                end_dt = st_dt + timedelta(minutes=t_min)
-                                
-                                if check_overlap(target_user_id, st_dt, end_dt):
-                                    st.error("⚠️ Error: El rango de horas se cruza con un registro existente.")
-                                else:
-                                    # 1. Intentar GUARDAR el registro
-                                    insert_ok = False
-                                    try:
-                                        payload = {
-                                            "profile_id": target_user_id, "project_id": p_id, "description": descripcion,
-                                            "start_time": st_dt.isoformat(), "end_time": end_dt.isoformat(),
-                                            "total_minutes": t_min, "is_billable": es_facturable
-                                        }
-                                        if nota_interna:
-                                            payload["internal_note"] = nota_interna
-                                        
-                                        supabase.table("time_entries").insert(payload).execute()
-                                        insert_ok = True
-                                    except Exception as e:
-                                        st.error(f" Error al guardar registro: {str(e)}")
-
-                                    # 2. Si guardó, limpiar cronómetro (con fallback)
-                                    if insert_ok:
-                                        if st.session_state.active_timer_id:
-                                            try:
-                                                supabase.table("active_timers").delete().eq("id", st.session_state.active_timer_id).execute()
-                                            except Exception as e_del:
-                                                # Fallback: Intentar al menos detenerlo para que no siga contando
-                                                try:
-                                                    supabase.table("active_timers").update({"is_running": False}).eq("id", st.session_state.active_timer_id).execute()
-                                                except: pass
-                                                st.toast(f"Guardado, pero error limpiando timer: {str(e_del)}", icon="⚠️")
-                                        
-                                        limpiar_estado_timer()
-                                        st.session_state.success_msg = " Cronómetro guardado."
-                                        st.rerun()
-                            except Exception as e:
-                                st.error(f" Error inesperado al finalizar: {str(e)}")
-                else:
-                    if st.session_state.total_elapsed > 0:
-                        hrs, rem = divmod(int(st.session_state.total_elapsed), 3600)
-                        mins, secs = divmod(rem, 60)
-                        st.metric("Pausado", f"{hrs:02d}:{mins:02d}:{secs:02d}")
-                        cp1, cp2 = st.columns(2)
-                        with cp1:
-                            if st.button(" Continuar"):
-                                try:
-                                    st.session_state.timer_start = get_lima_now().replace(tzinfo=None)
-                                    st.session_state.timer_running = True
-                                    supabase.table("active_timers").update({
-                                        "is_running": True, "start_time": st.session_state.timer_start.isoformat(),
-                                        "description": descripcion, "is_billable": es_facturable
-                                    }).eq("id", st.session_state.active_timer_id).execute()
-                                    st.rerun()
-                                except Exception as e:
-                                    st.error(f" Error al continuar: {str(e)}")
-                        with cp2:
-                            if st.button(" Descartar"):
-                                try:
-                                    if st.session_state.active_timer_id:
-                                        supabase.table("active_timers").delete().eq("id", st.session_state.active_timer_id).execute()
-                                    limpiar_estado_timer()
-                                    st.rerun()
-                                except Exception as e:
-                                    st.error(f" Error al descartar: {str(e)}")
-                    else:
-                        if st.button(" Iniciar Cronómetro", disabled=not (can_register and form_valido and is_today)):
-                            if not is_today:
-                                st.error("Solo se permite iniciar cronómetro hoy.")
-                                st.stop()
+    if finalizar and listo:
+        try:
+            t_now = get_lima_now().replace(tzinfo=None)
+            t_sec = st.session_state.total_elapsed + (t_now - st.session_state.timer_start).total_seconds()
+            t_min = int(t_sec // 60) + (1 if t_sec % 60 > 0 else 0)
+            tz_local = timezone(timedelta(hours=-5))
+            t_st_loc = st.session_state.timer_start - timedelta(seconds=st.session_state.total_elapsed)
+            st_dt = datetime.combine(fecha_sel, t_st_loc.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
+            end_dt = st_dt + timedelta(minutes=t_min)
+
+            if check_overlap(target_user_id, st_dt, end_dt):
+                st.error("⚠️ Error: El rango de horas se cruza con un registro existente.")
+            else:
+                # 1. Intentar GUARDAR el registro
+                insert_ok = False
+                try:
+                    payload = {
+                        "profile_id": target_user_id, "project_id": p_id, "description": descripcion,
+                        "start_time": st_dt.isoformat(), "end_time": end_dt.isoformat(),
+                        "total_minutes": t_min, "is_billable": es_facturable
+                    }
+                    if nota_interna:
+                        payload["internal_note"] = nota_interna
+
+                    supabase.table("time_entries").insert(payload).execute()
+                    invalidar_referencias("time_entries")
+                    insert_ok = True
+                except Exception as e:
+                    st.error(f" Error al guardar registro: {str(e)}")
 
+                # 2. Si guardó, limpiar cronómetro (con fallback)
+                if insert_ok:
+                    if st.session_state.active_timer_id:
+                        get_buffer_latidos().olvidar(st.session_state.active_timer_id)
+                        try:
+                            supabase.table("active_timers").delete().eq("id", st.session_state.active_timer_id).execute()
+                        except Exception as e_del:
+                            # Fallback: Intentar al menos detenerlo para que no siga contando
                             try:
-                                st.session_state.timer_start = get_lima_now().replace(tzinfo=None)
-                                st.session_state.timer_running = True
-                                resp = supabase.table("active_timers").insert({
-                                    "user_id": st.session_state.user.id, "project_id": p_id,
-                                    "start_time": st.session_state.timer_start.isoformat(),
-                                    "description": descripcion, "is_billable": es_facturable, "is_running": True
-                                }).execute()
-                                if resp.data:
-                                    st.session_state.active_timer_id = resp.data[0]['id']
-                                    st.session_state.active_project_id = p_id
-                                st.rerun()
-                            except Exception as e:
-                                # Intento de recuperación si falla por duplicado (RLS/Unique violation)
-                                if "violates row-level security" in str(e) or "duplicate key" in str(e) or "42501" in str(e):
-                                    try:
-                                        # Forzar recuperación
-                                        rec_q = supabase.table("active_timers").select("*").eq("user_id", st.session_state.user.id).execute()
-                                        if rec_q and rec_q.data:
-                                            t_rec = rec_q.data[0]
-                                            st.session_state.active_timer_id = t_rec['id']
-                                            st.session_state.timer_running = t_rec['is_running']
-                                            st.session_state.timer_start = pd.to_datetime(t_rec['start_time']).replace(tzinfo=None)
-                                            st.session_state.total_elapsed = t_rec['total_elapsed_seconds']
-                                            st.session_state.active_project_id = t_rec['project_id']
-                                            st.rerun()
-                                    except:
-                                        pass
-                                st.error(f"Error iniciando cronómetro: {str(e)}")
-                                if st.button("🔴 Forzar Reinicio de Estado"):
-                                    limpiar_estado_timer()
-                                    st.rerun()
+                                supabase.table("active_timers").update({"is_running": False}).eq("id", st.session_state.active_timer_id).execute()
+                            except: pass
+                            st.toast(f"Guardado, pero error limpiando timer: {str(e_del)}", icon="⚠️")
+
+                    limpiar_estado_timer()
+                    st.session_state.success_msg = " Cronómetro guardado."
+                    st.rerun()
+        except Exception as e:
+            st.error(f" Error inesperado al finalizar: {str(e)}")
+
+    if continuar:
+        try:
+            st.session_state.timer_start = get_lima_now().replace(tzinfo=None)
+            st.session_state.timer_running = True
+            supabase.table("active_timers").update({
+                "is_running": True, "start_time": st.session_state.timer_start.isoformat(),
+                "description": descripcion, "is_billable": es_facturable
+            }).eq("id", st.session_state.active_timer_id).execute()
+            st.rerun()
+        except Exception as e:
+            st.error(f" Error al continuar: {str(e)}")
+
+    if iniciar and listo:
+        if not is_today:
+            st.error("Solo se permite iniciar cronómetro hoy.")
+            st.stop()
+
+        try:
+            st.session_state.timer_start = get_lima_now().replace(tzinfo=None)
+            st.session_state.timer_running = True
+            resp = supabase.table("active_timers").insert({
+                "user_id": st.session_state.user.id, "project_id": p_id,
+                "start_time": st.session_state.timer_start.isoformat(),
+                "description": descripcion, "is_billable": es_facturable, "is_running": True
+            }).execute()
+            if resp.data:
+                st.session_state.active_timer_id = resp.data[0]['id']
+                st.session_state.active_project_id = p_id
+            st.rerun()
+        except Exception as e:
+            # Intento de recuperación si falla por duplicado (RLS/Unique violation)
+            if "violates row-level security" in str(e) or "duplicate key" in str(e) or "42501" in str(e):
+                try:
+                    # Forzar recuperación
+                    rec_q = supabase.table("active_timers").select("*").eq("user_id", st.session_state.user.id).execute()
+                    if rec_q and rec_q.data:
+                        t_rec = rec_q.data[0]
+                        st.session_state.active_timer_id = t_rec['id']
+                        st.session_state.timer_running = t_rec['is_running']
+                        st.session_state.timer_start = pd.to_datetime(t_rec['start_time']).replace(tzinfo=None)
+                        st.session_state.total_elapsed = t_rec['total_elapsed_seconds']
+                        st.session_state.active_project_id = t_rec['project_id']
+                        st.rerun()
+                except:
+                    pass
+            st.error(f"Error iniciando cronómetro: {str(e)}")
+            if st.button("🔴 Forzar Reinicio de Estado"):
+                limpiar_estado_timer()
+                st.rerun()
 
     # 4. TABLA DE HISTORIAL (Siempre visible al final)
     st.markdown("---")
@@ -627,30 +1910,17 @@ def limpiar_estado_timer():
     st.session_state.active_timer_description = ''
     st.session_state.active_timer_billable = True
 
+@perfilado("Historial")
 def mostrar_historial_tiempos():
     st.subheader(" Historial de Horas")
-    query = supabase.table("time_entries").select("*, profiles(full_name, role_id, roles(name)), projects(name, currency, clients(name))").order("start_time", desc=True)
+    filtros = {}
     if not st.session_state.is_admin:
-        # Convertir a UTC y remover timezone para evitar errores de Supabase
-        limite_30_dias_dt = get_lima_now() - timedelta(days=30)
-        limite_30_dias = limite_30_dias_dt.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
-        query = query.eq("profile_id", st.session_state.user.id).gte("start_time", limite_30_dias)
+        # Usuarios: solo sus registros de los últimos 30 días
+        filtros = {'profile_ids': [st.session_state.user.id], 'desde': (get_lima_now() - timedelta(days=30)).date()}
     
-    entries_resp = query.execute()
-    if entries_resp.data:
-        df = pd.json_normalize(entries_resp.data)
-        def to_local(s):
-            if pd.isna(s) or not s: return None
-            try: return pd.to_datetime(s, utc=True).tz_convert('America/Lima').tz_localize(None)
-            except: return pd.to_datetime(s).replace(tzinfo=None) - pd.Timedelta(hours=5)
-
-        df['dt_ref'] = df['start_time'].fillna(df['created_at'])
-        df['dt_st'] = df['dt_ref'].apply(to_local)
-        df['dt_en'] = df['end_time'].apply(to_local)
-        df['Inicio'] = df['dt_st'].dt.strftime('%H:%M').fillna('---')
-        df['Fin'] = df['dt_en'].dt.strftime('%H:%M').fillna('---')
-        df['Fecha'] = df['dt_st'].dt.strftime('%d.%m-%Y').fillna('---')
-        df['Tiempo'] = df['total_minutes'].apply(lambda x: f"{int(x)//60:02d}:{int(x)%60:02d}")
+    df = entradas_locales(filtros)
+    if not df.empty:
+        df = enriquecer_entradas(unir_referencias(df))
         df['Cliente'] = df['projects.clients.name'].fillna('...')
         df['Proyecto'] = df['projects.name'].fillna('...')
         df['Moneda'] = df['projects.currency'].fillna('')
@@ -665,22 +1935,15 @@ def mostrar_historial_tiempos():
             df['Nota'] = ''
         
         if st.session_state.is_admin:
-            rates_resp = supabase.table("project_rates").select("*").execute()
-            rates_df = pd.DataFrame(rates_resp.data)
-            def calc_metrics(row):
-                rate = 0.0
-                if not rates_df.empty:
-                    r = rates_df[(rates_df['project_id'] == row['project_id']) & (rates_df['role_id'] == row['profiles.role_id'])]
-                    rate = float(r['rate'].iloc[0]) if not r.empty else 0.0
-                total = (row['total_minutes'] / 60) * rate
-                return pd.Series([rate, total, total if row['is_billable'] else 0.0])
-            df[['Costo Hora', 'Total Bruto', 'Monto Facturable']] = df.apply(calc_metrics, axis=1)
+            rates_df = pd.DataFrame(get_tarifas_cached())
+            df[['Costo Hora', 'Total Bruto', 'Monto Facturable']] = resolver_tarifas(df, rates_df).to_numpy()
             
-            display_cols = ['Fecha', 'Usuario', 'Cliente', 'Proyecto', 'Moneda', 'description', 'Nota', 'Inicio', 'Fin', 'Tiempo', 'Costo Hora', 'is_billable', 'Total Bruto', 'Monto Facturable', 'is_paid', 'invoice_number']
+            display_cols = ['id', 'Fecha', 'Usuario', 'Cliente', 'Proyecto', 'Moneda', 'description', 'Nota', 'Inicio', 'Fin', 'Tiempo', 'Costo Hora', 'is_billable', 'Total Bruto', 'Monto Facturable', 'is_paid', 'invoice_number']
             final_df = df[display_cols].rename(columns={'description': 'Detalle', 'is_billable': '¿Fact?', 'is_paid': 'Cobrado?'})
             
             edited_df = st.data_editor(final_df, use_container_width=True, hide_index=True,
                 column_config={
+                    "id": None,
                     "¿Fact?": st.column_config.CheckboxColumn(label="Fact?"),
                     "Costo Hora": st.column_config.NumberColumn(format="%.2f"),
                     "Total Bruto": st.column_config.NumberColumn(format="%.2f"),
@@ -690,14 +1953,9 @@ def mostrar_historial_tiempos():
                 disabled=['Fecha', 'Usuario', 'Cliente', 'Proyecto', 'Moneda', 'Detalle', 'Inicio', 'Fin', 'Tiempo', 'Costo Hora', 'Total Bruto', '¿Fact?', 'Monto Facturable'])
             
             if st.button("Guardar Cambios Historial"):
-                for idx, row in edited_df.iterrows():
-                    orig = df.iloc[idx]
-                    if row['Cobrado?'] != orig['is_paid'] or row['invoice_number'] != orig['invoice_number'] or row['Nota'] != orig['internal_note']:
-                        supabase.table("time_entries").update({
-                            "is_paid": row['Cobrado?'], 
-                            "invoice_number": row['invoice_number'],
-                            "internal_note": row['Nota']
-                        }).eq("id", orig['id']).execute()
+                cambios = conjunto_cambios(final_df, edited_df, ['Cobrado?', 'invoice_number', 'Nota'])
+                aplicar_cambios("time_entries", cambios, {'Cobrado?': 'is_paid', 'Nota': 'internal_note'})
+                invalidar_referencias("time_entries")
                 st.success("Cambios guardados.")
                 st.rerun()
         else:
@@ -706,42 +1964,510 @@ def mostrar_historial_tiempos():
     else:
         st.info("No hay registros recientes.")
 
-# --- RECUERDO DE SESIÓN ---
-if not st.session_state.user and not st.session_state.get('logout_requested'):
-    # 1. Puerta de hidratación para componentes de almacenamiento
-    if "init_gate" not in st.session_state:
-        st.session_state.init_gate = True
-        with st.spinner("⏳ Conectando..."):
-            time.sleep(1.0)
-            st.rerun()
+# --- PÁGINAS DE ADMINISTRACIÓN (fragmentos) ---
+# Los filtros, editores y botones de estas páginas solo vuelven a ejecutar su fragmento;
+# la barra lateral, el recuerdo de sesión y la sincronización de la réplica no se repiten.
+def rerun_fragmento():
+    # scope="fragment" solo vale en un rerun del propio fragmento; si vino con toda la app, se repite toda
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def en_rerun_de_fragmento():
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
 
-    # 2. Intentar recuperar de Cookie de sesión
-    u_id = cookie_manager.get('user_id_persist')
+def fragmento_medido(nombre):
+    """``st.fragment`` cuyos reruns propios también pasan por el perfilador y el registro de consultas.
+
+    En una ejecución completa lo mide el script como parte de la página. En un rerun
+    solo del fragmento no corre el inicio ni el cierre del script, así que el fragmento
+    abre y cierra su propia medición; como no puede escribir en la barra lateral, los
+    paneles se muestran al pie del fragmento.
+    """
+    def decorador(func):
+        @functools.wraps(func)
+        def cuerpo(*args, **kwargs):
+            if not en_rerun_de_fragmento():
+                return func(*args, **kwargs)
+            iniciar_registro_consultas(registro_consultas_solicitado())
+            iniciar_perfil(perfil_solicitado())
+            try:
+                with seccion(nombre):
+                    func(*args, **kwargs)
+            except BaseException:
+                # st.rerun() y errores: no hay nada que mostrar de este rerun
+                iniciar_registro_consultas(False)
+                cerrar_perfil()
+                raise
+            cerrar_medicion(st, fragmento=nombre)
+        return st.fragment(cuerpo)
+    return decorador
+
+@fragmento_medido("Panel General")
+def mostrar_panel_general():
+    st.header(" Panel General de Horas")
     
-    if u_id:
-        try:
-            profile_res = supabase.table("profiles").select("*, roles(name)").eq("id", u_id).single().execute()
-            if profile_res and profile_res.data and profile_res.data.get('is_active'):
-                st.session_state.user = SimpleNamespace(id=u_id)
-                st.session_state.profile = profile_res.data
-                st.session_state.is_admin = profile_res.data.get('is_admin', False) or (profile_res.data.get('account_type') == "Administrador")
-                # Limpiar estado de timer al restaurar sesión
-                limpiar_estado_timer()
+    # Filtros (sobre la réplica local de time_entries)
+    perfiles_f = get_perfiles_cached()
+    clientes_f = get_clientes_cached()
+    clientes_f = clientes_f.data if clientes_f and clientes_f.data else []
+    col_f0, col_f1, col_f2 = st.columns(3)
+    with col_f0:
+        f_rango = st.date_input("Rango de Fechas", [get_lima_now().date() - timedelta(days=30), get_lima_now().date()], key="pg_rango")
+    with col_f1:
+        f_user = st.multiselect("Filtrar por Usuario", [u['full_name'] for u in perfiles_f])
+    with col_f2:
+        f_client = st.multiselect("Filtrar por Cliente", [c['name'] for c in clientes_f])
+    
+    filtros = {
+        'desde': f_rango[0] if len(f_rango) > 0 else None,
+        'hasta': f_rango[1] if len(f_rango) > 1 else None,
+        'profile_ids': [u['id'] for u in perfiles_f if u['full_name'] in f_user],
+    }
+    if f_client:
+        ids_cli = [c['id'] for c in clientes_f if c['name'] in f_client]
+        filtros['project_ids'] = [p['id'] for p in get_proyectos_cached() if p['client_id'] in ids_cli]
+    
+    # Paginación keyset: pila de cursores, se reinicia al cambiar filtros
+    firma_filtros = repr(filtros)
+    if st.session_state.get('pg_firma') != firma_filtros:
+        st.session_state.pg_firma = firma_filtros
+        st.session_state.pg_cursores = [None]
+    pagina_actual = len(st.session_state.pg_cursores)
+    
+    df, cursor_siguiente = pagina_entradas(filtros, st.session_state.pg_cursores[-1])
+    
+    if not df.empty:
+        rates_df = pd.DataFrame(get_tarifas_cached())
+        
+        # Conversin horaria (America/Lima) y formatos, por columnas
+        df = enriquecer_entradas(df).rename(columns={'Inicio': 'Hora Inicio', 'Fin': 'Hora Final', 'Tiempo': 'Tiempo (hh:mm)'})
+        
+        montos = resolver_tarifas(df, rates_df)
+        df['Costo Hora'] = montos['tarifa']
+        df['Valor Total'] = montos['bruto']
+        df['Costo Facturable'] = montos['facturable']
+        
+        # Renombrar para visualizacin
+        df = df.rename(columns={
+            'profiles.full_name': 'Usuario',
+            'profiles.roles.name': 'Rol',
+            'projects.clients.name': 'Cliente',
+            'projects.name': 'Proyecto',
+            'is_billable': 'Facturable'
+        })
+        
+        filtered_df = df.copy()
+        
+        # Columnas finales (Admin ve todo y puede editar)
+        display_cols = ['id', 'Fecha', 'Usuario', 'Rol', 'Cliente', 'Proyecto', 'Hora Inicio', 'Hora Final', 'Tiempo (hh:mm)', 'Costo Hora', 'Valor Total', 'Costo Facturable', 'Facturable']
+        
+        # FORZAR REDONDEO FSICO EN EL DF PARA EVITAR DECIMALES LARGOS
+        filtered_df['Costo Hora'] = filtered_df['Costo Hora'].fillna(0).round(2)
+        filtered_df['Valor Total'] = filtered_df['Valor Total'].fillna(0).round(2)
+        filtered_df['Costo Facturable'] = filtered_df['Costo Facturable'].fillna(0).round(2)
+
+        # Configuracin de columnas para alineacin y formato
+        col_config = {
+            "id": None, # Habilitar ocultamiento real sin error
+            "Costo Hora": st.column_config.NumberColumn(format="%.2f"),
+            "Valor Total": st.column_config.NumberColumn(format="%.2f"),
+            "Costo Facturable": st.column_config.NumberColumn(format="%.2f"),
+            "Facturable": st.column_config.CheckboxColumn(label="")
+        }
+        
+        with seccion("data_editor"):
+            edited_gen = st.data_editor(
+                filtered_df[display_cols], 
+                column_config=col_config,
+                use_container_width=True, hide_index=True,
+                disabled=['Rol', 'Cliente', 'Proyecto', 'Tiempo (hh:mm)', 'Costo Hora', 'Valor Total', 'Costo Facturable'] # Solo lo bsico y Facturable es editable
+            )
+        
+        # El desmarcado de "Facturable" se refleja en el editor. Recalcular mtricas dinmicas para visualizacin rpida:
+        billable_total_live = edited_gen[edited_gen['Facturable'] == True]['Costo Facturable'].sum()
+        st.info(f" **Total Facturable Proyectado (en esta página): {billable_total_live:,.2f}**")
+        
+        col_btn1, col_btn2 = st.columns([1, 1])
+        with col_btn1:
+            if st.button("Guardar cambios en Panel General"):
+                cambios = conjunto_cambios(filtered_df[display_cols], edited_gen, ['Facturable', 'Fecha'])
+                dt_ref_por_id = df.set_index('id')['dt_ref']
+                for orig_id, campos in cambios.items():
+                    if 'Fecha' in campos:
+                        nueva_fecha = campos.pop('Fecha')
+                        try:
+                            # Intentar parsear fecha editada, manteniendo la hora original
+                            new_d = datetime.strptime(nueva_fecha, '%d.%m-%Y')
+                            old_dt = pd.to_datetime(dt_ref_por_id[orig_id])
+                            campos['start_time'] = old_dt.replace(year=new_d.year, month=new_d.month, day=new_d.day).isoformat()
+                        except: pass
+                aplicar_cambios("time_entries", {k: v for k, v in cambios.items() if v}, {'Facturable': 'is_billable'})
+                invalidar_referencias("time_entries")
+                st.success(" Cambios administrativos guardados.")
                 st.rerun()
-        except:
-            pass
 
-# Eliminar inicialización duplicada
-# cookie_manager = xtc.CookieManager()
+        with col_btn2:
+            if HAS_OPENPYXL:
+                st.download_button(
+                    label="Descargar Reporte Excel ",
+                    data=functools.partial(xlsx_hoja, filtered_df[display_cols], 'Historial'),
+                    file_name=f"historial_horas_{get_lima_now().strftime('%Y%m%d')}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    on_click="ignore"
+                )
+            else:
+                st.empty() # No mostrar error si no hay librera
+        
+        # Navegación entre páginas
+        col_pg1, col_pg2, col_pg3 = st.columns([1, 2, 1])
+        with col_pg1:
+            if st.button("◀ Anterior", disabled=pagina_actual == 1):
+                st.session_state.pg_cursores.pop()
+                rerun_fragmento()
+        with col_pg2:
+            st.caption(f"Página {pagina_actual} ({len(filtered_df)} registros, {TAM_PAGINA} por página)")
+        with col_pg3:
+            if st.button("Siguiente ▶", disabled=cursor_siguiente is None):
+                st.session_state.pg_cursores.append(cursor_siguiente)
+                rerun_fragmento()
+        
+        # Calcular inversin por moneda (sobre todo el conjunto filtrado)
+        st.subheader("Inversin Total por Divisa")
+        n_total, resumen_monedas = totales_entradas(filtros)
+        st.caption(f"{n_total} registros en el rango y filtros seleccionados.")
+        if not resumen_monedas.empty:
+            metrics_cols = st.columns(len(resumen_monedas))
+            for i, (_, fila) in enumerate(resumen_monedas.iterrows()):
+                with metrics_cols[i]:
+                    st.metric(f"Total {fila['Moneda']}", f"{fila['Moneda']} {fila['Valor Total']:,.2f}")
+        
+        st.markdown("---")
+        st.subheader(" Descarga Global de Datos")
+        formatos_export = {"Excel (.xlsx)": "xlsx", "CSV comprimido (.csv.gz)": "csv.gz"} if HAS_OPENPYXL else {"CSV comprimido (.csv.gz)": "csv.gz"}
+        formato_sel = formatos_export[st.radio("Formato", list(formatos_export.keys()), horizontal=True, key="export_formato")]
+        if st.button("Descargar Base de Datos Completa"):
+            try:
+                # Se genera en un archivo temporal; reemplaza al de una descarga anterior
+                purgar_exportaciones()
+                previo = st.session_state.pop('export_global', None)
+                if previo and os.path.exists(previo['ruta']):
+                    os.remove(previo['ruta'])
+                total = supabase.table("time_entries").select("id", count="exact", head=True).execute().count or 0
+                os.makedirs(DIR_EXPORTACIONES, exist_ok=True)
+                with tempfile.NamedTemporaryFile(suffix=f".{formato_sel}", dir=DIR_EXPORTACIONES, delete=False) as tmp:
+                    ruta = tmp.name
+                barra = st.progress(0.0, text=f"Exportando {total} registros...")
+                escritas = exportar_base_completa(ruta, formato_sel, progreso=barra, total=total)
+                barra.empty()
+                if escritas:
+                    st.session_state.export_global = {
+                        'ruta': ruta, 'formato': formato_sel, 'filas': escritas,
+                        'nombre': f"FULL_DB_{get_lima_now().strftime('%Y%m%d_%H%M')}.{formato_sel}"
+                    }
+                else:
+                    os.remove(ruta)
+                    st.warning("La base de datos est vaca.")
+            except Exception as e:
+                st.error(f"Error en descarga global: {e}")
+        
+        export_global = st.session_state.get('export_global')
+        if export_global and os.path.exists(export_global['ruta']):
+            st.download_button(
+                label=f"Confirmar Descarga Global ({export_global['filas']} registros)",
+                data=functools.partial(leer_exportacion, export_global['ruta']),
+                file_name=export_global['nombre'],
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet" if export_global['formato'] == 'xlsx' else "application/gzip",
+                on_click="ignore"
+            )
+        elif export_global:
+            # Ya se purgó por vencida: hay que volver a generarla
+            del st.session_state['export_global']
+
+    else:
+        st.info("No hay registros de tiempo para los filtros seleccionados.")
+
+@fragmento_medido("Liquidación")
+def mostrar_liquidacion(cli_data, cli_name_sel, start_d, end_d):
+    proyectos_rep = liquidacion_proyectos(cli_data['id'], start_d, end_d)
+
+    if not proyectos_rep.empty:
+        # SELECTOR DE PROYECTOS (Nuevo)
+        st.markdown("###  Selección de Proyectos a Liquidar")
+        proyectos_disponibles = proyectos_rep['proyecto'].unique().tolist()
+        proyectos_seleccionados = st.multiselect(
+            "Seleccione los proyectos que desea incluir en esta liquidación:",
+            options=proyectos_disponibles,
+            default=proyectos_disponibles  # Por defecto todos seleccionados
+        )
+        
+        if proyectos_seleccionados:
+            # Agregados en el almacén analítico, solo de los proyectos seleccionados
+            sum_df = liquidacion_por_consultor(cli_data['id'], start_d, end_d, proyectos_seleccionados)
+        
+            tab1, tab2, tab3 = st.tabs([" Carta de Liquidación", " Anexo Detallado", " Dashboard"])
+        
+            with tab1, seccion("Carta de Liquidación"):
+                monedas_sel = proyectos_rep[proyectos_rep['proyecto'].isin(proyectos_seleccionados)]['moneda']
+                monedas_disp = [m for m in monedas_sel.unique() if pd.notna(m) and str(m) != 'nan']
+                if not monedas_disp:
+                    st.warning("No hay monedas vlidas.")
+                else:
+                    moneda_liq = st.selectbox("Moneda para Carta", monedas_disp)
+                    total_general_liq = sum_df.loc[sum_df['projects.currency'] == moneda_liq, 'Total_Monto'].sum()
+                    
+                    # Datos Pre-llenados
+                    doi_str = str(cli_data.get('doi_number', '')).strip()
+                    if doi_str == 'nan' or not doi_str: doi_str = '---'
+                    addr_str = str(cli_data.get('address', '')).strip()
+                    if addr_str == 'nan' or not addr_str: addr_str = 'Lima, Per.'
+                    try:
+                        firma_def = st.session_state.profile['full_name']
+                    except: firma_def = "Responsable"
+                    
+                    # ===== CONTROL DE LIQUIDACIN =====
+                    st.markdown("---")
+                    st.markdown("###  Control de Liquidación")
+                    
+                    # Verificar liquidación existente
+                    existing_liq = supabase.table("liquidations").select("*").eq("client_id", cli_data['id']).eq("period_start", start_d.isoformat()).eq("period_end", end_d.isoformat()).eq("currency", moneda_liq).execute()
+                    
+                    liquidation_number = None
+                    liquidation_id = None
+                    liquidation_status = "draft"
+                    
+                    if existing_liq.data:
+                        liq_data = existing_liq.data[0]
+                        liquidation_number = liq_data['liquidation_number']
+                        liquidation_id = liq_data['id']
+                        liquidation_status = liq_data.get('status', 'draft')
+                        st.info(f" Liquidación existente: **{liquidation_number}** | Estado: **{liquidation_status.upper()}**")
+                    else:
+                        st.caption(" No se ha generado número de liquidación. Se generará al guardar.")
+                    
+                    # Campo para notas especiales (descuentos, condiciones, etc.)
+                    st.markdown("#####  Notas Especiales (Opcional)")
+                    st.caption("Agregue aqu descuentos, condiciones especiales o cualquier texto adicional que desee incluir en la carta.")
+                    notas_especiales = st.text_area(
+                        "Notas adicionales para esta liquidación:",
+                        placeholder="Ejemplo: Se aplic un descuento del 10% por volumen de horas.\nO: Monto neto a pagar: USD 5,400.00 (despus de descuento de USD 600.00)",
+                        height=100,
+                        key=f"notas_{cli_name_sel}_{moneda_liq}",
+                        value=existing_liq.data[0].get('special_notes', '') if existing_liq.data else ''
+                    )
+                    
+                    # Construir seccin de notas si existe
+                    seccion_notas = ""
+                    if notas_especiales and notas_especiales.strip():
+                        seccion_notas = f"\n\n{notas_especiales.strip()}"
+                    
+                    # Construir referencia con número
+                    ref_line = "Ref.: Liquidación de Honorarios"
+                    if liquidation_number:
+                        ref_line = f"Ref.: Liquidación de Honorarios N {liquidation_number}"
+                    
+                    # Plantilla de Carta basada en PDF Hoja 1
+                    fecha_carta = get_lima_now().strftime('%d de %B de %Y')
+                    
+                    letter_template = f"""San Isidro, {fecha_carta}
+
+Seor(es):
+{cli_name_sel.upper()}
+Presente.-
+
+Estimado(s) seor(es):
+
+Nos dirigimos a usted(es) con el propsito de saludarlo(s) cordialmente y remitir la {ref_line}, por la suma neta de {moneda_liq} {total_general_liq:,.2f}, ms el Impuesto General a las Ventas.
+
+El detalle de las actividades efectivamente ejecutadas a favor de usted(es) se encuentra consignado en la liquidación de horas que se adjunta a esta comunicación. En tal sentido, agradeceremos se sirvan revisar detenidamente la información anexada.{seccion_notas}
+
+Para el pago de los honorarios y de la respectiva detraccin, srvanse tener en cuenta los siguientes datos:
+
+**Pago Detracciones:** Banco de la Nacin
+Cuenta corriente Soles N 00-005-337240
+
+**Pago Honorarios:** 
+[BANCO] [TIPO CUENTA] 
+N [NUMERO DE CUENTA]
+
+Atentamente,
+
+__________________________
+{firma_def}
+Responsable"""
+                    
+                    st.markdown("##### Editor de Carta")
+                    full_letter_text = st.text_area("Contenido", value=letter_template, height=450)
+                    
+                    # Botones para guardar liquidación
+                    st.markdown("---")
+                    col_save1, col_save2, col_save3 = st.columns([1, 1, 1])
+                    
+                    with col_save1:
+                        if st.button(" Guardar Liquidación", type="primary", help="Guardar liquidación y generará número correlativo"):
+                            try:
+                                # Generar número si no existe
+                                if not liquidation_number:
+                                    result = supabase.rpc('get_next_liquidation_number').execute()
+                                    liquidation_number = result.data
+                                
+                                # Preparar datos
+                                liq_data_to_save = {
+                                    "client_id": cli_data['id'],
+                                    "period_start": start_d.isoformat(),
+                                    "period_end": end_d.isoformat(),
+                                    "currency": moneda_liq,
+                                    "total_amount": float(total_general_liq),
+                                    "special_notes": notas_especiales.strip() if notas_especiales else None,
+                                    "projects": proyectos_seleccionados,
+                                    "status": "draft",
+                                    "generated_by": st.session_state.user.id
+                                }
+                                
+                                if liquidation_id:
+                                    supabase.table("liquidations").update(liq_data_to_save).eq("id", liquidation_id).execute()
+                                    st.success(f" Liquidación {liquidation_number} actualizada")
+                                else:
+                                    liq_data_to_save["liquidation_number"] = liquidation_number
+                                    supabase.table("liquidations").insert(liq_data_to_save).execute()
+                                    st.success(f" Liquidación {liquidation_number} guardada")
+                                
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"Error al guardar: {str(e)}")
+                    
+                    with col_save2:
+                        if liquidation_id and liquidation_status == "draft":
+                            if st.button(" Marcar como Enviada"):
+                                try:
+                                    supabase.table("liquidations").update({"status": "sent", "sent_at": get_lima_now().astimezone(timezone.utc).replace(tzinfo=None).isoformat()}).eq("id", liquidation_id).execute()
+                                    st.success(" Marcada como Enviada")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Error: {str(e)}")
+                    
+                    with col_save3:
+                        if liquidation_id and liquidation_status == "sent":
+                            if st.button(" Marcar como Pagada"):
+                                try:
+                                    supabase.table("liquidations").update({"status": "paid", "paid_at": get_lima_now().astimezone(timezone.utc).replace(tzinfo=None).isoformat()}).eq("id", liquidation_id).execute()
+                                    st.success(" Marcada como Pagada")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Error: {str(e)}")
+                    
+                    st.markdown("---")
+                    c1, c2 = st.columns(2)
+                    with c1:
+                        st.caption("Vista Previa")
+                        st.markdown(f"<div style='background:white; color:black; padding:25px; border:1px solid #ccc; font-family:Times New Roman; white-space: pre-wrap;'>{full_letter_text}</div>", unsafe_allow_html=True)
+                    with c2:
+                        st.caption("Acciones")
+                        if HAS_DOCX:
+                            st.download_button(" Descargar Word (.docx)", data=functools.partial(docx_carta, full_letter_text, firma_def), file_name=f"Carta_{cli_name_sel}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary", on_click="ignore")
+                        else:
+                            st.warning("Instale python-docx.")
+
+            with tab2, seccion("Anexo Detallado"):
+                if 'moneda_liq' in locals() and moneda_liq:
+                    st.subheader(f"Anexo: Detalle ({moneda_liq})")
+                    df_anexo = enriquecer_entradas(liquidacion_detalle(cli_data['id'], start_d, end_d, proyectos_seleccionados, moneda_liq))
+                    full_xls = []
+                    for proj, df_p in df_anexo.groupby('projects.name', sort=False):
+                        st.markdown(f"**Proyecto: {proj}**")
+                        disp = df_p[['Fecha', 'profiles.full_name', 'description', 'Tiempo', 'Total_Monto']].copy()
+                        disp.columns = ['Fecha', 'Consultor', 'Actividad', 'Tiempo', 'Valor']
+                        st.dataframe(disp, column_config={"Valor": st.column_config.NumberColumn(format="%.2f")}, use_container_width=True, hide_index=True)
+                        
+                        clean_p = disp.copy()
+                        clean_p.insert(0, 'Proyecto', proj)
+                        full_xls.append(clean_p)
+                    
+                    st.markdown("---")
+                    if HAS_OPENPYXL and full_xls:
+                        try:
+                            final_xls = pd.concat(full_xls)
+                            st.download_button(f" Descargar Anexo Detallado ({moneda_liq})", data=functools.partial(xlsx_hoja, final_xls, 'Anexo'), on_click="ignore", file_name=f"anexo_{cli_name_sel}_{moneda_liq}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                        except Exception as e:
+                            st.error(f"Error generando Excel: {str(e)}")
+                    elif full_xls:
+                        st.warning(" Requiere 'openpyxl' para descargar el anexo en Excel.")
+                else:
+                    st.info("Seleccione moneda en pestaa Carta.")
+
+            with tab3, seccion("Dashboard"):
+                st.subheader("Dashboard")
+                sum_df['Tiempo'] = sum_df['Horas_num'].apply(lambda h: f"{int(h)}h {int((h*60)%60)}m")
+                st.dataframe(sum_df, column_config={"Total_Monto": st.column_config.NumberColumn(format="%.2f")}, use_container_width=True, hide_index=True)
+        else:
+            st.warning(" Debe seleccionar al menos un proyecto para generará la liquidación.")
+
+    else:
+        st.info("No se encontraron registros para este cliente en el periodo seleccionado.")
+
+
+# --- RECUERDO DE SESIÓN ---
+entrar_seccion("Recuerdo de sesión")
+if not st.session_state.user and not st.session_state.get('logout_requested'):
+    # Inicializar gestor de cookies (CRITICAL PARA IOS). Solo hace falta sin sesión:
+    # con la sesión ya restaurada no se importa ni se dibuja su componente.
+    import extra_streamlit_components as xtc
+    cookie_manager = xtc.CookieManager()
+
+    # Intentar recuperar de Cookie de sesión. El gestor de cookies entrega su valor en
+    # cuanto el navegador lo envía (eso ya provoca un rerun), sin esperas ni reruns forzados.
+    datos_token = leer_token_sesion(cookie_manager.get(COOKIE_SESION)) if cookie_manager.get(COOKIE_SESION) else None
+
+    if datos_token:
+        # Token firmado y vigente: sin consulta a BD
+        st.session_state.user = SimpleNamespace(id=datos_token['uid'])
+        st.session_state.profile = perfil_desde_token(datos_token)
+        st.session_state.is_admin = datos_token['adm']
+        if time.time() - datos_token['iat'] > REVALIDAR_TOKEN_S:
+            st.session_state.sesion_revalidando = True
+            get_revalidador_sesiones().solicitar(datos_token['uid'])
+        # Limpiar estado de timer al restaurar sesión; la app se dibuja en esta misma pasada
+        limpiar_estado_timer()
+    elif cookie_manager.get(COOKIE_ANTIGUA):
+        # Cookie anterior (solo el id, sin firma): no prueba identidad, se borra y se pide login
+        borrar_cookie_antigua()
 
 if not st.session_state.user:
-    st.subheader("Acceso al Sistema")
-    with st.form("login_form"):
-        email = st.text_input("Correo electrónico")
-        password = st.text_input("Contraseña", type="password")
-        if st.form_submit_button("Entrar"):
-            login_user(email, password)
-else:
+    entrar_seccion("Login")
+    acceso = st.empty()
+    with acceso.container():
+        st.subheader("Acceso al Sistema")
+        with st.form("login_form"):
+            email = st.text_input("Correo electrónico")
+            password = st.text_input("Contraseña", type="password")
+            if st.form_submit_button("Entrar"):
+                login_user(email, password)
+    if st.session_state.user:
+        # Login correcto: se retira el formulario y la app sigue en esta misma pasada
+        acceso.empty()
+
+if st.session_state.user and st.session_state.get('sesion_revalidando'):
+    revalidado = get_revalidador_sesiones().resultado(st.session_state.user.id)
+    if revalidado is False:
+        # El perfil se desactivó o eliminó: cierre total como en "Cerrar Sesión"
+        st.session_state.sesion_revalidando = False
+        st.query_params["logout"] = "1"
+        st.session_state.user = None
+        st.session_state.logout_requested = True
+        st.rerun()
+    elif revalidado:
+        st.session_state.sesion_revalidando = False
+        st.session_state.profile = revalidado
+        st.session_state.is_admin = es_admin(revalidado)
+        st.session_state.sesion_por_guardar = "renovar"
+
+if st.session_state.user:
+    entrar_seccion("Menú lateral")
+    if st.session_state.get('sesion_por_guardar'):
+        motivo = st.session_state.pop('sesion_por_guardar')
+        guardar_sesion_en_navegador(st.session_state.profile, st.session_state.is_admin, aviso=motivo == "login")
     with st.sidebar:
         st.write(f" **{st.session_state.profile['full_name']}**")
         st.write(f" Rol: {st.session_state.profile['roles']['name']}")
@@ -756,174 +2482,10 @@ else:
     if st.session_state.is_admin:
         menu = ["Panel General", "Registro de Tiempos", "Clientes", "Proyectos", "Usuarios", "Roles y Tarifas", "Facturación y Reportes", "Carga Masiva"]
         choice = st.sidebar.selectbox("Seleccione Módulo", menu)
+        entrar_seccion(choice)
 
         if choice == "Panel General":
-            st.header(" Panel General de Horas")
-            
-            # Query base (Admin ve todo)
-            entries_q = supabase.table("time_entries").select("*, profiles(full_name, role_id, roles(name)), projects(name, currency, clients(name))").order("start_time", desc=True)
-            entries = entries_q.execute()
-            rates = supabase.table("project_rates").select("*").execute()
-            
-            if entries.data:
-                df = pd.json_normalize(entries.data)
-                rates_df = pd.DataFrame(rates.data)
-                
-                # Conversin horaria manual garantizada (UTC-5)
-                df['dt_ref'] = df['start_time'].fillna(df['created_at'])
-                df['dt_start'] = df['dt_ref'].apply(lambda x: pd.to_datetime(x, utc=True).tz_convert('America/Lima').tz_localize(None) if pd.notna(x) and x != 'nan' else None)
-                df['dt_end'] = df['end_time'].apply(lambda x: pd.to_datetime(x, utc=True).tz_convert('America/Lima').tz_localize(None) if pd.notna(x) and x != 'nan' else None)
-                
-                df['Hora Inicio'] = df['dt_start'].dt.strftime('%H:%M').fillna('---')
-                df['Hora Final'] = df['dt_end'].dt.strftime('%H:%M').fillna('---')
-                df['Tiempo (hh:mm)'] = df['total_minutes'].apply(lambda x: f"{int(x)//60:02d}:{int(x)%60:02d}")
-                df['Fecha'] = df['dt_start'].dt.strftime('%d.%m-%Y').fillna('---')
-                
-                # Respaldo si fall el apply (si resultaron nulos pero no deberan)
-                if not df.empty and df['Hora Inicio'].iloc[0] == '---' and not df['dt_ref'].isnull().all():
-                     df['dt_start'] = (pd.to_datetime(df['dt_ref'], utc=True) - pd.Timedelta(hours=5)).dt.tz_localize(None)
-                     df['dt_end'] = (pd.to_datetime(df['end_time'], utc=True) - pd.Timedelta(hours=5)).dt.tz_localize(None)
-                     df['Hora Inicio'] = df['dt_start'].dt.strftime('%H:%M').fillna('---')
-                     df['Hora Final'] = df['dt_end'].dt.strftime('%H:%M').fillna('---')
-                     df['Fecha'] = df['dt_start'].dt.strftime('%d.%m-%Y').fillna('---')
-                
-                def get_cost(row):
-                    if not rates_df.empty:
-                        r = rates_df[(rates_df['project_id'] == row['project_id']) & (rates_df['role_id'] == row['profiles.role_id'])]
-                        return float(r['rate'].iloc[0]) if not r.empty else 0.0
-                    return 0.0
-
-                df['Costo Hora'] = df.apply(get_cost, axis=1)
-                df['Valor Total'] = (df['total_minutes'] / 60) * df['Costo Hora']
-                df['Costo Facturable'] = df.apply(lambda r: r['Valor Total'] if r['is_billable'] else 0.0, axis=1)
-                
-                # Renombrar para visualizacin
-                df = df.rename(columns={
-                    'profiles.full_name': 'Usuario',
-                    'profiles.roles.name': 'Rol',
-                    'projects.clients.name': 'Cliente',
-                    'projects.name': 'Proyecto',
-                    'is_billable': 'Facturable'
-                })
-                
-                # Filtros
-                col_f1, col_f2 = st.columns(2)
-                with col_f1:
-                    f_user = st.multiselect("Filtrar por Usuario", df['Usuario'].unique())
-                with col_f2:
-                    f_client = st.multiselect("Filtrar por Cliente", df['Cliente'].unique())
-                
-                filtered_df = df.copy()
-                if f_user: filtered_df = filtered_df[filtered_df['Usuario'].isin(f_user)]
-                if f_client: filtered_df = filtered_df[filtered_df['Cliente'].isin(f_client)]
-                
-                # Columnas finales (Admin ve todo y puede editar)
-                display_cols = ['id', 'Fecha', 'Usuario', 'Rol', 'Cliente', 'Proyecto', 'Hora Inicio', 'Hora Final', 'Tiempo (hh:mm)', 'Costo Hora', 'Valor Total', 'Costo Facturable', 'Facturable']
-                
-                # FORZAR REDONDEO FSICO EN EL DF PARA EVITAR DECIMALES LARGOS
-                filtered_df['Costo Hora'] = filtered_df['Costo Hora'].fillna(0).round(2)
-                filtered_df['Valor Total'] = filtered_df['Valor Total'].fillna(0).round(2)
-                filtered_df['Costo Facturable'] = filtered_df['Costo Facturable'].fillna(0).round(2)
-
-                # Configuracin de columnas para alineacin y formato
-                col_config = {
-                    "id": None, # Habilitar ocultamiento real sin error
-                    "Costo Hora": st.column_config.NumberColumn(format="%.2f"),
-                    "Valor Total": st.column_config.NumberColumn(format="%.2f"),
-                    "Costo Facturable": st.column_config.NumberColumn(format="%.2f"),
-                    "Facturable": st.column_config.CheckboxColumn(label="")
-                }
-                
-                edited_gen = st.data_editor(
-                    filtered_df[display_cols], 
-                    column_config=col_config,
-                    use_container_width=True, hide_index=True,
-                    disabled=['Rol', 'Cliente', 'Proyecto', 'Tiempo (hh:mm)', 'Costo Hora', 'Valor Total', 'Costo Facturable'] # Solo lo bsico y Facturable es editable
-                )
-                
-                # El desmarcado de "Facturable" se refleja en el editor. Recalcular mtricas dinmicas para visualizacin rpida:
-                billable_total_live = edited_gen[edited_gen['Facturable'] == True]['Costo Facturable'].sum()
-                st.info(f" **Total Facturable Proyectado (en esta vista): {billable_total_live:,.2f}**")
-                
-                col_btn1, col_btn2 = st.columns([1, 1])
-                with col_btn1:
-                    if st.button("Guardar cambios en Panel General"):
-                        for i, row in edited_gen.iterrows():
-                            # Encontrar la fila original por ID
-                            orig_id = row['id']
-                            orig_row = df[df['id'] == orig_id].iloc[0]
-                            
-                            updates = {}
-                            if row['Facturable'] != orig_row['Facturable']: updates["is_billable"] = row['Facturable']
-                            if row['Fecha'] != orig_row['Fecha']: 
-                                try:
-                                    # Intentar parsear fecha editada
-                                    new_d = datetime.strptime(row['Fecha'], '%d.%m-%Y')
-                                    # Mantener la hora original
-                                    old_dt = pd.to_datetime(orig_row['dt_ref'])
-                                    new_dt = old_dt.replace(year=new_d.year, month=new_d.month, day=new_d.day)
-                                    updates["start_time"] = new_dt.isoformat()
-                                except: pass
-                            
-                            if updates:
-                                supabase.table("time_entries").update(updates).eq("id", orig_id).execute()
-                        st.success(" Cambios administrativos guardados.")
-                        st.rerun()
-
-                with col_btn2:
-                    if HAS_OPENPYXL:
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                            filtered_df[display_cols].to_excel(writer, index=False, sheet_name='Historial')
-                        st.download_button(
-                            label="Descargar Reporte Excel ",
-                            data=output.getvalue(),
-                            file_name=f"historial_horas_{get_lima_now().strftime('%Y%m%d')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
-                    else:
-                        st.empty() # No mostrar error si no hay librera
-                
-                # Calcular inversin por moneda
-                st.subheader("Inversin Total por Divisa")
-                if not filtered_df.empty:
-                    # Agrupar por la moneda del proyecto (que sacamos del join)
-                    if 'projects.currency' in filtered_df:
-                        metrics_cols = st.columns(len(filtered_df['projects.currency'].unique()))
-                        for i, (curr, group) in enumerate(filtered_df.groupby('projects.currency')):
-                            with metrics_cols[i]:
-                                total_curr = group['Valor Total'].sum()
-                                st.metric(f"Total {curr}", f"{curr} {total_curr:,.2f}")
-                    else:
-                        st.metric("Inversin Total", f"${filtered_df['Valor Total'].sum():,.2f}")
-                
-                st.markdown("---")
-                st.subheader(" Descarga Global de Datos")
-                if st.button("Descargar Base de Datos Completa (Excel)"):
-                    if HAS_OPENPYXL:
-                        try:
-                            # Descargar TODO lo que hay en time_entries sin filtros
-                            all_q = supabase.table("time_entries").select("*, profiles(full_name), projects(name, currency, clients(name))").execute()
-                            if all_q.data:
-                                df_all = pd.json_normalize(all_q.data)
-                                output_all = io.BytesIO()
-                                with pd.ExcelWriter(output_all, engine='openpyxl') as writer:
-                                    df_all.to_excel(writer, index=False, sheet_name='BaseCompleta')
-                                st.download_button(
-                                    label="Confirmar Descarga Global",
-                                    data=output_all.getvalue(),
-                                    file_name=f"FULL_DB_{get_lima_now().strftime('%Y%m%d_%H%M')}.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                )
-                            else:
-                                st.warning("La base de datos est vaca.")
-                        except Exception as e:
-                            st.error(f"Error en descarga global: {e}")
-                    else:
-                        st.error("Librera Excel no disponible.")
-
-            else:
-                st.info("No hay registros de tiempo an.")
+            mostrar_panel_general()
 
         elif choice == "Registro de Tiempos":
             mostrar_registro_tiempos()
@@ -948,6 +2510,7 @@ else:
                                 "name": nombre, "doi_type": doi_type, "doi_number": doi_num, 
                                 "address": direccion, "email": email_cli, "contact_number": celular_cli
                             }).execute()
+                            invalidar_referencias("clients")
                             st.success(f" Cliente '{nombre}' creado con xito.")
             
             st.subheader("Clientes Registrados")
@@ -960,19 +2523,17 @@ else:
                     disabled=["id"]
                 )
                 if st.button("Guardar Cambios de Clientes"):
-                    for i, row in edited_clients.iterrows():
-                        orig = clientes_q.data[i]
-                        # Solo actualizar si hubo cambios
-                        diff = {k: v for k, v in row.items() if v != orig.get(k)}
-                        if diff:
-                            supabase.table("clients").update(diff).eq("id", row['id']).execute()
+                    # Solo se envían las celdas que cambiaron
+                    cambios = conjunto_cambios(c_df, edited_clients, ['name', 'doi_type', 'doi_number', 'email', 'contact_number', 'address'])
+                    aplicar_cambios("clients", cambios)
+                    invalidar_referencias("clients")
                     st.success(" Datos de clientes actualizados.")
                     st.rerun()
 
         elif choice == "Proyectos":
             st.header(" Gestin de Proyectos")
-            clientes = supabase.table("clients").select("id, name").order("name").execute()
-            if not clientes.data:
+            clientes = get_clientes_cached()
+            if not clientes or not clientes.data:
                 st.warning("Debe crear un cliente primero.")
             else:
                 client_map = {c['name']: c['id'] for c in clientes.data}
@@ -994,29 +2555,31 @@ else:
                                 supabase.table("projects").insert({
                                     "client_id": client_map[cliente_create], "name": proj_name, "currency": moneda
                                 }).execute()
+                                invalidar_referencias("projects")
                                 st.session_state.proj_success_msg = f" Proyecto '{proj_name}' creado con xito."
                                 st.session_state.proj_key_suffix += 1
                                 st.rerun()
 
                 st.subheader("Proyectos Existentes")
-                proyectos = supabase.table("projects").select("*, clients(name)").order("name").execute()
-                if proyectos.data:
-                    p_df = pd.json_normalize(proyectos.data)
+                proyectos = get_proyectos_cached()
+                if proyectos:
+                    p_df = pd.json_normalize(proyectos)
                     p_df = p_df[['clients.name', 'name', 'currency']]
                     p_df.columns = ['Cliente', 'Proyecto', 'Moneda']
                     st.table(p_df)
                     
                     st.markdown("---")
                     st.subheader(" Editar Moneda de Proyecto")
-                    proj_list = {f"{p['clients']['name']} - {p['name']}": p['id'] for p in proyectos.data}
+                    proj_list = {f"{p['clients']['name']} - {p['name']}": p['id'] for p in proyectos}
                     p_to_edit = st.selectbox("Seleccionar Proyecto para Editar", list(proj_list.keys()))
                     
                     # Buscar moneda actual
-                    curr_p = [p for p in proyectos.data if p['id'] == proj_list[p_to_edit]][0]
+                    curr_p = [p for p in proyectos if p['id'] == proj_list[p_to_edit]][0]
                     new_curr = st.selectbox("Nueva Moneda", ["PEN", "USD"], index=0 if curr_p['currency'] == 'PEN' else 1)
                     
                     if st.button("Actualizar Moneda"):
                         supabase.table("projects").update({"currency": new_curr}).eq("id", proj_list[p_to_edit]).execute()
+                        invalidar_referencias("projects")
                         st.success(f" Moneda de '{p_to_edit}' actualizada a {new_curr}.")
                         st.rerun()
                 else:
@@ -1024,8 +2587,7 @@ else:
 
         elif choice == "Usuarios":
             st.header(" Gestin de Usuarios")
-            roles = supabase.table("roles").select("id, name").order("name").execute()
-            role_map = {r['name']: r['id'] for r in roles.data}
+            role_map = {r['name']: r['id'] for r in get_roles_cached()}
             
             with st.form("form_usuario"):
                 u_email = st.text_input("Email (ser su acceso)")
@@ -1058,6 +2620,7 @@ else:
                                 "is_active": False,
                                 "is_admin": u_is_admin
                             }).execute()
+                            invalidar_referencias("profiles")
                             st.success(f" Usuario '{u_name}' creado con xito.")
                             st.info(" Recuerde activarlo en la tabla de abajo para que pueda iniciar sesin.")
                         except Exception as e:
@@ -1085,15 +2648,10 @@ else:
                 edited_users = st.data_editor(u_df, use_container_width=True, hide_index=True, disabled=["ID", "Interno", "DOI"])
                 
                 if st.button("Guardar Cambios de Usuarios"):
-                    changed_count = 0
-                    for i, row in edited_users.iterrows():
-                        orig = users_resp.data[i]
-                        if row['Activo'] != orig['is_active'] or row['Admin'] != orig['is_admin']:
-                            supabase.table("profiles").update({
-                                "is_active": row['Activo'], "is_admin": row['Admin']
-                            }).eq("id", row['ID']).execute()
-                            changed_count += 1
+                    cambios = conjunto_cambios(u_df, edited_users, ['Activo', 'Admin'], clave='ID')
+                    changed_count = aplicar_cambios("profiles", cambios, {'Activo': 'is_active', 'Admin': 'is_admin'})
                     if changed_count > 0:
+                        invalidar_referencias("profiles")
                         st.session_state.user_success_msg = f" {changed_count} usuarios actualizados."
                         st.rerun()
 
@@ -1104,48 +2662,84 @@ else:
 
         elif choice == "Roles y Tarifas":
             st.header(" Roles y Tarifas por Proyecto")
-            proyectos = supabase.table("projects").select("id, name, clients(name)").execute()
-            if not proyectos.data:
+            proyectos = get_proyectos_cached()
+            roles = get_roles_cached()
+            if not proyectos:
                 st.warning("Debe crear proyectos primero.")
+            elif not roles:
+                st.warning("Debe crear roles primero.")
             else:
-                proj_map = {f"{p['clients']['name']} - {p['name']}": p['id'] for p in proyectos.data}
-                proj_sel = st.selectbox("Seleccionar Proyecto", list(proj_map.keys()))
-                
-                # Suffix para resetear inputs de tarifas al cambiar proyecto
-                if 'rate_key_prefix' not in st.session_state: st.session_state.rate_key_prefix = 0
-                if 'last_proj_sel' not in st.session_state: st.session_state.last_proj_sel = proj_sel
-                
-                if st.session_state.last_proj_sel != proj_sel:
-                    st.session_state.rate_key_prefix += 1
-                    st.session_state.last_proj_sel = proj_sel
-                    st.rerun()
-                
-                roles = supabase.table("roles").select("*").execute()
+                proj_map = {f"{p['clients']['name']} - {p['name']}": p['id'] for p in proyectos}
+                proj_label = {p_id: nombre for nombre, p_id in proj_map.items()}
+                proj_sel = st.multiselect("Seleccionar Proyectos", list(proj_map.keys()), default=list(proj_map.keys())[:1])
                 
-                st.subheader(f"Tarifas para: {proj_sel}")
-                tarifas_nuevas = {}
-                for role in roles.data:
-                    col_r1, col_r2 = st.columns([2, 1])
-                    with col_r1:
-                        st.write(f"Rol: **{role['name']}**")
-                    with col_r2:
-                        # Buscar tarifa actual - Usamos cache local por proyecto para evitar queries repetitivas si es posible, o simplemente select simple
-                        current_rate = supabase.table("project_rates").select("rate").eq("project_id", proj_map[proj_sel]).eq("role_id", role['id']).execute()
-                        initial_val = float(current_rate.data[0]['rate']) if current_rate.data else 0.0
-                        new_rate = st.number_input(f"Tarifa ({role['name']})", value=initial_val, key=f"rate_{proj_map[proj_sel]}_{role['id']}")
-                        tarifas_nuevas[role['id']] = (new_rate, initial_val, bool(current_rate.data))
+                if 'rates_msg' in st.session_state:
+                    st.success(st.session_state.rates_msg)
+                    del st.session_state.rates_msg
                 
-                if st.button("Guardar Todas las Tarifas"):
-                    for r_id, (val, old_val, exists) in tarifas_nuevas.items():
-                        if val != old_val:
-                            if exists:
-                                supabase.table("project_rates").update({"rate": val}).eq("project_id", proj_map[proj_sel]).eq("role_id", r_id).execute()
+                if not proj_sel:
+                    st.info("Seleccione uno o más proyectos para ver sus tarifas.")
+                else:
+                    ids_sel = [proj_map[p] for p in proj_sel]
+                    matriz = matriz_tarifas(ids_sel, roles)
+                    
+                    st.subheader("Matriz de Tarifas (proyecto x rol)")
+                    vista = matriz.copy()
+                    vista.insert(0, 'Proyecto', [proj_label[p_id] for p_id in vista.index])
+                    if 'rate_key_prefix' not in st.session_state: st.session_state.rate_key_prefix = 0
+                    editada = st.data_editor(
+                        vista, use_container_width=True, hide_index=True, disabled=['Proyecto'],
+                        column_config={str(r['id']): st.column_config.NumberColumn(r['name'], min_value=0.0, format="%.2f") for r in roles},
+                        key=f"rates_matrix_{st.session_state.rate_key_prefix}_{'_'.join(map(str, ids_sel))}"
+                    )
+                    
+                    def guardar_tarifas(filas, mensaje):
+                        etiquetas = [f"{proj_label[f['project_id']]} / rol {f['role_id']}" for f in filas]
+                        nuevas, actualizadas, errores = guardar_tarifas_por_clave(filas, etiquetas)
+                        invalidar_referencias("project_rates")
+                        for err in errores:
+                            st.error(err)
+                        if not errores:
+                            st.session_state.rates_msg = mensaje.format(nuevas + actualizadas)
+                            st.session_state.rate_key_prefix += 1
+                            st.rerun()
+                    
+                    if st.button("Guardar Todas las Tarifas"):
+                        editada = editada.set_axis(matriz.index)[matriz.columns]
+                        filas = cambios_matriz(matriz, editada, roles)
+                        if not filas:
+                            st.info("No hay cambios para guardar.")
+                        else:
+                            guardar_tarifas(filas, " {} tarifas guardadas.")
+                    
+                    st.markdown("---")
+                    st.subheader(" Edicin Masiva")
+                    col_c1, col_c2 = st.columns(2)
+                    with col_c1:
+                        st.write("**Copiar tarifas desde otro proyecto**")
+                        origen = st.selectbox("Proyecto origen", list(proj_map.keys()), key="rates_origen")
+                        if st.button("Copiar a proyectos seleccionados"):
+                            base = matriz_tarifas([proj_map[origen]], roles).iloc[0]
+                            destino = matriz.copy()
+                            destino.loc[:, :] = base.to_numpy()
+                            filas = cambios_matriz(matriz, destino, roles)
+                            if not filas:
+                                st.info("Los proyectos seleccionados ya tienen esas tarifas.")
                             else:
-                                supabase.table("project_rates").insert({"project_id": proj_map[proj_sel], "role_id": r_id, "rate": val}).execute()
-                    st.success(f" Tarifas para '{proj_sel}' guardadas.")
-                    st.rerun()
-                    st.success(f" Tarifas para '{proj_sel}' guardadas.")
-                    st.rerun()
+                                guardar_tarifas(filas, f" {{}} tarifas copiadas desde '{origen}'.")
+                    with col_c2:
+                        st.write("**Fijar la tarifa de un rol**")
+                        role_map = {r['name']: r['id'] for r in roles}
+                        rol_masivo = st.selectbox("Rol", list(role_map.keys()), key="rates_rol_masivo")
+                        tarifa_masiva = st.number_input("Nueva tarifa", min_value=0.0, value=0.0, key="rates_valor_masivo")
+                        if st.button("Aplicar a proyectos seleccionados"):
+                            destino = matriz.copy()
+                            destino[str(role_map[rol_masivo])] = tarifa_masiva
+                            filas = cambios_matriz(matriz, destino, roles)
+                            if not filas:
+                                st.info("Los proyectos seleccionados ya tienen esa tarifa.")
+                            else:
+                                guardar_tarifas(filas, f" {{}} tarifas de '{rol_masivo}' actualizadas.")
 
         elif choice == "Carga Masiva":
             st.header(" Carga Masiva de Datos")
@@ -1195,12 +2789,17 @@ else:
                         st.write("Vista previa:", df_upload.head())
                         
                         if st.button("Procesar Carga de Registros"):
-                            # Mapeos
-                            prof_map = {p['full_name']: (p['id'], p['role_id']) for p in supabase.table("profiles").select("id, full_name, role_id").execute().data}
-                            clients_map = {c['name']: c['id'] for c in supabase.table("clients").select("id, name").execute().data}
+                            # Mapeos (una consulta por tabla, resueltos antes de procesar filas)
+                            prof_map = {p['full_name']: (p['id'], p['role_id']) for p in get_perfiles_cached()}
+                            clientes_res = get_clientes_cached()
+                            clients_map = {c['name']: c['id'] for c in (clientes_res.data if clientes_res else [])}
+                            proj_map = {(p['client_id'], p['name']): p['id'] for p in get_proyectos_cached()}
                             
-                            success_count = 0
                             errors = []
+                            candidatos = []
+                            filas_validas = []
+                            etiquetas = []
+                            tz_local = timezone(timedelta(hours=-5))
                             
                             for idx, row in df_upload.iterrows():
                                 try:
@@ -1220,11 +2819,10 @@ else:
                                     
                                     # Buscar proyecto
                                     proyecto = row.get('Proyecto')
-                                    proj_q = supabase.table("projects").select("id").eq("client_id", c_id).eq("name", proyecto).execute()
-                                    if not proj_q.data:
+                                    if (c_id, proyecto) not in proj_map:
                                         errors.append(f"Fila {idx+2}: Proyecto '{proyecto}' no existe para cliente '{cliente}'")
                                         continue
-                                    p_id = proj_q.data[0]['id']
+                                    p_id = proj_map[(c_id, proyecto)]
                                     
                                     # Procesar fecha y horas
                                     fecha_str = row.get('Fecha')
@@ -1241,7 +2839,6 @@ else:
                                     t2_dt = datetime.strptime(hora_final_str, "%H:%M")
                                     
                                     # Crear timestamps UTC-5
-                                    tz_local = timezone(timedelta(hours=-5))
                                     t1 = datetime.combine(fecha_dt, t1_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
                                     t2 = datetime.combine(fecha_dt, t2_dt.time()).replace(tzinfo=tz_local).astimezone(timezone.utc)
                                     
@@ -1252,8 +2849,7 @@ else:
                                     # Calcular minutos
                                     total_min = int((t2 - t1).total_seconds() / 60)
                                     
-                                    # Insertar
-                                    supabase.table("time_entries").insert({
+                                    candidatos.append((f"Fila {idx+2}", u_id, t1, t2, {
                                         "profile_id": u_id,
                                         "project_id": p_id,
                                         "start_time": t1.isoformat(),
@@ -1261,12 +2857,29 @@ else:
                                         "total_minutes": total_min,
                                         "description": row.get('Detalle', 'Carga Masiva'),
                                         "is_billable": True
-                                    }).execute()
-                                    success_count += 1
+                                    }))
                                     
                                 except Exception as e:
                                     errors.append(f"Fila {idx+2}: Error - {str(e)}")
                             
+                            # Validar cruces: un índice por usuario para todo el rango del archivo,
+                            # incluyendo las filas ya aceptadas del propio archivo
+                            if candidatos:
+                                indices = cargar_indices_intervalos({c[1] for c in candidatos}, min(c[2] for c in candidatos), max(c[3] for c in candidatos))
+                                for etiqueta, u_id, t1, t2, payload in candidatos:
+                                    if indices[u_id].se_solapa(t1, t2):
+                                        errors.append(f"{etiqueta}: El rango de horas se cruza con un registro existente")
+                                        continue
+                                    indices[u_id].agregar(t1, t2)
+                                    filas_validas.append(payload)
+                                    etiquetas.append(etiqueta)
+                            
+                            # Inserción por lotes con barra de progreso
+                            barra = st.progress(0.0, text=f"Insertando {len(filas_validas)} registros...")
+                            success_count, errores_insercion = insertar_en_lotes("time_entries", filas_validas, etiquetas, progreso=barra)
+                            invalidar_referencias("time_entries")
+                            errors.extend(errores_insercion)
+                            
                             st.success(f" Procesado. Exitosos: {success_count}. Errores: {len(errors)}")
                             if errors:
                                 with st.expander("Ver Errores"):
@@ -1301,19 +2914,35 @@ else:
                         st.write("Vista previa:", df_clients.head())
                         
                         if st.button("Procesar Carga de Clientes"):
-                            success_count = 0
+                            # Clave natural: RUC si viene informado, si no el nombre (última fila gana)
+                            existentes = supabase.table("clients").select("id, name, doi_number").execute().data
+                            por_ruc = {clave_texto(c['doi_number']): c['id'] for c in existentes if clave_texto(c['doi_number'])}
+                            por_nombre = {clave_texto(c['name']): c['id'] for c in existentes}
+                            
+                            filas = {}
                             for idx, row in df_clients.iterrows():
-                                try:
-                                    supabase.table("clients").insert({
-                                        "name": row.get('Nombre'),
-                                        "doi_type": "RUC",
-                                        "doi_number": str(row.get('RUC')),
-                                        "address": row.get('Direccin', '')
-                                    }).execute()
-                                    success_count += 1
-                                except Exception as e:
-                                    st.error(f"Fila {idx+2}: {str(e)}")
-                            st.success(f" {success_count} clientes cargados")
+                                ruc = str(valor_celda(row.get('RUC'))).strip()
+                                nombre = str(valor_celda(row.get('Nombre'))).strip()
+                                if not nombre:
+                                    st.error(f"Fila {idx+2}: Nombre vacío")
+                                    continue
+                                filas[clave_texto(ruc) or clave_texto(nombre)] = (f"Fila {idx+2}", {
+                                    "name": nombre,
+                                    "doi_type": "RUC",
+                                    "doi_number": ruc,
+                                    "address": valor_celda(row.get('Direccin', ''))
+                                })
+                            
+                            etiquetas = [e for e, _ in filas.values()]
+                            barra = st.progress(0.0, text=f"Procesando {len(filas)} clientes...")
+                            creadas, actualizadas, errores = sincronizar_por_clave(
+                                "clients", [f for _, f in filas.values()], etiquetas,
+                                lambda f: por_ruc.get(clave_texto(f['doi_number'])) or por_nombre.get(clave_texto(f['name'])),
+                                progreso=barra)
+                            invalidar_referencias("clients")
+                            for err in errores:
+                                st.error(err)
+                            st.success(f" {creadas} clientes nuevos, {actualizadas} actualizados")
                     except Exception as e:
                         st.error(f"Error: {e}")
             
@@ -1341,24 +2970,34 @@ else:
                         st.write("Vista previa:", df_projects.head())
                         
                         if st.button("Procesar Carga de Proyectos"):
-                            clients_map = {c['name']: c['id'] for c in supabase.table("clients").select("id, name").execute().data}
-                            success_count = 0
+                            clientes_res = get_clientes_cached()
+                            clients_map = {c['name']: c['id'] for c in (clientes_res.data if clientes_res else [])}
+                            # Clave natural: (cliente, nombre de proyecto)
+                            existentes = {(p['client_id'], clave_texto(p['name'])): p['id'] for p in supabase.table("projects").select("id, client_id, name").execute().data}
+                            
+                            filas = {}
                             for idx, row in df_projects.iterrows():
-                                try:
-                                    cliente = row.get('Cliente')
-                                    if cliente not in clients_map:
-                                        st.error(f"Fila {idx+2}: Cliente '{cliente}' no encontrado")
-                                        continue
-                                    
-                                    supabase.table("projects").insert({
-                                        "client_id": clients_map[cliente],
-                                        "name": row.get('Nombre Proyecto'),
-                                        "currency": row.get('Moneda', 'PEN')
-                                    }).execute()
-                                    success_count += 1
-                                except Exception as e:
-                                    st.error(f"Fila {idx+2}: {str(e)}")
-                            st.success(f" {success_count} proyectos cargados")
+                                cliente = row.get('Cliente')
+                                if cliente not in clients_map:
+                                    st.error(f"Fila {idx+2}: Cliente '{cliente}' no encontrado")
+                                    continue
+                                nombre = str(valor_celda(row.get('Nombre Proyecto'))).strip()
+                                filas[(clients_map[cliente], clave_texto(nombre))] = (f"Fila {idx+2}", {
+                                    "client_id": clients_map[cliente],
+                                    "name": nombre,
+                                    "currency": valor_celda(row.get('Moneda', 'PEN'), 'PEN')
+                                })
+                            
+                            etiquetas = [e for e, _ in filas.values()]
+                            barra = st.progress(0.0, text=f"Procesando {len(filas)} proyectos...")
+                            creadas, actualizadas, errores = sincronizar_por_clave(
+                                "projects", [f for _, f in filas.values()], etiquetas,
+                                lambda f: existentes.get((f['client_id'], clave_texto(f['name']))),
+                                progreso=barra)
+                            invalidar_referencias("projects")
+                            for err in errores:
+                                st.error(err)
+                            st.success(f" {creadas} proyectos nuevos, {actualizadas} actualizados")
                     except Exception as e:
                         st.error(f"Error: {e}")
             
@@ -1386,9 +3025,11 @@ else:
                         st.write("Vista previa:", df_rates.head())
                         
                         if st.button("Procesar Carga de Tarifas"):
-                            projects_map = {p['name']: p['id'] for p in supabase.table("projects").select("id, name").execute().data}
-                            roles_map = {r['name']: r['id'] for r in supabase.table("roles").select("id, name").execute().data}
-                            success_count = 0
+                            projects_map = {p['name']: p['id'] for p in get_proyectos_cached()}
+                            roles_map = {r['name']: r['id'] for r in get_roles_cached()}
+                            
+                            # Clave natural: (proyecto, rol); los ids existentes se buscan en una consulta
+                            filas = {}
                             for idx, row in df_rates.iterrows():
                                 try:
                                     proyecto = row.get('Proyecto')
@@ -1401,15 +3042,21 @@ else:
                                         st.error(f"Fila {idx+2}: Rol '{rol}' no encontrado")
                                         continue
                                     
-                                    supabase.table("project_rates").insert({
+                                    filas[(projects_map[proyecto], roles_map[rol])] = (f"Fila {idx+2}", {
                                         "project_id": projects_map[proyecto],
                                         "role_id": roles_map[rol],
                                         "rate": float(row.get('Tarifa'))
-                                    }).execute()
-                                    success_count += 1
+                                    })
                                 except Exception as e:
                                     st.error(f"Fila {idx+2}: {str(e)}")
-                            st.success(f" {success_count} tarifas cargadas")
+                            
+                            barra = st.progress(0.0, text=f"Procesando {len(filas)} tarifas...")
+                            creadas, actualizadas, errores = guardar_tarifas_por_clave(
+                                [f for _, f in filas.values()], [e for e, _ in filas.values()], progreso=barra)
+                            invalidar_referencias("project_rates")
+                            for err in errores:
+                                st.error(err)
+                            st.success(f" {creadas} tarifas nuevas, {actualizadas} actualizadas")
                     except Exception as e:
                         st.error(f"Error: {e}")
 
@@ -1417,8 +3064,8 @@ else:
             st.header(" Facturación y Reportes")
             
             # Filtros de Reporte
-            clientes_q = supabase.table("clients").select("id, name, doi_type, doi_number, address").order("name").execute()
-            if not clientes_q.data:
+            clientes_q = get_clientes_cached()
+            if not clientes_q or not clientes_q.data:
                 st.warning("Debe registrar clientes primero.")
             else:
                 with st.sidebar:
@@ -1434,251 +3081,7 @@ else:
 
                 if len(date_range) == 2:
                     start_d, end_d = date_range
-                    report_q = supabase.table("time_entries").select("*, profiles(full_name, role_id, roles(name)), projects(name, currency, client_id)").eq("projects.client_id", cli_data['id']).execute()
-                    
-                    if report_q.data:
-                        df_rep = pd.json_normalize(report_q.data)
-                        if df_rep.empty:
-                            st.info("No hay registros en el periodo seleccionado.")
-                        else:
-                            # Procesamiento
-                            df_rep['dt_ref'] = df_rep['start_time'].fillna(df_rep['created_at'])
-                            df_rep['dt_start'] = (pd.to_datetime(df_rep['dt_ref'], utc=True, errors='coerce') - pd.Timedelta(hours=5)).dt.tz_localize(None)
-                            df_rep['Fecha_dt'] = df_rep['dt_start'].dt.date
-                            df_rep['Fecha_str'] = df_rep['dt_start'].dt.strftime('%d.%m-%Y').fillna('---')
-                            
-                            rates = supabase.table("project_rates").select("*").execute()
-                            rates_df = pd.DataFrame(rates.data)
-                            
-                            def get_cost_rep(row):
-                                if rates_df.empty: return 0.0
-                                r = rates_df[(rates_df['project_id'] == row['project_id']) & (rates_df['role_id'] == row['profiles.role_id'])]
-                                return float(r['rate'].iloc[0]) if not r.empty else 0.0
-                            
-                            df_rep['Horas_num'] = df_rep['total_minutes'] / 60
-                            df_rep['Costo_H'] = df_rep.apply(get_cost_rep, axis=1)
-                            df_rep['Total_Monto'] = df_rep['Horas_num'] * df_rep['Costo_H']
-                            
-                            # SELECTOR DE PROYECTOS (Nuevo)
-                            st.markdown("###  Selección de Proyectos a Liquidar")
-                            proyectos_disponibles = df_rep['projects.name'].unique().tolist()
-                            proyectos_seleccionados = st.multiselect(
-                                "Seleccione los proyectos que desea incluir en esta liquidación:",
-                                options=proyectos_disponibles,
-                                default=proyectos_disponibles  # Por defecto todos seleccionados
-                            )
-                            
-                            if proyectos_seleccionados:
-                                # Filtrar dataframe por proyectos seleccionados
-                                df_rep = df_rep[df_rep['projects.name'].isin(proyectos_seleccionados)]
-                            
-                                tab1, tab2, tab3 = st.tabs([" Carta de Liquidación", " Anexo Detallado", " Dashboard"])
-                            
-                                with tab1:
-                                    monedas_disp = [m for m in df_rep['projects.currency'].unique() if pd.notna(m) and str(m) != 'nan']
-                                    if not monedas_disp:
-                                        st.warning("No hay monedas vlidas.")
-                                    else:
-                                        moneda_liq = st.selectbox("Moneda para Carta", monedas_disp)
-                                        df_carta = df_rep[df_rep['projects.currency'] == moneda_liq].copy()
-                                        total_general_liq = df_carta['Total_Monto'].sum()
-                                        
-                                        # Datos Pre-llenados
-                                        doi_str = str(cli_data.get('doi_number', '')).strip()
-                                        if doi_str == 'nan' or not doi_str: doi_str = '---'
-                                        addr_str = str(cli_data.get('address', '')).strip()
-                                        if addr_str == 'nan' or not addr_str: addr_str = 'Lima, Per.'
-                                        try:
-                                            firma_def = st.session_state.profile['full_name']
-                                        except: firma_def = "Responsable"
-                                        
-                                        # ===== CONTROL DE LIQUIDACIN =====
-                                        st.markdown("---")
-                                        st.markdown("###  Control de Liquidación")
-                                        
-                                        # Verificar liquidación existente
-                                        existing_liq = supabase.table("liquidations").select("*").eq("client_id", cli_data['id']).eq("period_start", start_d.isoformat()).eq("period_end", end_d.isoformat()).eq("currency", moneda_liq).execute()
-                                        
-                                        liquidation_number = None
-                                        liquidation_id = None
-                                        liquidation_status = "draft"
-                                        
-                                        if existing_liq.data:
-                                            liq_data = existing_liq.data[0]
-                                            liquidation_number = liq_data['liquidation_number']
-                                            liquidation_id = liq_data['id']
-                                            liquidation_status = liq_data.get('status', 'draft')
-                                            st.info(f" Liquidación existente: **{liquidation_number}** | Estado: **{liquidation_status.upper()}**")
-                                        else:
-                                            st.caption(" No se ha generado número de liquidación. Se generará al guardar.")
-                                        
-                                        # Campo para notas especiales (descuentos, condiciones, etc.)
-                                        st.markdown("#####  Notas Especiales (Opcional)")
-                                        st.caption("Agregue aqu descuentos, condiciones especiales o cualquier texto adicional que desee incluir en la carta.")
-                                        notas_especiales = st.text_area(
-                                            "Notas adicionales para esta liquidación:",
-                                            placeholder="Ejemplo: Se aplic un descuento del 10% por volumen de horas.\nO: Monto neto a pagar: USD 5,400.00 (despus de descuento de USD 600.00)",
-                                            height=100,
-                                            key=f"notas_{cli_name_sel}_{moneda_liq}",
-                                            value=existing_liq.data[0].get('special_notes', '') if existing_liq.data else ''
-                                        )
-                                        
-                                        # Construir seccin de notas si existe
-                                        seccion_notas = ""
-                                        if notas_especiales and notas_especiales.strip():
-                                            seccion_notas = f"\n\n{notas_especiales.strip()}"
-                                        
-                                        # Construir referencia con número
-                                        ref_line = "Ref.: Liquidación de Honorarios"
-                                        if liquidation_number:
-                                            ref_line = f"Ref.: Liquidación de Honorarios N {liquidation_number}"
-                                        
-                                        # Plantilla de Carta basada en PDF Hoja 1
-                                        fecha_carta = get_lima_now().strftime('%d de %B de %Y')
-                                        
-                                        letter_template = f"""San Isidro, {fecha_carta}
-
-Seor(es):
-{cli_name_sel.upper()}
-Presente.-
-
-Estimado(s) seor(es):
-
-Nos dirigimos a usted(es) con el propsito de saludarlo(s) cordialmente y remitir la {ref_line}, por la suma neta de {moneda_liq} {total_general_liq:,.2f}, ms el Impuesto General a las Ventas.
-
-El detalle de las actividades efectivamente ejecutadas a favor de usted(es) se encuentra consignado en la liquidación de horas que se adjunta a esta comunicación. En tal sentido, agradeceremos se sirvan revisar detenidamente la información anexada.{seccion_notas}
-
-Para el pago de los honorarios y de la respectiva detraccin, srvanse tener en cuenta los siguientes datos:
-
-**Pago Detracciones:** Banco de la Nacin
-Cuenta corriente Soles N 00-005-337240
-
-**Pago Honorarios:** 
-[BANCO] [TIPO CUENTA] 
-N [NUMERO DE CUENTA]
-
-Atentamente,
-
-__________________________
-{firma_def}
-Responsable"""
-                                        
-                                        st.markdown("##### Editor de Carta")
-                                        full_letter_text = st.text_area("Contenido", value=letter_template, height=450)
-                                        
-                                        # Botones para guardar liquidación
-                                        st.markdown("---")
-                                        col_save1, col_save2, col_save3 = st.columns([1, 1, 1])
-                                        
-                                        with col_save1:
-                                            if st.button(" Guardar Liquidación", type="primary", help="Guardar liquidación y generará número correlativo"):
-                                                try:
-                                                    # Generar número si no existe
-                                                    if not liquidation_number:
-                                                        result = supabase.rpc('get_next_liquidation_number').execute()
-                                                        liquidation_number = result.data
-                                                    
-                                                    # Preparar datos
-                                                    liq_data_to_save = {
-                                                        "client_id": cli_data['id'],
-                                                        "period_start": start_d.isoformat(),
-                                                        "period_end": end_d.isoformat(),
-                                                        "currency": moneda_liq,
-                                                        "total_amount": float(total_general_liq),
-                                                        "special_notes": notas_especiales.strip() if notas_especiales else None,
-                                                        "projects": proyectos_seleccionados,
-                                                        "status": "draft",
-                                                        "generated_by": st.session_state.user.id
-                                                    }
-                                                    
-                                                    if liquidation_id:
-                                                        supabase.table("liquidations").update(liq_data_to_save).eq("id", liquidation_id).execute()
-                                                        st.success(f" Liquidación {liquidation_number} actualizada")
-                                                    else:
-                                                        liq_data_to_save["liquidation_number"] = liquidation_number
-                                                        supabase.table("liquidations").insert(liq_data_to_save).execute()
-                                                        st.success(f" Liquidación {liquidation_number} guardada")
-                                                    
-                                                    st.rerun()
-                                                except Exception as e:
-                                                    st.error(f"Error al guardar: {str(e)}")
-                                        
-                                        with col_save2:
-                                            if liquidation_id and liquidation_status == "draft":
-                                                if st.button(" Marcar como Enviada"):
-                                                    try:
-                                                        supabase.table("liquidations").update({"status": "sent", "sent_at": get_lima_now().astimezone(timezone.utc).replace(tzinfo=None).isoformat()}).eq("id", liquidation_id).execute()
-                                                        st.success(" Marcada como Enviada")
-                                                        st.rerun()
-                                                    except Exception as e:
-                                                        st.error(f"Error: {str(e)}")
-                                        
-                                        with col_save3:
-                                            if liquidation_id and liquidation_status == "sent":
-                                                if st.button(" Marcar como Pagada"):
-                                                    try:
-                                                        supabase.table("liquidations").update({"status": "paid", "paid_at": get_lima_now().astimezone(timezone.utc).replace(tzinfo=None).isoformat()}).eq("id", liquidation_id).execute()
-                                                        st.success(" Marcada como Pagada")
-                                                        st.rerun()
-                                                    except Exception as e:
-                                                        st.error(f"Error: {str(e)}")
-                                        
-                                        st.markdown("---")
-                                        c1, c2 = st.columns(2)
-                                        with c1:
-                                            st.caption("Vista Previa")
-                                            st.markdown(f"<div style='background:white; color:black; padding:25px; border:1px solid #ccc; font-family:Times New Roman; white-space: pre-wrap;'>{full_letter_text}</div>", unsafe_allow_html=True)
-                                        with c2:
-                                            st.caption("Acciones")
-                                            if HAS_DOCX:
-                                                docx_bytes = generate_word_letter(full_letter_text, firma_def)
-                                                st.download_button(" Descargar Word (.docx)", data=docx_bytes, file_name=f"Carta_{cli_name_sel}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document", type="primary")
-                                            else:
-                                                st.warning("Instale python-docx.")
-
-                                with tab2:
-                                    if 'moneda_liq' in locals() and moneda_liq:
-                                        st.subheader(f"Anexo: Detalle ({moneda_liq})")
-                                        df_anexo = df_rep[df_rep['projects.currency'] == moneda_liq].copy()
-                                        full_xls = []
-                                        for proj in df_anexo['projects.name'].unique():
-                                            st.markdown(f"**Proyecto: {proj}**")
-                                            df_p = df_anexo[df_anexo['projects.name'] == proj].copy()
-                                            disp = df_p[['Fecha_str', 'profiles.full_name', 'description', 'total_minutes', 'Total_Monto']].copy()
-                                            disp['Tiempo'] = disp['total_minutes'].apply(lambda x: f"{int(x)//60:02d}:{int(x)%60:02d}")
-                                            disp = disp[['Fecha_str', 'profiles.full_name', 'description', 'Tiempo', 'Total_Monto']]
-                                            disp.columns = ['Fecha', 'Consultor', 'Actividad', 'Tiempo', 'Valor']
-                                            st.dataframe(disp, column_config={"Valor": st.column_config.NumberColumn(format="%.2f")}, use_container_width=True, hide_index=True)
-                                            
-                                            clean_p = disp.copy()
-                                            clean_p.insert(0, 'Proyecto', proj)
-                                            full_xls.append(clean_p)
-                                        
-                                        st.markdown("---")
-                                        if HAS_OPENPYXL and full_xls:
-                                            try:
-                                                final_xls = pd.concat(full_xls)
-                                                buffer = io.BytesIO()
-                                                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                                    final_xls.to_excel(writer, index=False, sheet_name='Anexo')
-                                                st.download_button(f" Descargar Anexo Detallado ({moneda_liq})", data=buffer.getvalue(), file_name=f"anexo_{cli_name_sel}_{moneda_liq}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                                            except Exception as e:
-                                                st.error(f"Error generando Excel: {str(e)}")
-                                        elif full_xls:
-                                            st.warning(" Requiere 'openpyxl' para descargar el anexo en Excel.")
-                                    else:
-                                        st.info("Seleccione moneda en pestaa Carta.")
-
-                                with tab3:
-                                    st.subheader("Dashboard")
-                                    sum_df = df_rep.groupby(['profiles.full_name', 'projects.currency'])[['Horas_num', 'Total_Monto']].sum().reset_index()
-                                    sum_df['Tiempo'] = sum_df['Horas_num'].apply(lambda h: f"{int(h)}h {int((h*60)%60)}m")
-                                    st.dataframe(sum_df, column_config={"Total_Monto": st.column_config.NumberColumn(format="%.2f")}, use_container_width=True, hide_index=True)
-                            else:
-                                st.warning(" Debe seleccionar al menos un proyecto para generará la liquidación.")
-
-                    else:
-                        st.info("No se encontraron registros para este cliente.")
+                    mostrar_liquidacion(cli_data, cli_name_sel, start_d, end_d)
                 else:
                     st.info("Seleccione un rango de fechas en la barra lateral.")
 
@@ -1686,8 +3089,5 @@ Responsable"""
         # Para roles de usuario no administrador
         mostrar_registro_tiempos()
 
-# --- REFRESH DINMICO (Al final para no bloquear UI) ---
-
-if st.session_state.get('user') and st.session_state.get('timer_running') and not st.session_state.get('logout_requested'):
-    time.sleep(1)
-    st.rerun()
+# --- PANEL DE CONSULTAS (cierre de la ejecución) ---
+cerrar_medicion()
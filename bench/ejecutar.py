@@ -0,0 +1,165 @@
+"""Benchmark de las páginas de app.py contra un Supabase falso en memoria (sin red).
+
+Ejecuta el script real con ``streamlit.testing`` (AppTest) y mide, por página,
+la latencia de render, la cantidad de consultas y los bytes de payload. El
+escenario "Formulario" mide el tiempo hasta el formulario de registro interactivo
+de un consultor con cronómetro en curso, desde que pulsa "Entrar".
+
+Uso:
+    python bench/ejecutar.py                          # 1k, 10k y 100k registros
+    python bench/ejecutar.py --volumenes 1000 --repeticiones 5
+    python bench/ejecutar.py --latencia-ms 40 --json resultados.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import streamlit as st
+import supabase
+from streamlit.testing.v1 import AppTest
+
+from semilla import CLAVE, EMAIL_ADMIN, EMAIL_USUARIO, sembrar
+
+APP = str(Path(__file__).resolve().parent.parent / "app.py")
+PAGINAS = ["Registro de Tiempos", "Panel General", "Facturación y Reportes", "Carga Masiva"]
+
+
+def nueva_app(fake, usuario=None):
+    """AppTest apuntando al cliente falso; con ``usuario`` arranca con la sesión ya iniciada."""
+    supabase.create_client = lambda *a, **k: fake
+    at = AppTest.from_file(APP, default_timeout=600)
+    at.secrets["SUPABASE_URL"] = "http://bench.local"
+    at.secrets["SUPABASE_KEY"] = "bench"
+    if usuario:
+        perfil = next(p for p in fake.db["profiles"] if p["id"] == usuario)
+        rol = next((r for r in fake.db["roles"] if r["id"] == perfil["role_id"]), {"name": ""})
+        at.session_state["user"] = SimpleNamespace(id=usuario)
+        at.session_state["profile"] = dict(perfil, roles={"name": rol["name"]})
+        at.session_state["is_admin"] = perfil["is_admin"]
+        at.session_state["logout_requested"] = False
+    return at
+
+
+def medir(fake, ejecutar):
+    """Corre ``ejecutar()`` y devuelve (segundos, consultas, bytes)."""
+    fake.reset_log()
+    t0 = time.perf_counter()
+    at = ejecutar()
+    segundos = time.perf_counter() - t0
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return segundos, len(fake.log), sum(q["bytes"] for q in fake.log)
+
+
+def fila(pagina, volumen, frio, tibios):
+    return {
+        "pagina": pagina, "registros": volumen,
+        "frio_ms": round(frio[0] * 1000, 1), "frio_consultas": frio[1], "frio_bytes": frio[2],
+        "tibio_ms": round(statistics.median(t[0] for t in tibios) * 1000, 1),
+        "tibio_consultas": tibios[-1][1], "tibio_bytes": tibios[-1][2],
+    }
+
+
+def limpiar_caches():
+    # Equivale a un proceso recién iniciado: réplica, almacén y referencias vacíos
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+
+def escenario_login(fake, volumen, repeticiones):
+    # Desde la primera carga (sin sesión) hasta la página inicial ya autenticada
+    def login():
+        at = nueva_app(fake)
+        at.run()
+        at.text_input[0].input(EMAIL_ADMIN)
+        at.text_input[1].input(CLAVE)
+        return at.button[0].click().run()
+    limpiar_caches()
+    return fila("Login", volumen, medir(fake, login), [medir(fake, login) for _ in range(repeticiones)])
+
+
+def escenario_formulario(fake, volumen, repeticiones):
+    # Tiempo hasta el formulario: clic en "Entrar" -> registro con cliente/proyecto del cronómetro
+    usuario = fake.usuarios_auth[EMAIL_USUARIO]["id"]
+    ahora = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+    fake.db["active_timers"] = [t for t in fake.db["active_timers"] if t["user_id"] != usuario] + [{
+        "id": max((t["id"] for t in fake.db["active_timers"]), default=0) + 1, "user_id": usuario, "project_id": 1,
+        "description": "Trabajo en curso", "is_billable": True, "is_running": True, "total_elapsed_seconds": 0,
+        "start_time": ahora, "created_at": ahora, "updated_at": ahora,
+    }]
+
+    def hasta_formulario():
+        at = nueva_app(fake)
+        at.run()
+        at.text_input[0].input(EMAIL_USUARIO)
+        at.text_input[1].input(CLAVE)
+        fake.reset_log()
+        t0 = time.perf_counter()
+        at.button[0].click().run()
+        segundos = time.perf_counter() - t0
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        if not any(b.label == "Registrar Manualmente" for b in at.button):
+            raise RuntimeError("el formulario de registro no quedó visible tras el login")
+        return segundos, len(fake.log), sum(q["bytes"] for q in fake.log)
+    limpiar_caches()
+    return fila("Formulario", volumen, hasta_formulario(), [hasta_formulario() for _ in range(repeticiones)])
+
+
+def escenario_pagina(fake, volumen, pagina, repeticiones):
+    # Frío: primera visita con las cachés de proceso vacías; tibio: reruns de la misma página
+    if pagina == "Registro de Tiempos":
+        for t in fake.db["active_timers"]:
+            t["updated_at"] = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+    at = nueva_app(fake, usuario="u0")
+    at.run()
+    limpiar_caches()
+
+    def visitar():
+        return at.sidebar.selectbox[0].set_value(pagina).run() if pagina != "Panel General" else at.run()
+    frio = medir(fake, visitar)
+    return fila(pagina, volumen, frio, [medir(fake, at.run) for _ in range(repeticiones)])
+
+
+def ejecutar(volumenes, repeticiones, latencia_s):
+    resultados = []
+    for volumen in volumenes:
+        t0 = time.perf_counter()
+        fake = sembrar(volumen, latencia_s=latencia_s)
+        print(f"\n== {volumen} registros (sembrado en {time.perf_counter() - t0:.1f} s)", file=sys.stderr)
+        resultados.append(escenario_login(fake, volumen, repeticiones))
+        resultados.append(escenario_formulario(fake, volumen, repeticiones))
+        for pagina in PAGINAS:
+            resultados.append(escenario_pagina(fake, volumen, pagina, repeticiones))
+    return resultados
+
+
+def imprimir(resultados):
+    columnas = ["pagina", "registros", "frio_ms", "frio_consultas", "frio_bytes", "tibio_ms", "tibio_consultas", "tibio_bytes"]
+    anchos = {c: max(len(c), *(len(str(r[c])) for r in resultados)) for c in columnas}
+    print("  ".join(c.ljust(anchos[c]) for c in columnas))
+    for r in resultados:
+        print("  ".join(str(r[c]).ljust(anchos[c]) for c in columnas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--volumenes", type=int, nargs="+", default=[1000, 10000, 100000], help="registros de tiempo a sembrar")
+    parser.add_argument("--repeticiones", type=int, default=3, help="reruns tibios por página (se reporta la mediana)")
+    parser.add_argument("--latencia-ms", type=float, default=0.0, help="latencia de red simulada por consulta")
+    parser.add_argument("--json", help="archivo donde guardar los resultados")
+    args = parser.parse_args()
+
+    resultados = ejecutar(args.volumenes, args.repeticiones, args.latencia_ms / 1000)
+    imprimir(resultados)
+    if args.json:
+        Path(args.json).write_text(json.dumps(resultados, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
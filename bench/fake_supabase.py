@@ -0,0 +1,492 @@
+"""Cliente falso de Supabase en memoria para pruebas y benchmarks sin red.
+
+Implementa el subconjunto de la API de ``supabase-py`` / ``postgrest`` que usa
+``app.py``: ``table().select/insert/update/upsert/delete``, filtros
+(``eq``, ``neq``, ``gt``, ``gte``, ``lt``, ``lte``, ``in_``, ``or_``,
+``is_``), ``order``, ``range``, ``limit``, ``single``, recursos embebidos
+(``projects(name, clients(name))``, ``!inner``), agregados
+(``total_minutes.sum()``), ``count="exact"``, ``rpc`` y ``auth``.
+
+Cada ``execute()`` queda registrado en ``FakeSupabase.log`` con la tabla,
+filtros, filas devueltas, bytes de payload y duración (incluida la latencia
+de red simulada con ``latencia_s``).
+"""
+import copy
+import json
+import re
+import time
+import uuid
+from types import SimpleNamespace
+
+# Relaciones foráneas: recurso embebido -> (columna local, tabla destino)
+RELACIONES = {
+    "profiles": ("profile_id", "profiles"),
+    "projects": ("project_id", "projects"),
+    "roles": ("role_id", "roles"),
+    "clients": ("client_id", "clients"),
+}
+RELACIONES_POR_TABLA = {
+    "active_timers": {"profiles": ("user_id", "profiles")},
+}
+
+
+class APIError(Exception):
+    pass
+
+
+def _split_top(s, sep=","):
+    """Divide ``s`` por ``sep`` ignorando separadores dentro de paréntesis."""
+    out, depth, cur = [], 0, ""
+    for ch in s:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == sep and depth == 0:
+            out.append(cur.strip())
+            cur = ""
+        else:
+            cur += ch
+    if cur.strip():
+        out.append(cur.strip())
+    return out
+
+
+def _coerce(v):
+    if isinstance(v, str):
+        if v in ("true", "false"):
+            return v == "true"
+        if v == "null":
+            return None
+        if re.fullmatch(r"-?\d+", v):
+            return int(v)
+    return v
+
+
+_FECHA_ISO = re.compile(r"\d{4}-\d{2}-\d{2}T")
+_ZONA_UTC = re.compile(r"(\+00:00|Z)$")
+
+
+def _cmp_key(v):
+    # Comparación homogénea: fechas ISO como texto normalizado sin zona
+    if isinstance(v, str) and _FECHA_ISO.match(v):
+        return _ZONA_UTC.sub("", v)
+    return v
+
+
+def _compare(op, a, b):
+    if op == "is":
+        return a is None if b in (None, "null") else a == _coerce(b)
+    if a is None:
+        return False
+    if op == "in":
+        return a in b
+    b = _coerce(b) if isinstance(b, str) and not isinstance(a, str) else b
+    try:
+        a_k, b_k = _cmp_key(a), _cmp_key(b)
+        if op == "eq":
+            return a_k == b_k
+        if op == "neq":
+            return a_k != b_k
+        if op == "gt":
+            return a_k > b_k
+        if op == "gte":
+            return a_k >= b_k
+        if op == "lt":
+            return a_k < b_k
+        if op == "lte":
+            return a_k <= b_k
+    except TypeError:
+        return False
+    raise APIError(f"Operador no soportado: {op}")
+
+
+def _parse_or(expr):
+    """Convierte ``a.eq.1,and(b.lt.2,c.eq.3)`` en un árbol de condiciones."""
+    conds = []
+    for part in _split_top(expr):
+        if part.startswith("and(") and part.endswith(")"):
+            conds.append(("and", _parse_or(part[4:-1])))
+        elif part.startswith("or(") and part.endswith(")"):
+            conds.append(("or", _parse_or(part[3:-1])))
+        else:
+            col, op, val = part.split(".", 2)
+            if op == "in":
+                val = [_coerce(x.strip().strip('"')) for x in val.strip("()").split(",")]
+            else:
+                val = val.strip('"')
+            conds.append(("cmp", (col, op, val)))
+    return conds
+
+
+class _Response(SimpleNamespace):
+    pass
+
+
+class _Query:
+    def __init__(self, client, table):
+        self.client = client
+        self.table_name = table
+        self.op = "select"
+        self.columns = "*"
+        self.filters = []
+        self.orders = []
+        self.range_ = None
+        self.limit_ = None
+        self.single_ = False
+        self.payload = None
+        self.count = None
+        self.head = False
+        self.on_conflict = None
+
+    # --- Construcción ---
+    def select(self, columns="*", count=None, head=None):
+        self.op, self.columns, self.count, self.head = "select", columns, count, bool(head)
+        return self
+
+    def insert(self, payload, **_):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload, **_):
+        self.op, self.payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict=None, **_):
+        self.op, self.payload, self.on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def delete(self, **_):
+        self.op = "delete"
+        return self
+
+    def _f(self, op, col, val):
+        self.filters.append(("cmp", (col, op, val)))
+        return self
+
+    def eq(self, c, v): return self._f("eq", c, v)
+    def neq(self, c, v): return self._f("neq", c, v)
+    def gt(self, c, v): return self._f("gt", c, v)
+    def gte(self, c, v): return self._f("gte", c, v)
+    def lt(self, c, v): return self._f("lt", c, v)
+    def lte(self, c, v): return self._f("lte", c, v)
+    def is_(self, c, v): return self._f("is", c, v)
+    def in_(self, c, v): return self._f("in", c, list(v))
+
+    def or_(self, expr, **_):
+        self.filters.append(("or", _parse_or(expr)))
+        return self
+
+    def order(self, col, desc=False, **_):
+        self.orders.append((col, desc))
+        return self
+
+    def range(self, start, end):
+        self.range_ = (start, end)
+        return self
+
+    def limit(self, n, **_):
+        self.limit_ = n
+        return self
+
+    def single(self):
+        self.single_ = True
+        return self
+
+    def maybe_single(self):
+        return self.single()
+
+    # --- Ejecución ---
+    def _rows(self):
+        return self.client.db.setdefault(self.table_name, [])
+
+    def _match(self, row, conds, mode="and"):
+        results = []
+        for kind, c in conds:
+            if kind == "cmp":
+                col, op, val = c
+                if "." in col:
+                    # Filtro sobre recurso embebido: se evalúa tras embeber
+                    continue
+                results.append(_compare(op, row.get(col), val))
+            elif kind == "and":
+                results.append(self._match(row, c, "and"))
+            elif kind == "or":
+                results.append(self._match(row, c, "or"))
+        if not results:
+            return True
+        return all(results) if mode == "and" else any(results)
+
+    def _embed(self, table, row, columns):
+        # None si un embebido ``!inner`` no tiene fila: PostgREST descarta la fila padre
+        out = {}
+        aggregates = []
+        for col in _split_top(columns):
+            m = re.fullmatch(r"(\w+)(!inner)?\((.*)\)", col, re.S)
+            if m:
+                name, inner, sub = m.group(1), m.group(2), m.group(3)
+                rel = RELACIONES_POR_TABLA.get(table, {}).get(name) or RELACIONES.get(name)
+                if not rel:
+                    raise APIError(f"Relación desconocida {name}")
+                fk, target = rel
+                key = row.get(fk)
+                target_row = self.client._by_id(target, key)
+                out[name] = self._embed(target, target_row, sub) if target_row else None
+                if inner and out[name] is None:
+                    return None
+            elif col == "*":
+                out.update({k: v for k, v in row.items()})
+            else:
+                m_agg = re.fullmatch(r"(\w+)\.(sum|count|avg|min|max)\(\)", col)
+                if m_agg:
+                    aggregates.append((m_agg.group(1), m_agg.group(2)))
+                    continue
+                out[col] = row.get(col)
+        if aggregates:
+            out["__agg__"] = aggregates
+        return out
+
+    def _embedded_ok(self, row):
+        for kind, c in self.filters:
+            if kind != "cmp" or "." not in c[0]:
+                continue
+            col, op, val = c
+            base, sub = col.split(".", 1)
+            emb = row.get(base)
+            if emb is None:
+                # Sin !inner PostgREST deja la fila con el embebido nulo
+                if f"{base}!inner" in self.columns:
+                    return False
+                continue
+            if not _compare(op, emb.get(sub), val):
+                if f"{base}!inner" in self.columns:
+                    return False
+                row[base] = None
+        return True
+
+    def execute(self):
+        t0 = time.perf_counter()
+        if self.client.latencia_s:
+            # Ida y vuelta de red simulada
+            time.sleep(self.client.latencia_s)
+        data, count = self._execute()
+        if self.single_:
+            if not data:
+                raise APIError("JSON object requested, multiple (or no) rows returned")
+            data = data[0]
+        payload = json.dumps(data, default=str)
+        elapsed = time.perf_counter() - t0
+        self.client.log.append({
+            "table": self.table_name, "op": self.op,
+            "filters": [str(f) for f in self.filters],
+            "rows": len(data) if isinstance(data, list) else 1,
+            "bytes": len(payload), "seconds": elapsed,
+        })
+        return _Response(data=json.loads(payload), count=count)
+
+    def _execute(self):
+        rows = self._rows()
+        if self.op == "select":
+            matched = [r for r in rows if self._match(r, self.filters)]
+            for col, desc in reversed(self.orders):
+                matched.sort(key=lambda r: (r.get(col) is None, _cmp_key(r.get(col))), reverse=desc)
+            aggs = re.findall(r"(\w+)\.(sum|count)\(\)", self.columns)
+            if not aggs and "!inner" not in self.columns and not any(kind == "cmp" and "." in c[0] for kind, c in self.filters):
+                # Sin filtros sobre embebidos, !inner ni agregados: paginar antes de embeber
+                count = len(matched) if self.count else None
+                if self.range_:
+                    matched = matched[self.range_[0]:self.range_[1] + 1]
+                if self.limit_ is not None:
+                    matched = matched[:self.limit_]
+                out = [] if self.head else [self._embed(self.table_name, r, self.columns) for r in matched]
+                for e in out:
+                    e.pop("__agg__", None)
+                return out, count
+            out = []
+            for r in matched:
+                e = self._embed(self.table_name, r, self.columns)
+                if e is not None and self._embedded_ok(e):
+                    e["__src__"] = r
+                    out.append(e)
+            if aggs:
+                out = self._group(out, aggs)
+            else:
+                for e in out:
+                    e.pop("__src__", None)
+                    e.pop("__agg__", None)
+            count = len(out) if self.count else None
+            if self.range_:
+                out = out[self.range_[0]:self.range_[1] + 1]
+            if self.limit_ is not None:
+                out = out[:self.limit_]
+            if self.head:
+                out = []
+            return out, count
+        if self.op == "insert":
+            items = self.payload if isinstance(self.payload, list) else [self.payload]
+            created = []
+            try:
+                # Un INSERT masivo es una sola sentencia: todo o nada
+                for it in items:
+                    row = dict(it)
+                    row.setdefault("id", self.client._next_id(self.table_name))
+                    row.setdefault("created_at", self.client.now_iso())
+                    if self.table_name in self.client.con_updated_at:
+                        row.setdefault("updated_at", self.client.now_iso())
+                    self.client._check_unique(self.table_name, row)
+                    rows.append(row)
+                    created.append(row)
+            except APIError:
+                del rows[len(rows) - len(created):]
+                raise
+            return copy.deepcopy(created), None
+        if self.op == "upsert":
+            items = self.payload if isinstance(self.payload, list) else [self.payload]
+            keys = (self.on_conflict or "id").split(",")
+            if keys != ["id"] and tuple(keys) not in self.client.unique.get(self.table_name, []):
+                # Como PostgREST: ON CONFLICT exige una restricción única sobre esas columnas
+                raise APIError("there is no unique or exclusion constraint matching the ON CONFLICT specification")
+            out = []
+            for it in items:
+                existing = next((r for r in rows if all(r.get(k) == it.get(k) for k in keys)), None)
+                if existing is not None:
+                    existing.update(it)
+                    if self.table_name in self.client.con_updated_at:
+                        existing["updated_at"] = self.client.now_iso()
+                    out.append(existing)
+                else:
+                    row = dict(it)
+                    row.setdefault("id", self.client._next_id(self.table_name))
+                    row.setdefault("created_at", self.client.now_iso())
+                    if self.table_name in self.client.con_updated_at:
+                        row.setdefault("updated_at", self.client.now_iso())
+                    rows.append(row)
+                    out.append(row)
+            return copy.deepcopy(out), None
+        if self.op == "update":
+            out = []
+            for r in rows:
+                if self._match(r, self.filters):
+                    r.update(self.payload)
+                    if self.table_name in self.client.con_updated_at and "updated_at" not in self.payload:
+                        r["updated_at"] = self.client.now_iso()
+                    out.append(r)
+            return copy.deepcopy(out), None
+        if self.op == "delete":
+            keep, gone = [], []
+            for r in rows:
+                (gone if self._match(r, self.filters) else keep).append(r)
+            self.client.db[self.table_name] = keep
+            return copy.deepcopy(gone), None
+        raise APIError(self.op)
+
+    def _group(self, rows, aggs):
+        groups = {}
+        for e in rows:
+            src = e.pop("__src__")
+            e.pop("__agg__", None)
+            key = json.dumps(e, sort_keys=True, default=str)
+            base, srcs = groups.setdefault(key, (e, []))
+            srcs.append(src)
+        out = []
+        for base, srcs in groups.values():
+            for col, fn in aggs:
+                if fn == "sum":
+                    base["sum"] = sum(s.get(col) or 0 for s in srcs)
+                else:
+                    base["count"] = len(srcs)
+            out.append(base)
+        return out
+
+
+class _Auth:
+    def __init__(self, client):
+        self.client = client
+        self.admin = SimpleNamespace(create_user=self._create_user)
+
+    def sign_in_with_password(self, creds):
+        user = self.client.usuarios_auth.get(creds.get("email"))
+        if not user or user["password"] != creds.get("password"):
+            raise APIError("Invalid login credentials")
+        return SimpleNamespace(user=SimpleNamespace(id=user["id"], email=creds["email"]))
+
+    def _create_user(self, attrs):
+        uid = str(uuid.uuid4())
+        self.client.usuarios_auth[attrs["email"]] = {"id": uid, "password": attrs["password"]}
+        return SimpleNamespace(user=SimpleNamespace(id=uid))
+
+
+class _Rpc:
+    def __init__(self, client, name, params):
+        self.client, self.name, self.params = client, name, params
+
+    def execute(self):
+        if self.client.latencia_s:
+            time.sleep(self.client.latencia_s)
+        fn = self.client.rpcs.get(self.name)
+        if fn is None:
+            raise APIError(f"RPC desconocida: {self.name}")
+        data = fn(self.client, **(self.params or {}))
+        self.client.log.append({"table": f"rpc:{self.name}", "op": "rpc", "filters": [],
+                                "rows": 1, "bytes": len(json.dumps(data, default=str)),
+                                "seconds": self.client.latencia_s})
+        return _Response(data=data, count=None)
+
+
+def _next_liquidation_number(client):
+    client._liq_seq = getattr(client, "_liq_seq", 0) + 1
+    return f"LIQ-{client._liq_seq:05d}"
+
+
+class FakeSupabase:
+    """Base de datos en memoria con la forma del esquema de la app."""
+
+    def __init__(self, db=None, latencia_s=0.0):
+        self.db = db if db is not None else {}
+        self.log = []
+        self.latencia_s = latencia_s
+        self.usuarios_auth = {}
+        # Solo las restricciones únicas que existen en la base real (project_rates no tiene)
+        self.unique = {
+            "active_timers": [("user_id",)],
+        }
+        self.con_updated_at = {"time_entries", "active_timers"}
+        self.rpcs = {"get_next_liquidation_number": _next_liquidation_number}
+        self._seq = {}
+        self.auth = _Auth(self)
+
+    def now_iso(self):
+        from datetime import datetime, timezone
+        return datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+
+    def _next_id(self, table):
+        rows = self.db.get(table, [])
+        if rows and isinstance(rows[0].get("id"), str):
+            return str(uuid.uuid4())
+        self._seq[table] = max(self._seq.get(table, 0), max((r.get("id") or 0 for r in rows), default=0)) + 1
+        return self._seq[table]
+
+    def _check_unique(self, table, row):
+        for cols in self.unique.get(table, []):
+            for r in self.db.get(table, []):
+                if r is not row and all(r.get(c) == row.get(c) for c in cols):
+                    raise APIError(f'duplicate key value violates unique constraint "{table}_{"_".join(cols)}_key"')
+
+    def _by_id(self, table, key):
+        if key is None:
+            return None
+        for r in self.db.get(table, []):
+            if r.get("id") == key:
+                return r
+        return None
+
+    def table(self, name):
+        return _Query(self, name)
+
+    from_ = table
+
+    def rpc(self, name, params=None):
+        return _Rpc(self, name, params)
+
+    def reset_log(self):
+        self.log = []
@@ -0,0 +1,110 @@
+"""Benchmark de arranque en frío: costo de importación y librerías que carga cada perfil.
+
+Cada medición corre en un proceso nuevo de Python (nada queda en ``sys.modules``):
+
+* por librería pesada, el tiempo de ``import`` aislado;
+* por perfil (consultor en Registro de Tiempos, admin en Panel General y en
+  Facturación), el primer render de app.py contra el Supabase falso y qué librerías
+  pesadas quedaron importadas por la app.
+
+Uso:
+    python bench/importaciones.py
+    python bench/importaciones.py --repeticiones 5 --json arranque.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BENCH = Path(__file__).resolve().parent
+LIBRERIAS = ["streamlit", "pandas", "numpy", "supabase", "extra_streamlit_components", "openpyxl", "docx"]
+
+MEDIR_IMPORT = """
+import time
+t0 = time.perf_counter()
+import {modulo}
+print(time.perf_counter() - t0)
+"""
+
+MEDIR_PERFIL = """
+import json, sys, time
+sys.path.insert(0, {bench!r})
+from ejecutar import nueva_app
+from semilla import sembrar
+fake = sembrar(1000)
+at = nueva_app(fake, usuario={usuario!r})
+antes = set(sys.modules)
+t0 = time.perf_counter()
+at.run()
+if {pagina!r}:
+    at.sidebar.selectbox[0].set_value({pagina!r}).run()
+segundos = time.perf_counter() - t0
+if at.exception:
+    raise SystemExit(at.exception[0].message)
+cargadas = [m for m in {librerias!r} if m in sys.modules and m not in antes]
+print(json.dumps({{"segundos": segundos, "cargadas": cargadas}}))
+"""
+
+PERFILES = [
+    ("consultor: Registro de Tiempos", "u1", None),
+    ("admin: Panel General", "u0", None),
+    ("admin: Facturación y Reportes", "u0", "Facturación y Reportes"),
+]
+
+
+def correr(codigo):
+    res = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True, cwd=BENCH)
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr.strip().splitlines()[-1] if res.stderr.strip() else "proceso fallido")
+    return res.stdout.strip().splitlines()[-1]
+
+
+def medir_librerias(repeticiones):
+    filas = []
+    for modulo in LIBRERIAS:
+        try:
+            tiempos = [float(correr(MEDIR_IMPORT.format(modulo=modulo))) for _ in range(repeticiones)]
+        except RuntimeError:
+            filas.append({"medicion": f"import {modulo}", "ms": None, "cargadas": "no instalada"})
+            continue
+        filas.append({"medicion": f"import {modulo}", "ms": round(statistics.median(tiempos) * 1000, 1), "cargadas": ""})
+    return filas
+
+
+def medir_perfiles(repeticiones):
+    filas = []
+    for nombre, usuario, pagina in PERFILES:
+        codigo = MEDIR_PERFIL.format(bench=str(BENCH), usuario=usuario, pagina=pagina, librerias=LIBRERIAS)
+        resultados = [json.loads(correr(codigo)) for _ in range(repeticiones)]
+        filas.append({
+            "medicion": f"app {nombre} (1er render)",
+            "ms": round(statistics.median(r["segundos"] for r in resultados) * 1000, 1),
+            "cargadas": ", ".join(resultados[-1]["cargadas"]) or "-",
+        })
+    return filas
+
+
+def imprimir(resultados):
+    columnas = ["medicion", "ms", "cargadas"]
+    anchos = {c: max(len(c), *(len(str(r[c])) for r in resultados)) for c in columnas}
+    print("  ".join(c.ljust(anchos[c]) for c in columnas))
+    for r in resultados:
+        print("  ".join(str(r[c]).ljust(anchos[c]) for c in columnas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=3, help="procesos por medición (se reporta la mediana)")
+    parser.add_argument("--json", help="archivo donde guardar los resultados")
+    args = parser.parse_args()
+
+    resultados = medir_librerias(args.repeticiones) + medir_perfiles(args.repeticiones)
+    imprimir(resultados)
+    if args.json:
+        Path(args.json).write_text(json.dumps(resultados, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Datos sintéticos para el benchmark: usuarios, clientes, proyectos, tarifas y registros.
+
+Los registros se reparten en los últimos 90 días (hora Lima de oficina), de
+modo que los filtros por defecto de Panel General y Reportes encuentren datos.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+from fake_supabase import FakeSupabase
+
+EMAIL_ADMIN = "admin@bench.local"
+EMAIL_USUARIO = "usuario@bench.local"
+CLAVE = "bench"
+
+
+def sembrar(n_entradas=1000, n_usuarios=10, n_clientes=5, proyectos_por_cliente=3,
+            con_cronometro=True, latencia_s=0.0, semilla=1):
+    """Devuelve un ``FakeSupabase`` poblado. El usuario ``u0`` es administrador."""
+    rnd = random.Random(semilla)
+    ahora = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    db = {}
+    db["roles"] = [{"id": i, "name": f"Rol {i}"} for i in range(1, 5)]
+    db["profiles"] = [
+        {"id": f"u{i}", "full_name": f"Usuario {i}", "username": f"user{i}", "role_id": rnd.randint(1, 4),
+         "is_active": True, "is_admin": i == 0, "doi_type": "DNI", "doi_number": str(10000000 + i),
+         "account_type": "Administrador" if i == 0 else "Usuario"}
+        for i in range(n_usuarios)
+    ]
+    db["clients"] = [
+        {"id": i, "name": f"Cliente {i}", "doi_type": "RUC", "doi_number": f"20{i:09d}",
+         "address": "Lima", "email": "", "contact_number": ""}
+        for i in range(1, n_clientes + 1)
+    ]
+    db["projects"] = []
+    for c in db["clients"]:
+        for j in range(proyectos_por_cliente):
+            db["projects"].append({"id": len(db["projects"]) + 1, "client_id": c["id"],
+                                   "name": f"Proyecto {c['id']}-{j}", "currency": rnd.choice(["PEN", "USD"])})
+    db["project_rates"] = [
+        {"project_id": p["id"], "role_id": r["id"], "rate": float(rnd.choice([50, 80, 120, 150]))}
+        for p in db["projects"] for r in db["roles"] if rnd.random() < 0.85
+    ]
+    for k, r in enumerate(db["project_rates"]):
+        r["id"] = k + 1
+
+    db["time_entries"] = []
+    for i in range(n_entradas):
+        # Entre 08:00 y 18:00 hora Lima (13:00-23:00 UTC)
+        inicio = ahora.replace(hour=13, minute=0, second=0) - timedelta(days=rnd.randint(1, 90)) + timedelta(minutes=rnd.randint(0, 600))
+        minutos = rnd.randint(15, 240)
+        db["time_entries"].append({
+            "id": i + 1, "profile_id": rnd.choice(db["profiles"])["id"], "project_id": rnd.choice(db["projects"])["id"],
+            "start_time": inicio.isoformat(), "end_time": (inicio + timedelta(minutes=minutos)).isoformat(),
+            "total_minutes": minutos, "description": f"Tarea {i}", "is_billable": rnd.random() < 0.8,
+            "is_paid": False, "invoice_number": None, "internal_note": None,
+            "created_at": inicio.isoformat(), "updated_at": inicio.isoformat(),
+        })
+
+    db["active_timers"] = []
+    if con_cronometro:
+        # Cronómetro corriendo del administrador, iniciado hace 1h 10m
+        db["active_timers"].append({
+            "id": 1, "user_id": "u0", "project_id": 1, "description": "Trabajo en curso", "is_billable": True,
+            "start_time": (ahora - timedelta(hours=1, minutes=10)).isoformat(), "total_elapsed_seconds": 0,
+            "is_running": True, "created_at": ahora.isoformat(), "updated_at": ahora.isoformat(),
+        })
+    db["liquidations"] = []
+
+    fake = FakeSupabase(db, latencia_s=latencia_s)
+    fake.usuarios_auth = {EMAIL_ADMIN: {"id": "u0", "password": CLAVE}, EMAIL_USUARIO: {"id": "u1", "password": CLAVE}}
+    return fake
@@ -0,0 +1,18 @@
+-- time_entries.updated_at mantenida por la base: la réplica de app.py (ReplicaEntradas)
+-- trae solo las filas con updated_at posterior a su marca de agua.
+create extension if not exists moddatetime schema extensions;
+
+alter table public.time_entries
+    add column if not exists updated_at timestamp with time zone default now();
+
+update public.time_entries
+   set updated_at = coalesce(created_at, now())
+ where updated_at is null;
+
+create index if not exists time_entries_updated_at_id_idx
+    on public.time_entries (updated_at, id);
+
+drop trigger if exists time_entries_updated_at on public.time_entries;
+create trigger time_entries_updated_at
+    before update on public.time_entries
+    for each row execute procedure extensions.moddatetime(updated_at);
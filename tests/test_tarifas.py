@@ -0,0 +1,91 @@
+"""Regresión de resolver_tarifas contra las búsquedas fila por fila que reemplazó.
+
+app.py es un script de Streamlit y no se puede importar sin ejecutar la app, así
+que la función se toma del código fuente con ``ast`` y se evalúa aislada.
+"""
+import ast
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+
+def cargar_funcion(nombre):
+    arbol = ast.parse(APP.read_text(encoding="utf-8"))
+    nodo = next(n for n in arbol.body if isinstance(n, ast.FunctionDef) and n.name == nombre)
+    espacio = {"pd": pd, "np": np}
+    exec(compile(ast.Module(body=[nodo], type_ignores=[]), str(APP), "exec"), espacio)
+    return espacio[nombre]
+
+
+resolver_tarifas = cargar_funcion("resolver_tarifas")
+
+
+# --- IMPLEMENTACIÓN ANTERIOR (df.apply por fila) ---
+def costo_fila_a_fila(df, rates_df, role_col='profiles.role_id'):
+    def get_cost(row):
+        if not rates_df.empty:
+            r = rates_df[(rates_df['project_id'] == row['project_id']) & (rates_df['role_id'] == row[role_col])]
+            return float(r['rate'].iloc[0]) if not r.empty else 0.0
+        return 0.0
+
+    tarifa = df.apply(get_cost, axis=1) if not df.empty else pd.Series(dtype=float)
+    bruto = (df['total_minutes'] / 60) * tarifa
+    facturable = pd.Series([b if f else 0.0 for b, f in zip(bruto, df['is_billable'])], index=df.index, dtype=float)
+    return tarifa, bruto, facturable
+
+
+def datos_sinteticos(n_entradas, n_proyectos=80, n_roles=6, semilla=7):
+    rng = np.random.default_rng(semilla)
+    tarifas = pd.DataFrame({
+        'project_id': rng.integers(0, n_proyectos, n_proyectos * 3),
+        'role_id': rng.integers(0, n_roles, n_proyectos * 3),
+        'rate': rng.integers(1, 500, n_proyectos * 3) * 0.25,
+    })
+    # Proyectos sin tarifa y pares (proyecto, rol) duplicados con otro valor.
+    tarifas = tarifas[tarifas['project_id'] % 10 != 0]
+    tarifas = pd.concat([tarifas, tarifas.head(20).assign(rate=999.0)], ignore_index=True)
+
+    roles = rng.integers(0, n_roles, n_entradas).astype(float)
+    roles[rng.random(n_entradas) < 0.05] = np.nan  # perfiles sin rol
+    facturable = rng.choice(np.array([True, False, None], dtype=object), n_entradas, p=[0.6, 0.3, 0.1])
+    entradas = pd.DataFrame({
+        'project_id': rng.integers(0, n_proyectos + 5, n_entradas),
+        'profiles.role_id': roles,
+        'total_minutes': rng.integers(1, 600, n_entradas),
+        'is_billable': facturable,
+    }, index=pd.RangeIndex(100, 100 + n_entradas))
+    return entradas, tarifas
+
+
+@pytest.mark.parametrize("n_entradas", [0, 1, 5000])
+def test_resolver_tarifas_igual_a_fila_a_fila(n_entradas):
+    entradas, tarifas = datos_sinteticos(n_entradas)
+    tarifa, bruto, facturable = costo_fila_a_fila(entradas, tarifas)
+
+    montos = resolver_tarifas(entradas, tarifas)
+
+    assert montos.index.equals(entradas.index)
+    np.testing.assert_array_equal(montos['tarifa'].to_numpy(dtype=float), tarifa.to_numpy(dtype=float))
+    np.testing.assert_array_equal(montos['bruto'].to_numpy(dtype=float), bruto.to_numpy(dtype=float))
+    np.testing.assert_array_equal(montos['facturable'].to_numpy(dtype=float), facturable.to_numpy(dtype=float))
+
+
+def test_sin_tarifas_todo_en_cero():
+    entradas, _ = datos_sinteticos(50)
+    for vacias in (None, pd.DataFrame()):
+        montos = resolver_tarifas(entradas, vacias)
+        assert (montos[['tarifa', 'bruto', 'facturable']] == 0).all().all()
+
+
+def test_tarifa_duplicada_usa_la_primera():
+    entradas = pd.DataFrame({'project_id': [1], 'profiles.role_id': [2], 'total_minutes': [90], 'is_billable': [True]})
+    tarifas = pd.DataFrame({'project_id': [1, 1], 'role_id': [2, 2], 'rate': [40.0, 70.0]})
+
+    montos = resolver_tarifas(entradas, tarifas)
+
+    assert montos.loc[0, 'tarifa'] == 40.0
+    assert montos.loc[0, 'facturable'] == 60.0